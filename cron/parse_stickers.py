@@ -54,13 +54,22 @@ class Cache:
         return _redis.delete(key)
 
     @staticmethod
-    def delete_by_pattern(pattern: str):
+    def delete_by_pattern(pattern: str, batch_size: int = 500) -> int:
         """
         Удаляет ключи из кэша по паттерну. Пример паттерна: 'user:*'
 
-        See: https://stackoverflow.com/a/27561399/136559
+        Порциями через SCAN + UNLINK, чтобы не блокировать редис, как это делал KEYS.
         """
-        _redis.eval("for i, name in ipairs(redis.call('KEYS', ARGV[1])) do redis.call('DEL', name); end", 0, pattern)
+        deleted = 0
+        batch = []
+        for key in _redis.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                deleted += _redis.unlink(*batch)
+                batch = []
+        if batch:
+            deleted += _redis.unlink(*batch)
+        return deleted
 
 
 def request(url):
@@ -190,6 +190,8 @@ def add_private_handlers(dp):
         CommandHandler('topmat', topmat.private_topmat, filters=Filters.private & Filters.command))
     dp.add_handler(CommandHandler('anon', private.anon, filters=Filters.private & Filters.command))
     dp.add_handler(CommandHandler('year', private.year, filters=Filters.private & Filters.command))
+    dp.add_handler(CommandHandler('rollups_backfill', private.rollups_backfill,
+                                  filters=Filters.private & Filters.command))
     dp.add_handler(CommandHandler('send_to_all_chats', private.send_to_all_chats_handler, filters=Filters.private & Filters.command))
 
     # должно идти в конце
@@ -1,30 +1,84 @@
-from datetime import time
+from datetime import datetime, time, timedelta, timezone
+from typing import Callable, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 
+from telegram.ext.jobqueue import Days
+
+from src.commands.weather import warm_weather_cache
 from src.modules.weeklystat import weekly_stats
-from src.modules.jobs import daily_midnight, daily_afternoon, every_hour
+from src.models.user_stat import UserStatRollup
+from src.modules.jobs import daily_midnight, daily_afternoon, every_hour, reconcile_chat_members, \
+    flush_user_stat_rollups
+from src.utils.leader_lease import LeaderLease
+from src.utils.logger_helpers import get_logger
+from src.utils.time_helpers import get_last_due
 
+logger = get_logger(__name__)
 
-def add_jobs(updater):
-    updater.job_queue.run_daily(
-        weekly_stats,
-        time=time(0, 0, 10, tzinfo=ZoneInfo('Europe/Moscow')),  # во сколько постим
-        days=(0,)  # постим в понедельник
-    )
+# пропущенную ежедневную задачу запускаем, только если опоздали не сильно
+CATCH_UP_WITHIN = timedelta(hours=6)
+
+
+def add_jobs(updater, lease: Optional[LeaderLease] = None):
+    """
+    В кластере задачи регистрируются на каждом воркере, а выполняются только на лидере (`lease`).
+    Ежедневные задачи, время которых пришлось на смену лидера, запускает новый лидер.
+    """
+    daily_jobs: List[Tuple[str, Callable, time, tuple]] = []
+
+    def job(callback):
+        return lease.guard(callback) if lease else callback
+
+    def daily(callback, at: time, days: tuple = Days.EVERY_DAY):
+        if lease:
+            name = f'{callback.__name__}:{at.strftime("%H%M")}'
+            callback = lease.guard(callback, name)
+            daily_jobs.append((name, callback, at, days))
+        updater.job_queue.run_daily(callback, time=at, days=days)
+
+    # во сколько постим; постим в понедельник
+    daily(weekly_stats, time(0, 0, 10, tzinfo=ZoneInfo('Europe/Moscow')), days=(0,))
 
     # каждый день в 00:00
-    updater.job_queue.run_daily(
-        daily_midnight,
-        time=time(0, 0, 10, tzinfo=ZoneInfo('Europe/Moscow')),
-    )
+    daily(daily_midnight, time(0, 0, 10, tzinfo=ZoneInfo('Europe/Moscow')))
 
     # каждый день в 12:00
-    updater.job_queue.run_daily(
-        daily_afternoon,
-        time=time(12, 0, 10, tzinfo=ZoneInfo('Europe/Moscow')),
-    )
+    daily(daily_afternoon, time(12, 0, 10, tzinfo=ZoneInfo('Europe/Moscow')))
+
+    # каждый день в 04:00 сверяем участников чатов в редисе с бд
+    daily(reconcile_chat_members, time(4, 0, 0, tzinfo=ZoneInfo('Europe/Moscow')))
+
+    # прогреваем кэш погоды перед утренним и вечерним часом пик
+    for hour in (8, 18):
+        daily(warm_weather_cache, time(hour - 1, 50, 0, tzinfo=ZoneInfo('Europe/Moscow')))
+
+    if lease:
+        lease.on_acquire(lambda: updater.job_queue.run_once(
+            lambda bot, _: run_overdue(bot, daily_jobs), 0))
 
     updater.job_queue.run_repeating(
-        every_hour, first=65,
+        job(every_hour), first=65,
         interval=60 * 60  # раз в час
     )
+
+    updater.job_queue.run_repeating(
+        job(flush_user_stat_rollups), first=UserStatRollup.flush_interval,
+        interval=UserStatRollup.flush_interval
+    )
+
+
+def run_overdue(bot, daily_jobs: List[Tuple[str, Callable, time, tuple]]) -> None:
+    """
+    Запускает ежедневные задачи, которые не выполнились в свое время. Задачу, о запусках
+    которой ничего не известно (первый запуск кластера), не запускаем, а только запоминаем.
+    """
+    now = datetime.now(timezone.utc)
+    for name, callback, at, days in daily_jobs:
+        last_run = LeaderLease.get_last_run(name)
+        if last_run is None:
+            LeaderLease.set_last_run(name)
+            continue
+        due = get_last_due(at, days, now)
+        if last_run < due.timestamp() and now - due < CATCH_UP_WITHIN:
+            logger.warning(f'[jobs] {name} was missed at {due}, running it now')
+            callback(bot, None)
@@ -0,0 +1,242 @@
+"""
+Кластер: фронт и несколько воркеров, между которыми поделены чаты. Работает только с вебхуками.
+
+Один процесс бота упирается в GIL: регулярки, хэши картинок и пиклы всех чатов идут на одном
+ядре. В кластере фронт принимает вебхук телеграма, выбирает воркер по чату
+(`chat_id % workers`) и пересылает ему апдейт как есть. Воркер — отдельный процесс с обычным
+диспетчером (`create_updater`), который слушает вебхук на своем локальном порту.
+
+Порядок апдейтов одного чата сохраняется: телеграм шлет апдейты по одному
+(`max_connections=1`), а у каждого воркера во фронте своя очередь и один поток, который
+пересылает апдейты строго по очереди и ждет ответа воркера.
+
+Задачи из `add_jobs` регистрируются на каждом воркере, но выполняются только на лидере
+(`src/utils/leader_lease.py`).
+
+Общий лимит телеграма на отправку делится между воркерами поровну: у каждого своя очередь
+`dsp` с долей `1 / workers`. Это проще, чем общее ведро в редисе, и не добавляет запрос к
+редису на каждое сообщение. Лимиты чатов не делятся: чат обслуживает один воркер. Исключение —
+задачи лидера, которые пишут во все чаты; если они столкнутся с воркером чата, телеграм ответит
+RetryAfter, и очередь подождет. Упавший воркер фронт перезапускает, а его апдейты пока копятся
+в очереди. Воркеры делят между собой редис, поэтому кэш в памяти процесса в кластере нельзя.
+
+Настройки — в разделе `cluster` конфига.
+"""
+import json
+import multiprocessing
+import os
+import signal
+import ssl
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from queue import Queue
+from typing import List
+
+import requests
+import telegram
+from telegram.utils.request import Request
+
+import src.utils.cache as cache_file
+from src.bot_start.add_jobs import add_jobs
+from src.bot_start.start import create_updater, get_request_data, set_default_logging_format
+from src.config import CONFIG
+from src.utils.cache import cache, YEAR
+from src.utils.leader_lease import LeaderLease
+from src.utils.logger_helpers import get_logger
+from src.utils.telegram_helpers import dsp
+from src.web.server import start_server
+
+logger = get_logger(__name__)
+
+WEBHOOK_PORT = 8443
+
+
+def get_chat_id(update: dict) -> int:
+    """
+    Чат апдейта, а если чата нет (инлайн-запросы, опросы) — пользователь.
+    """
+    for key, value in update.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        message = value if 'chat' in value else value.get('message')
+        if isinstance(message, dict) and 'chat' in message:
+            return message['chat']['id']
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+    return 0
+
+
+def get_worker_index(update: dict, workers: int) -> int:
+    return get_chat_id(update) % workers
+
+
+class Forwarder:
+    """
+    Пересылает апдейты одному воркеру строго по очереди.
+    """
+
+    def __init__(self, url: str, retry_interval: float = 1.) -> None:
+        self.url = url
+        self.retry_interval = retry_interval
+        self.queue: Queue = Queue()
+        self.session = requests.Session()
+        threading.Thread(target=self.__run, name=f'Forwarder {url}', daemon=True).start()
+
+    def put(self, body: bytes) -> None:
+        self.queue.put(body)
+
+    def __run(self) -> None:
+        while True:
+            body = self.queue.get()
+            # пока воркер перезапускается, ждем его: если пропустить апдейт, нарушится порядок
+            while not self.__send(body):
+                time.sleep(self.retry_interval)
+            self.queue.task_done()
+
+    def __send(self, body: bytes) -> bool:
+        try:
+            response = self.session.post(self.url, data=body, timeout=10,
+                                         headers={'Content-Type': 'application/json'})
+        except requests.RequestException as e:
+            logger.warning(f'[cluster] {self.url}: {e}')
+            return False
+        if response.status_code >= 500:
+            logger.warning(f'[cluster] {self.url}: {response.status_code}')
+            return False
+        if response.status_code != 200:
+            # повторять бесполезно: воркер не принял сам апдейт
+            logger.error(f'[cluster] {self.url} rejected an update: {response.status_code}')
+        return True
+
+
+class FrontRequestHandler(BaseHTTPRequestHandler):
+    server: 'FrontServer'
+
+    def do_POST(self) -> None:
+        if self.path != self.server.url_path:
+            self.send_error(403)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            update = json.loads(body)
+        except ValueError:
+            self.send_error(400)
+            return
+        forwarders = self.server.forwarders
+        forwarders[get_worker_index(update, len(forwarders))].put(body)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class FrontServer(HTTPServer):
+    """
+    Однопоточный, чтобы апдейты уходили в очереди воркеров в том порядке, в котором пришли.
+    """
+
+    def __init__(self, address: tuple, url_path: str, forwarders: List[Forwarder]) -> None:
+        super().__init__(address, FrontRequestHandler)
+        self.url_path = url_path
+        self.forwarders = forwarders
+
+
+def run_worker(index: int, workers: int, port: int, lease_ttl: float) -> None:
+    """
+    Точка входа процесса-воркера.
+    """
+    set_default_logging_format()
+    dsp.share_global_limit(workers)
+    updater = create_updater()
+    # без сертификата апдейтер не трогает вебхук в телеграме, только слушает порт
+    updater.start_webhook(listen='127.0.0.1', port=port, url_path=CONFIG['bot_token'])
+    lease = LeaderLease('jobs', owner=f'worker-{index}:{os.getpid()}', ttl=lease_ttl)
+    # задачи до аренды: получив ее, воркер сразу запускает пропущенные
+    add_jobs(updater, lease)
+    lease.start()
+    cache_file._bot_id = updater.bot.id
+    start_server(updater.dispatcher, '5010', offset=index + 1)
+    logger.info(f'[cluster] worker {index} started on port {port}')
+    updater.idle()
+    lease.stop()
+
+
+class Cluster:
+    def __init__(self, workers: int, base_port: int, lease_ttl: float) -> None:
+        self.workers = workers
+        self.base_port = base_port
+        self.lease_ttl = lease_ttl
+        # spawn, а не fork: в родителе уже есть потоки и соединения с редисом и бд
+        self.context = multiprocessing.get_context('spawn')
+        self.processes: List[multiprocessing.Process] = []
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        self.processes = [self.__start_worker(index) for index in range(self.workers)]
+
+    def supervise(self, interval: float = 5.) -> None:
+        while not self._stop.wait(interval):
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error(f'[cluster] worker {index} exited with {process.exitcode}, '
+                                 f'restarting')
+                    self.processes[index] = self.__start_worker(index)
+
+    def request_stop(self) -> None:
+        self._stop.set()
+
+    def stop(self) -> None:
+        self._stop.set()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def __start_worker(self, index: int) -> multiprocessing.Process:
+        process = self.context.Process(target=run_worker,
+                                       args=(index, self.workers, self.base_port + index,
+                                             self.lease_ttl),
+                                       name=f'bot-worker-{index}')
+        process.start()
+        return process
+
+
+def start_cluster() -> None:
+    config = CONFIG.get('cluster', {})
+    if 'webhook_domain' not in CONFIG:
+        raise ValueError('cluster works only with webhooks: set webhook_domain')
+    if CONFIG.get('cache', {}).get('backend', 'redis') != 'redis':
+        raise ValueError('cluster needs the redis cache backend')
+    workers = config['workers']
+    base_port = config.get('base_port', 8500)
+    domain = CONFIG['webhook_domain']
+    token = CONFIG['bot_token']
+
+    forwarders = [Forwarder(f'http://127.0.0.1:{base_port + index}/{token}')
+                  for index in range(workers)]
+    server = FrontServer(('0.0.0.0', WEBHOOK_PORT), f'/{token}', forwarders)
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain('cert.pem', 'private.key')
+    server.socket = ssl_context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, name='ClusterFront', daemon=True).start()
+
+    bot = telegram.Bot(token, request=Request(**get_request_data()))
+    with open('cert.pem', 'rb') as cert:
+        bot.set_webhook(url=f'https://{domain}:{WEBHOOK_PORT}/{token}', certificate=cert,
+                        max_connections=1)
+
+    cluster = Cluster(workers, base_port, config.get('lease_ttl', 60))
+    cluster.start()
+    logger.info(f'Bot started: cluster of {workers} workers')
+    cache.set('bot_startup_time', datetime.now(), time=YEAR)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: cluster.request_stop())
+    cluster.supervise()
+    server.shutdown()
+    cluster.stop()
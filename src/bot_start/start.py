@@ -12,6 +12,7 @@ from src.bot_start.add_handlers import add_chat_handlers, add_private_handlers,
 from src.bot_start.add_jobs import add_jobs
 from src.config import CONFIG
 from src.utils.cache import cache, YEAR
+from src.utils.handlers_decorators import instrument_handlers
 from src.utils.repair import repair_bot
 from src.web.server import start_server
 
@@ -55,22 +56,35 @@ def prepare():
     Подготовительный этап
     """
     set_default_logging_format()
+    if 'database' in CONFIG:
+        from src.utils.db import engine
+        from src.utils.migrations import migrate
+        migrate(engine)
     cache.set('pipinder:fav_stickersets_names',
               set(CONFIG.get("sasha_rebinder_stickersets_names", [])), time=YEAR)
 
 
-def start_bot():
+def create_updater() -> Updater:
     """
-    Инициализация бота
+    Апдейтер со всеми обработчиками, но еще не запущенный
     """
     updater = Updater(token=CONFIG['bot_token'], workers=32, request_kwargs=get_request_data(), use_context=False)
-    bot = updater.bot
     dp = updater.dispatcher
     dp.logger.addHandler(CriticalHandler())  # в логгер библиотеки добавляем свой обработчик
     add_chat_handlers(dp)
     add_private_handlers(dp)
     add_other_handlers(dp)
+    instrument_handlers(dp)
     dp.add_error_handler(error)
+    return updater
+
+
+def start_bot():
+    """
+    Инициализация бота
+    """
+    updater = create_updater()
+    bot = updater.bot
 
     logger.info('Bot started')
     cache.set('bot_startup_time', datetime.now(), time=YEAR)
@@ -114,9 +128,13 @@ def get_request_data():
 
 def start():
     prepare()
+    if CONFIG.get('cluster', {}).get('workers', 1) > 1:
+        from src.bot_start.cluster import start_cluster
+        start_cluster()
+        return
     try:
         updater = start_bot()
-        start_server(updater.bot, '5010')
+        start_server(updater.dispatcher, '5010')
         updater.idle()
     except DelayQueueError as e:
         if str(e) == 'Could not process callback in stopped thread':
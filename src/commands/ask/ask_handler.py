@@ -1,19 +1,19 @@
 import telegram
-from telegram.ext import run_async
 
 from src.commands.khaleesi.khaleesi_handler import check_base_khaleesi
 from src.commands.ask.ask import Ask
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
+from src.utils.lanes import interactive_lane
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
 def chat(bot: telegram.Bot, update: telegram.Update) -> None:
     send_ask(bot, update.message, private=False)
 
-@run_async
+@interactive_lane
 def private(bot: telegram.Bot, update: telegram.Update) -> None:  # pragma: no cover
     message = update.edited_message if update.edited_message else update.message
     send_ask(bot, message, private=True)
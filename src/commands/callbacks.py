@@ -1,5 +1,4 @@
 import telegram
-from telegram.ext import run_async
 
 from src.modules.last_word import callback_last_word
 from src.commands.on_off import callback_off
@@ -8,17 +7,18 @@ from src.dayof.day_manager import DayOfManager
 from src.modules.antimat.matshowtime import MatshowtimeHandlers
 from src.commands.spoiler import SpoilerHandlers
 from src.commands.i_stat.command_handlers import callback_handler as istat_callback_handler
-from src.utils.cache import cache
+from src.utils.callback_helpers import get_callback_data_by_key
+from src.utils.lanes import interactive_lane
 from src.utils.logger_helpers import get_logger
 from src.utils.send_video_helpers import send_video_callback_handler
 
 logger = get_logger(__name__)
 
 
-@run_async
+@interactive_lane
 def callback_handler(bot: telegram.Bot, update: telegram.Update) -> None:
     query = update.callback_query
-    data = cache.get(f'callback:{query.data}')
+    data = get_callback_data_by_key(query.data)
     if not data:
         return
     if data['name'] == '/off':
@@ -1,14 +1,14 @@
 import random
 
 import telegram
-from telegram.ext import run_async
 
 from src.utils.cache import pure_cache, TWO_DAYS
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
+from src.utils.lanes import interactive_lane
 from src.utils.time_helpers import today_str
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
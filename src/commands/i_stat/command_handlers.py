@@ -2,7 +2,6 @@ from typing import Optional
 
 import telegram
 from telegram import ParseMode
-from telegram.ext import run_async
 
 from src.commands.i_stat.banhammer import banhammer, BanStatus
 from src.commands.i_stat.db import RedisChatStatistician
@@ -11,13 +10,14 @@ from src.models.user_stat import UserStat
 from src.utils.callback_helpers import get_callback_data
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
 from src.utils.handlers_helpers import check_admin
+from src.utils.lanes import interactive_lane
 
 CACHE_PREFIX = 'i_stat'
 MODULE_NAME = CACHE_PREFIX
 callback_show = 'istat_show_click'
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -37,7 +37,7 @@ def send_personal_stat_handler(bot: telegram.Bot, update: telegram.Update) -> No
     send_personal_stat(bot, message.chat_id, user_id, reply_to_message_id=message.message_id)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -52,7 +52,7 @@ def send_all_stat_handler(bot: telegram.Bot, update: telegram.Update) -> None:
     bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
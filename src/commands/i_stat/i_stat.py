@@ -7,6 +7,7 @@ import telegram
 
 from src.models.user import User
 from src.models.user_stat import UserStat as ModelUserStat
+from src.utils.misc import SlotsState
 
 re_personal_pronouns = re.compile(r"\b(я|меня|мне|мной|мною)\b", re.IGNORECASE)
 
@@ -168,7 +169,9 @@ class ChatStat(object):
         self.users[user_id] = user
 
 
-class UserStat(object):
+class UserStat(SlotsState):
+    __slots__ = ('all_count', 'counts', 'messages_count')
+
     def __init__(self):
         self.all_count = 0
         self.counts: Dict[str, int] = dict()
@@ -180,8 +183,6 @@ class UserStat(object):
         self.all_count += count
 
     def add_message(self) -> None:
-        if not hasattr(self, 'messages_count'):
-            self.messages_count = 0
         self.messages_count += 1
 
     def remove(self, word: str, count: int) -> None:
@@ -1,20 +1,20 @@
 from typing import Tuple, Optional
 
 import telegram
-from telegram.ext import run_async
 
 from src.commands.khaleesi.khaleesi import Khaleesi
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
+from src.utils.lanes import interactive_lane
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
 def chat(bot: telegram.Bot, update: telegram.Update) -> None:  # pragma: no cover
     send_khaleesi(bot, update.message, limit_chars=1000)
 
-@run_async
+@interactive_lane
 def private(bot: telegram.Bot, update: telegram.Update) -> None:  # pragma: no cover
     message = update.edited_message if update.edited_message else update.message
     send_khaleesi(bot, message)
@@ -7,6 +7,7 @@ import telegram
 from src.commands.khaleesi.khaleesi import Khaleesi
 from src.models.chat_user import ChatUser
 from src.models.user import User
+from src.models.user_stat import UserStat
 from src.modules.night_watch import get_hour
 from src.utils.cache import Cache
 from src.utils.misc import weighted_choice
@@ -103,7 +104,7 @@ def get_random_user(chat_id: int, user_cls: Type[User], chat_user_cls: Type[Chat
     text = 'Даю голову на отсечение, я не мент!'
     if random.randint(1, 100) <= 20:
         return text
-    chat_user = chat_user_cls.get_random(chat_id)
+    chat_user = chat_user_cls.get_random(chat_id, UserStat.get_activity_weights(chat_id))
     if chat_user is None:
         return text
     user = user_cls.get(chat_user.uid)
@@ -16,7 +16,7 @@ from src.utils.cache import cache, YEAR
 from src.utils.handlers_helpers import check_admin
 from src.utils.logger_helpers import get_logger
 from src.utils.misc import chunks
-from src.utils.telegram_helpers import dsp
+from src.utils.telegram_helpers import dsp, Priority
 from src.utils.telegram_helpers import telegram_retry
 
 logger = get_logger(__name__)
@@ -120,7 +120,7 @@ def format_users(chat_id: int, uids: Iterable[int]) -> List[str]:
     Возвращает подготовленный список юзернеймов для указанных uids. Там особые условия.
     """
     users = []
-    chat_uids: Set[int] = {chat_user.uid for chat_user in ChatUser.get_all(chat_id)}
+    chat_uids: Set[int] = ChatUser.get_all_uids(chat_id)
     for uid in uids:
         user = User.get(uid)
         # если юзера нет в базе, то добавляем его uid, чтобы хотя бы так можно было удалить
@@ -145,7 +145,7 @@ def format_chat_users(chat_id: int, uids: Iterable[int]) -> List[str]:
     Возвращает юзернеймы (с тегами) тех uids, что есть в чате.
     """
     users = []
-    chat_uids: Set[int] = {chat_user.uid for chat_user in ChatUser.get_all(chat_id)}
+    chat_uids: Set[int] = ChatUser.get_all_uids(chat_id)
     for uid in uids:
         user = User.get(uid)
         if user is None:
@@ -189,7 +189,8 @@ def send_list_replay(bot: telegram.Bot, chat_id: int, message_id: int, uids: Ite
             first_message_id = first_msg.message_id
             continue
         # в последющих сообщениях тегаем первое
-        dsp(send_replay, bot, chat_id, first_message_id, joined)
+        dsp.put(send_replay, (bot, chat_id, first_message_id, joined), chat_id=chat_id,
+                priority=Priority.INTERACTIVE)
 
 
 @telegram_retry(logger=logger, silence=False, default=None, title='send_replay')
@@ -2,7 +2,6 @@ import typing
 
 import telegram
 from telegram import ParseMode, ChatAction
-from telegram.ext import run_async
 
 from src.config import CONFIG
 from src.models.reply_top import ReplyTop, ReplyLove
@@ -10,12 +9,13 @@ from src.models.user import User
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard, \
     only_users_from_main_chat
 from src.utils.handlers_helpers import check_admin
+from src.utils.lanes import interactive_lane
 from src.utils.logger_helpers import get_logger
 
 logger = get_logger(__name__)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -77,7 +77,7 @@ def send_mylove(bot: telegram.Bot, update: telegram.Update, send_to_cid: int,
                      reply_to_message_id=update.message.message_id, parse_mode=ParseMode.HTML)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
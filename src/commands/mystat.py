@@ -1,12 +1,12 @@
 import telegram
 from telegram import ParseMode, ChatAction
-from telegram.ext import run_async
 
 from src.config import CONFIG
 from src.models.user import User
 from src.models.user_stat import UserStat
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard, \
     only_users_from_main_chat
+from src.utils.lanes import interactive_lane
 from src.utils.logger_helpers import get_logger
 
 logger = get_logger(__name__)
@@ -45,7 +45,7 @@ def send_whois(bot: telegram.Bot, update: telegram.Update, send_to_cid: int,
     logger.info(f'User {requestor_id} requested stats for user {user_id}')
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -54,7 +54,7 @@ def whois(bot: telegram.Bot, update: telegram.Update) -> None:
     send_whois(bot, update, send_to_cid=chat_id, find_in_cid=chat_id)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @command_guard
 def mystat(bot, update):
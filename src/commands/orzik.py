@@ -4,11 +4,11 @@ from collections import deque
 from datetime import datetime
 
 import telegram
-from telegram.ext import run_async
 
 from src.config import CONFIG
 from src.utils.cache import cache
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
+from src.utils.lanes import interactive_lane
 
 MONTH = 30 * 24 * 60 * 60  # 30 дней
 
@@ -66,7 +66,7 @@ def get_base_name(key: str) -> str:
     return name
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -81,7 +81,7 @@ def orzik(bot: telegram.Bot, update: telegram.Update) -> None:
     bot.send_message(chat_id, f"Сегодня ты: {name}")
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -94,7 +94,7 @@ def lord(bot: telegram.Bot, update: telegram.Update) -> None:
     bot.send_message(chat_id, f"Сегодня ты: {name}")
 
 
-@run_async
+@interactive_lane
 def orzik_correction(bot: telegram.Bot, update: telegram.Update) -> None:
     """
     Реакция на упоминание орзика
@@ -5,26 +5,26 @@ from typing import List
 
 import telegram
 from telegram import ParseMode, ChatAction, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import run_async
 
 from src.config import CHATRULES, CMDS, CONFIG
 from src.commands.khaleesi.khaleesi_handler import check_base_khaleesi
-from src.modules.last_word import get_last_word_cache_key
+from src.modules.last_word import get_last_word
 from src.modules.message_reactions import send_gdeleha, send_pidor
 from src.models.leave_collector import LeaveCollector
 from src.models.user import User
 from src.commands.huificator import huificator
-from src.utils.cache import cache, bot_id
+from src.utils.cache import bot_id
 from src.utils.callback_helpers import get_callback_data
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
 from src.utils.handlers_helpers import is_command_enabled_for_chat, \
     check_admin
+from src.utils.lanes import interactive_lane
 from src.utils.logger_helpers import get_logger
 
 logger = get_logger(__name__)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -48,7 +48,7 @@ def send_huificator(bot: telegram.Bot, message: telegram.Message, limit_chars: i
     bot.send_message(chat_id, new_msg, reply_to_message_id=reply_to_message_id)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -59,7 +59,7 @@ def expert(bot, update):
     chat_id = update.message.chat_id
     rand_num = random.randrange(1, 10)
     name = User.get(expert_uid).username
-    last_msg_id, _ = cache.get(get_last_word_cache_key(chat_id, expert_uid))
+    last_msg_id, _ = get_last_word(chat_id, expert_uid)
     expert_phrases = [
         'иди сюда!',
         'Срочно нужен эксперт!',
@@ -76,7 +76,7 @@ def expert(bot, update):
                             reply_to_message_id=last_msg_id)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -92,7 +92,7 @@ def papa(bot, update):
     chat_id = update.message.chat_id
     bot.sendMessage(chat_id, random.choice(phrases))
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -104,7 +104,7 @@ def kick(bot: telegram.Bot, update: telegram.Update) -> None:
     bot.send_message(chat_id, text, reply_to_message_id=message.message_id)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -117,7 +117,7 @@ def changelog(bot: telegram.Bot, update):
                      disable_web_page_preview=True)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -135,7 +135,7 @@ def love(bot, update):
     bot.sendSticker(chat_id, random.choice(stickers))
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -144,7 +144,7 @@ def rules(bot, update):
     bot.sendMessage(chat_id, CHATRULES, parse_mode=ParseMode.HTML)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -159,7 +159,7 @@ def anketa(bot, update):
         bot.sendMessage(chat_id, content)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -176,7 +176,7 @@ def putin(bot: telegram.Bot, update: telegram.Update) -> None:
                     reply_to_message_id=update.message.reply_to_message.message_id)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -200,7 +200,7 @@ def pomogite(bot, update):
     bot.sendMessage(chat_id, msg)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -236,7 +236,7 @@ def leave(bot, update):
     bot.sendMessage(chat_id, result, parse_mode='HTML', reply_markup=reply_markup)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -301,7 +301,7 @@ def pipixel_handler(bot: telegram.Bot, update: telegram.Update) -> None:
     bot.send_message(chat_id, new_msg, reply_to_message_id=reply_to_message_id)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -7,7 +7,6 @@ from typing import Callable
 import requests
 import telegram
 from telegram import ParseMode
-from telegram.ext import run_async
 
 from src.commands.other import send_huificator
 from src.config import CONFIG, get_config_chats
@@ -22,6 +21,7 @@ from src.modules.tiktok import process_message_for_tiktok
 from src.modules.twitter import process_message_for_twitter
 from src.utils.cache import cache, TWO_DAYS
 from src.utils.handlers_decorators import only_users_from_main_chat
+from src.utils.lanes import interactive_lane, heavy_io_lane
 from src.utils.logger_helpers import get_logger
 from src.utils.misc import weighted_choice
 from src.utils.telegram_helpers import dsp, telegram_retry, send_long
@@ -45,8 +45,9 @@ def users_clear_cache(bot: telegram.Bot, update: telegram.Update) -> None:
     """
     uid = update.message.chat_id
     logger.info(f'id {uid} /users_clear_cache')
-    User.clear_cache()
-    bot.send_message(uid, '<b>User</b> кеш очищен', parse_mode=telegram.ParseMode.HTML)
+    deleted = User.clear_cache()
+    bot.send_message(uid, f'<b>User</b> кеш очищен ({deleted} ключей)',
+                     parse_mode=telegram.ParseMode.HTML)
 
 
 def run_weekly_stats(bot: telegram.Bot, update: telegram.Update) -> None:
@@ -60,6 +61,9 @@ def run_weekly_stats(bot: telegram.Bot, update: telegram.Update) -> None:
 
 
 def year(bot: telegram.Bot, update: telegram.Update) -> None:
+    """
+    Топ чата за год или за месяц: `/year`, `/year 2017`, `/year 2017 5`.
+    """
     uid = update.message.chat_id
     logger.info(f'id {uid} /year')
     if uid != CONFIG.get('debug_uid', None):
@@ -67,13 +71,25 @@ def year(bot: telegram.Bot, update: telegram.Update) -> None:
 
     from src.models.user_stat import UserStat
 
+    args = update.message.text.split()[1:]
+    now = datetime.now()
+    try:
+        year = int(args[0]) if len(args) > 0 else now.year
+        month = int(args[1]) if len(args) > 1 else None
+    except ValueError:
+        bot.send_message(uid, 'Формат: /year [год] [месяц]')
+        return
+
     bot.send_chat_action(uid, telegram.chataction.ChatAction.TYPING)
     cid = CONFIG.get('anon_chat_id')
-    # cid = -48952907
-    year = 2017
-    info = UserStat.get_chat_year(cid, year)
-
-    msg = f'<b>Rapture {year}</b>\n' \
+    if month is None:
+        title = f'Rapture {year}'
+        info = UserStat.get_chat_year(cid, year)
+    else:
+        title = f'Rapture {month:02d}.{year}'
+        info = UserStat.get_chat_month(cid, year, month)
+
+    msg = f'<b>{title}</b>\n' \
           f'Нас: {info["users_count"]}\n' \
           f'Сообщений: {info["msg_count"]}\n'
     msg += '\n'
@@ -81,6 +97,28 @@ def year(bot: telegram.Bot, update: telegram.Update) -> None:
     send_long(bot, CONFIG.get('anon_chat_id'), msg)
 
 
+@heavy_io_lane
+def rollups_backfill(bot: telegram.Bot, update: telegram.Update) -> None:
+    """
+    Пересобирает помесячную и годовую стату из недельной.
+    """
+    uid = update.message.chat_id
+    logger.info(f'id {uid} /rollups_backfill')
+    if uid != CONFIG.get('debug_uid', None):
+        return
+
+    from src.models.user_stat import UserStatRollup
+
+    bot.send_message(uid, 'Пересобираю помесячную и годовую стату...')
+    try:
+        rows_count = UserStatRollup.backfill()
+    except Exception as e:
+        logger.error(e)
+        bot.send_message(uid, f'Не получилось: {repr(e)}')
+        return
+    bot.send_message(uid, f'Готово, обработано недельных записей: {rows_count}')
+
+
 def send_to_all_chats_handler(bot: telegram.Bot, update: telegram.Update) -> None:
     uid = update.message.chat_id
     logger.info(f'id {uid} /send_to_all_chats')
@@ -92,7 +130,7 @@ def send_to_all_chats_handler(bot: telegram.Bot, update: telegram.Update) -> Non
 """.strip()
     # send_to_all_chats(bot, 'all', lambda _: text)
 
-@run_async
+@interactive_lane
 def huyamda(bot: telegram.Bot, update: telegram.Update) -> None:
     message = update.edited_message if update.edited_message else update.message
     send_huificator(bot, message)
@@ -115,7 +153,7 @@ def rand(bot: telegram.Bot, update):
     return bot.send_message(message.chat_id, str(num))
 
 
-@run_async
+@interactive_lane
 def lovedump(_: telegram.Bot, update: telegram.Update) -> None:
     message = update.message
     try:
@@ -146,7 +184,7 @@ def anon(bot: telegram.Bot, update: telegram.Update) -> None:
     bot.send_message(cid, text, disable_web_page_preview=True)
 
 
-@run_async
+@interactive_lane
 def private(bot: telegram.Bot, update: telegram.Update):
     """
     Текст в личку бота.
@@ -157,10 +195,7 @@ def private(bot: telegram.Bot, update: telegram.Update):
             return True
         if uid in CONFIG.get('admins_ids', []) or uid in CONFIG.get('private_ids', []):
             return True
-        chat_user = ChatUser.get(uid, CONFIG.get('anon_chat_id', 0))
-        if not chat_user or chat_user.left:
-            return False
-        return True
+        return ChatUser.is_member(uid, CONFIG.get('anon_chat_id', 0))
     message = update.effective_message
     if not _check_user(message):
         message.reply_text('Только для участников чата Rapture')
@@ -182,7 +217,7 @@ def private(bot: telegram.Bot, update: telegram.Update):
         return
 
 
-@run_async
+@interactive_lane
 def help(bot: telegram.Bot, update: telegram.Update):
     DayOfManager.private_help_handler(bot, update)
     # remove keyboard
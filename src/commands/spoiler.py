@@ -4,13 +4,13 @@ from random import randint
 from typing import List, Tuple, Optional
 
 import telegram
-from telegram.ext import run_async
 
 from src.config import CONFIG
 from src.models.chat_user import ChatUser
 from src.models.user import User
 from src.utils.cache import cache
 from src.utils.callback_helpers import get_callback_data
+from src.utils.lanes import interactive_lane
 from src.utils.logger_helpers import get_logger
 from src.utils.mwt import MWT
 from src.utils.telegram_helpers import telegram_retry
@@ -260,7 +260,7 @@ class SpoilerHandlers:
 
     @classmethod
     @Guard.deco_handler_guard
-    @run_async
+    @interactive_lane
     def private_handler(cls, bot: telegram.Bot, update: telegram.Update) -> None:
         SpoilerCreator.text_handler(bot, update)
 
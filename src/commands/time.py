@@ -2,14 +2,14 @@ import typing
 
 import arrow
 import telegram
-from telegram.ext import run_async
 
 from src.config import CONFIG, CMDS
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
 from src.utils.handlers_helpers import CommandConfig
+from src.utils.lanes import interactive_lane
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -2,16 +2,16 @@ import json
 import os
 from multiprocessing.dummy import Pool as ThreadPool
 from threading import Lock
-from typing import Union, Optional
+from typing import Union, Optional, Iterable, List, Dict
 
 import arrow
 import requests
 import telegram
-from telegram.ext import run_async
 
 from src.config import CONFIG
 from src.utils.cache import cache
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
+from src.utils.lanes import heavy_io_lane, interactive_lane
 from src.utils.logger_helpers import get_logger
 from src.utils.telegram_helpers import dsp
 
@@ -20,7 +20,7 @@ full_moon_lock = Lock()
 logger = get_logger(__name__)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -68,12 +68,12 @@ def send_weather_now(bot: telegram.Bot, update: telegram.Update) -> None:
                      disable_web_page_preview=True)
 
 
-@run_async
+@heavy_io_lane
 def send_alert_if_full_moon(bot: telegram.Bot, chat_id: int) -> None:
     """
     Сегодня полнолуние? Оповещает чат.
     """
-    # т.к. используется run_async, то мы можем одновременно вызвать этот метод.
+    # т.к. метод выполняется в полосе heavy_io, то его могут вызвать одновременно.
     # но мы не хотим делать несколько одинаковых запросов к апи.
     # поэтому используем блокировку и сохраняем результат запроса в редис.
     logger.debug(f'full_moon_lock')
@@ -193,31 +193,81 @@ def parse_jsons(jsons):
 
 
 def make_requests(chat_id, weather_cities, debug=False):
-    def make_request(city, debug=False):
-        city_name, city_code, timezone, wu_city_code = city
-        if debug:
-            val = FileUtils.load_json(city_code)
-        else:
-            response = request(city_code)
-            val = response['error_msg'] if response['error'] else response['json']
-        return city_name, timezone, val
-
     if debug:
-        return [make_request(city, debug=True) for city in weather_cities]
+        return [(city_name, timezone, FileUtils.load_json(city_code))
+                for city_name, city_code, timezone, _ in weather_cities]
+
+    vals = CityWeatherCache.fetch([city_code for _, city_code, _, _ in weather_cities])
+    return [(city_name, timezone, vals[city_code])
+            for city_name, city_code, timezone, _ in weather_cities]
 
-    cached_key = f'weather:{chat_id}:requests'
-    cached = cache.get(cached_key)
-    if cached:
-        return cached
 
+class CityWeatherCache:
+    """
+    Кэш сырых ответов апи по городам. Общий для всех чатов: если два чата показывают Москву,
+    то в апи пойдет только один запрос.
+    """
+    key_prefix = 'weather:city'
+    ttl = 30 * 60  # хранится в кэше 30 минут
     num_of_workers = 3
-    pool = ThreadPool(num_of_workers)
-    results = pool.map(make_request, weather_cities)
-    pool.close()
-    pool.join()
 
-    cache.set(cached_key, results, 30 * 60)  # хранится в кэше 30 минут
-    return results
+    @classmethod
+    def fetch(cls, city_codes: Iterable[str]) -> Dict[str, Union[dict, str]]:
+        """
+        Возвращает json для каждого города (или текст ошибки).
+        В апи запрашиваются только те города, которых нет в кэше, каждый по одному разу.
+        """
+        result = {}
+        missing = []
+        for city_code in set(city_codes):
+            cached = cache.get(cls.__get_key(city_code))
+            if cached is None:
+                missing.append(city_code)
+                continue
+            result[city_code] = cached
+        if not missing:
+            return result
+
+        pool = ThreadPool(min(cls.num_of_workers, len(missing)))
+        responses = pool.map(request, missing)
+        pool.close()
+        pool.join()
+
+        for city_code, response in zip(missing, responses):
+            if response is None:
+                result[city_code] = 'не указан апи ключ'
+                continue
+            # ошибки не кэшируем, пусть в следующий раз попробует еще раз
+            if response['error']:
+                result[city_code] = response['error_msg']
+                continue
+            cache.set(cls.__get_key(city_code), response['json'], cls.ttl)
+            result[city_code] = response['json']
+        return result
+
+    @classmethod
+    def __get_key(cls, city_code: str) -> str:
+        return f'{cls.key_prefix}:{city_code}'
+
+
+def get_all_config_city_codes() -> List[str]:
+    """
+    Координаты всех городов из конфига всех чатов, без повторов.
+    """
+    city_codes = set()
+    for weather_cities in CONFIG.get('weather_cities', {}).values():
+        for _, city_code, _, _ in weather_cities:
+            city_codes.add(city_code)
+    return list(city_codes)
+
+
+def warm_weather_cache(bot: telegram.Bot, _) -> None:
+    """
+    Заранее (перед часами пик) заполняет кэш погоды для всех городов из конфига.
+    """
+    if CONFIG.get('weather_debug') or not CONFIG.get('weather_yandex_api_key'):
+        return
+    CityWeatherCache.fetch(get_all_config_city_codes())
 
 
 def request(city_code: str):
@@ -3,7 +3,6 @@ from datetime import datetime
 from typing import List, Set
 
 import telegram
-from telegram.ext import run_async
 
 from src.dayof.helper import set_today_special
 from src.models.chat_user import ChatUser
@@ -12,6 +11,7 @@ from src.dayof.day_8.model import random_gift_text
 from src.dayof.valentine_day.helpers.helpers import send_to_all_chats
 from src.utils.cache import cache, FEW_DAYS
 from src.utils.handlers_decorators import command_guard, collect_stats, chat_guard
+from src.utils.lanes import interactive_lane
 
 LIMIT = 4
 LIMIT_TEXT = f'{LIMIT} раза'
@@ -48,7 +48,7 @@ def send_limit(bot: telegram.Bot, chat_id: int) -> None:
     bot.send_message(chat_id, f'/8 вызывается только {LIMIT_TEXT}')
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
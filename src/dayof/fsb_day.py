@@ -8,14 +8,15 @@ from functools import wraps
 
 import telegram
 from pytils.numeral import get_plural
-from telegram.ext import run_async
 
 from src.config import CONFIG
 from src.dayof.helper import set_today_special
 from src.models.chat_user import ChatUser
 from src.models.user import User
+from src.models.user_stat import UserStat
 from src.utils.cache import cache, USER_CACHE_EXPIRE
 from src.utils.callback_helpers import get_callback_data
+from src.utils.lanes import interactive_lane
 from src.utils.logger_helpers import get_logger
 from src.utils.text_helpers import lstrip_every_line
 
@@ -71,7 +72,7 @@ class FSBDayGuard:
         return datetime.now().hour == 13
 
     @staticmethod
-    @run_async
+    @interactive_lane
     def __send_dinner(bot: telegram.Bot, uid) -> None:
         user = User.get(uid)
         who = 'Женщина' if user.female else 'Мужчина'
@@ -579,7 +580,7 @@ class FSBDay:
 
 class FSBDayAnekdot:
     @classmethod
-    @run_async
+    @interactive_lane
     def send_anekdot(cls, bot, uid) -> None:
         if 'anecdotica_url' not in CONFIG:
             return
@@ -933,7 +934,9 @@ class FSBDayCase:
             header = f'<b>Дело № {case_num.num}.</b> <i>"{case_num.title}"</i>'
         else:
             header = f'<b>Дело № {case_num.num}</b>'
-        random_user = User.get(ChatUser.get_random(CONFIG['anon_chat_id']))
+        anon_chat_id = CONFIG['anon_chat_id']
+        random_user = User.get(ChatUser.get_random(anon_chat_id,
+                                                   UserStat.get_activity_weights(anon_chat_id)))
         user = User.get(self.uid)
         masked_sign = self.__mask_signature(random_user if random.randint(0, 100) < 70 else user)
         signature = f'Подписано  {masked_sign}' if random_user else ''
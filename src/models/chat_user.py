@@ -1,19 +1,30 @@
+import heapq
+import random
 import typing
 from threading import Lock
 
-from sqlalchemy import Column, Integer, BigInteger, Boolean, func
+from sqlalchemy import Column, Integer, BigInteger, Boolean, Index, select
 
 from src.config import CONFIG
 from src.utils.cache import USER_CACHE_EXPIRE, bot_id
-from src.utils.cache import cache
-from src.utils.db import Base, add_to_db, retry, session_scope
+from src.utils.cache import pure_cache, TouchThrottle
+from src.utils.cache_buckets import BucketedCache
+from src.utils.db import Base, retry, session_scope, upsert, fetch_all, fetch_first
 from src.utils.logger_helpers import get_logger
+from src.utils.misc import SlotsState
 
 logger = get_logger(__name__)
+# чатюзеры лежат в хэше своего чата: поле — uid
+chatuser_cache = BucketedCache('chatuser', USER_CACHE_EXPIRE,
+                               legacy_key='chatuser:{bucket}:{field}')
 
 
 class ChatUserDB(Base):
     __tablename__ = 'chat_users'
+    __table_args__ = (
+        Index('ux_chat_users_uid_cid', 'uid', 'cid', unique=True),
+        Index('ix_chat_users_cid_left', 'cid', 'left'),
+    )
 
     id = Column('id', Integer, primary_key=True)
     uid = Column('uid', BigInteger)
@@ -33,7 +44,8 @@ class ChatUserDB(Base):
     @retry(logger=logger)
     def add(cls, value: 'ChatUser'):
         try:
-            add_to_db(cls.copy(value))
+            upsert(cls, {'uid': value.uid, 'cid': value.cid, 'left': value.left},
+                   ['uid', 'cid'], {'left': value.left})
         except Exception as e:
             logger.error(e)
             raise Exception(f"Can't add chatuser {value.uid}:{value.cid} to DB")
@@ -42,51 +54,44 @@ class ChatUserDB(Base):
     @retry(logger=logger)
     def get(cls, uid: int, cid: int) -> typing.Optional['ChatUser']:
         try:
-            with session_scope() as db:
-                q: typing.List[ChatUserDB] = db.query(ChatUserDB) \
-                    .filter(ChatUserDB.uid == uid) \
-                    .filter(ChatUserDB.cid == cid) \
-                    .limit(1) \
-                    .all()
-            if q:
-                chatuser = ChatUser.copy(q[0])
-                return chatuser
-            return None
+            row = fetch_first(select(ChatUserDB.__table__)
+                              .where(ChatUserDB.uid == uid, ChatUserDB.cid == cid)
+                              .limit(1))
+            return None if row is None else ChatUser.from_row(row)
         except Exception as e:
             logger.error(e)
             raise Exception(f"Can't get chatuser {uid}:{cid} from DB")
 
     @classmethod
     @retry(logger=logger)
-    def get_random(cls, cid: int) -> typing.Optional['ChatUser']:
+    def get_all(cls, cid: int, left=False) -> typing.List['ChatUser']:
         try:
-            with session_scope() as db:
-                q: typing.List[ChatUserDB] = db.query(ChatUserDB) \
-                    .filter(ChatUserDB.cid == cid) \
-                    .filter(ChatUserDB.left == 0) \
-                    .order_by(func.rand()) \
-                    .limit(1) \
-                    .all()
-            if q:
-                return ChatUser.copy(q[0])
-            return None
+            rows = fetch_all(select(ChatUserDB.__table__)
+                             .where(ChatUserDB.cid == cid, ChatUserDB.left == left))
+            return [ChatUser.from_row(row) for row in rows]
         except Exception as e:
             logger.error(e)
-            raise Exception(f"Can't get random chatuser {cid} from DB")
+            raise Exception(f"Can't get all chatusers {cid}:{left} from DB")
 
     @classmethod
     @retry(logger=logger)
-    def get_all(cls, cid: int, left=False) -> typing.List['ChatUser']:
+    def get_present_uids(cls, cid: int, uids: typing.Iterable[int]) -> typing.Set[int]:
+        """
+        Кто из `uids` сейчас в чате.
+        """
+        uids = list(uids)
+        if not uids:
+            return set()
         try:
-            with session_scope() as db:
-                all_users = db.query(ChatUserDB) \
-                    .filter(ChatUserDB.cid == cid) \
-                    .filter(ChatUserDB.left == left) \
-                    .all()
-                return [ChatUser.copy(chatuser) for chatuser in all_users]
+            # noinspection PyUnresolvedReferences
+            rows = fetch_all(select(ChatUserDB.uid)
+                             .where(ChatUserDB.cid == cid,
+                                    ChatUserDB.uid.in_(uids),
+                                    ChatUserDB.left == 0))
+            return {uid for uid, in rows}
         except Exception as e:
             logger.error(e)
-            raise Exception(f"Can't get all chatusers {cid}:{left} from DB")
+            raise Exception(f"Can't get present chatusers {cid} from DB")
 
     @classmethod
     @retry(logger=logger)
@@ -94,14 +99,12 @@ class ChatUserDB(Base):
     typing.List[int]:
         config_cids = cids if cids else [int(c) for c in CONFIG.get('chats', [])]
         try:
-            with session_scope() as db:
-                # noinspection PyUnresolvedReferences
-                user_in_chats = db.query(ChatUserDB) \
-                    .filter(ChatUserDB.cid.in_(config_cids)) \
-                    .filter(ChatUserDB.uid == uid) \
-                    .filter(ChatUserDB.left == 0) \
-                    .all()
-                return [chatuser.cid for chatuser in user_in_chats]
+            # noinspection PyUnresolvedReferences
+            rows = fetch_all(select(ChatUserDB.cid)
+                             .where(ChatUserDB.cid.in_(config_cids),
+                                    ChatUserDB.uid == uid,
+                                    ChatUserDB.left == 0))
+            return [cid for cid, in rows]
         except Exception as e:
             logger.error(e)
             raise Exception(f"Can't get user chats {uid} from DB")
@@ -131,12 +134,86 @@ class ChatUserDB(Base):
             raise Exception(f"Can't update chatuser {uid}:{cid} to DB")
 
 
-class ChatUser:
+class ChatMembers:
+    """
+    Кто сейчас в чате — множество uid в редисе.
+
+    Заполняется из `chat_users` при первом обращении, дальше обновляется в `ChatUser.add` и при
+    входах и выходах. Раз в сутки сверяется с бд (`reconcile`), на случай если что-то разъехалось.
+    """
+    # uid 0 не бывает у людей. Он всегда лежит в множестве, чтобы пустой чат отличался
+    # от еще не загруженного
+    placeholder = '0'
+
+    @classmethod
+    def add(cls, cid: int, uid: int) -> None:
+        pure_cache.update_existing_set(cls.__get_key(cid), add=uid)
+
+    @classmethod
+    def remove(cls, cid: int, uid: int) -> None:
+        pure_cache.update_existing_set(cls.__get_key(cid), remove=uid)
+
+    @classmethod
+    def get(cls, cid: int) -> typing.Set[int]:
+        members = pure_cache.get_set(cls.__get_key(cid))
+        if not members:
+            members = cls.load(cid)
+        return {int(uid) for uid in members if uid != cls.placeholder}
+
+    @classmethod
+    def contains(cls, cid: int, uid: int) -> bool:
+        key = cls.__get_key(cid)
+        if pure_cache.is_in_set(key, uid):
+            return True
+        if pure_cache.is_in_set(key, cls.placeholder):
+            return False
+        return uid in cls.get(cid)
+
+    @classmethod
+    def random(cls, cid: int, count: int = 1) -> typing.List[int]:
+        """
+        До `count` разных случайных участников чата. Без чтения всего множества.
+        """
+        key = cls.__get_key(cid)
+        # просим на один больше, ведь может попасться заглушка
+        members = pure_cache.random_from_set(key, count + 1)
+        if not members:
+            cls.load(cid)
+            members = pure_cache.random_from_set(key, count + 1)
+        return [int(uid) for uid in members if uid != cls.placeholder][:count]
+
+    @classmethod
+    def load(cls, cid: int) -> typing.Set[str]:
+        """
+        Перечитывает участников чата из бд.
+        """
+        members = {str(chatuser.uid) for chatuser in ChatUserDB.get_all(cid)}
+        members.add(cls.placeholder)
+        pure_cache.replace_set(cls.__get_key(cid), members)
+        return members
+
+    @classmethod
+    def reconcile(cls, cid: int) -> None:
+        old = pure_cache.get_set(cls.__get_key(cid))
+        new = cls.load(cid)
+        if old and old != new:
+            logger.info(f'[chat_members] {cid}: +{len(new - old)} -{len(old - new)} '
+                        f'after reconcile')
+
+    @staticmethod
+    def __get_key(cid: int) -> str:
+        return f'chat_members:{cid}'
+
+
+class ChatUser(SlotsState):
     """
     Список всех юзеров в конкретном чате, даже ливнувших.
     """
+    __slots__ = ('id', 'uid', 'cid', 'left')
     add_lock = Lock()
     get_lock = Lock()
+    # неизменившегося чатюзера продлеваем в редисе не чаще раза в полчаса
+    cache_touch = TouchThrottle(30 * 60)
 
     def __init__(self, id=None, uid=None, cid=None, left=False):
         self.id = id
@@ -156,6 +233,13 @@ class ChatUser:
             left=chatuser.left
         )
 
+    @classmethod
+    def from_row(cls, row) -> 'ChatUser':
+        """
+        Из строки select'а по колонкам таблицы chat_users.
+        """
+        return ChatUser(**row._mapping)
+
     @classmethod
     def add(cls, uid: int, cid: int, left: bool = False) -> None:
         if uid == bot_id():
@@ -163,21 +247,34 @@ class ChatUser:
         new_user = ChatUser(uid=uid, cid=cid, left=left)
         old_user = cls.get(uid, cid)
 
+        # get уже положил чатюзера в редис. если ничего не поменялось, то только продлеваем кэш
+        key = (cid, uid)
+        if old_user is not None and old_user.left == left:
+            cls.cache_touch.touch(key, lambda: chatuser_cache.touch(uid, bucket=cid))
+            return
+
         # эти данные в бд меняются редко, поэтому они сразу сохраняются в редис,
         # чтобы не локать лишний раз
-        cache.set(cls.__get_key(uid, cid), new_user, time=USER_CACHE_EXPIRE)
+        chatuser_cache.set(uid, new_user, bucket=cid)
+        cls.cache_touch.forget(key)
 
-        # проверка, нужно ли обновлять бд
-        # блокировка (она в методе __add) начнется только если данные изменились
+        # блокировка (она в методе __add) начнется только здесь, когда данные изменились
+        cls.__update_members(new_user)
         if old_user is not None:
-            update = {}
-            if old_user.left != left:
-                update['left'] = left
-            if update:
-                cls.__add(new_user, update)
+            cls.__add(new_user, {'left': left})
             return
         cls.__add(new_user)
 
+    @staticmethod
+    def __update_members(chatuser: 'ChatUser') -> None:
+        try:
+            if chatuser.left:
+                ChatMembers.remove(chatuser.cid, chatuser.uid)
+            else:
+                ChatMembers.add(chatuser.cid, chatuser.uid)
+        except Exception as e:
+            logger.error(e)
+
     @classmethod
     def __add(cls, new_user: 'ChatUser', update: dict = None) -> None:
         """
@@ -195,7 +292,7 @@ class ChatUser:
 
     @classmethod
     def get(cls, uid, cid) -> typing.Optional['ChatUser']:
-        cached = cache.get(cls.__get_key(uid, cid))
+        cached = chatuser_cache.get(uid, bucket=cid)
         if cached:
             return cached
 
@@ -205,7 +302,7 @@ class ChatUser:
             try:
                 chatuser = ChatUserDB.get(uid, cid)
                 if chatuser:
-                    cache.set(cls.__get_key(uid, cid), chatuser, time=USER_CACHE_EXPIRE)
+                    chatuser_cache.set(uid, chatuser, bucket=cid)
                     return chatuser
             except Exception as e:
                 logger.error(e)
@@ -216,19 +313,56 @@ class ChatUser:
         """
         Возвращает список всех, кто сейчас в чате.
         """
+        return [ChatUser(uid=uid, cid=cid) for uid in sorted(cls.get_all_uids(cid))]
+
+    @classmethod
+    def get_all_uids(cls, cid: int) -> typing.Set[int]:
+        """
+        Uid всех, кто сейчас в чате. Берется из редиса, без запроса к бд.
+        """
         try:
-            return ChatUserDB.get_all(cid)
+            return ChatMembers.get(cid)
         except Exception as e:
             logger.error(e)
-            return []
+            return set()
 
     @classmethod
-    def get_random(cls, cid: int) -> typing.Optional['ChatUser']:
+    def is_member(cls, uid: int, cid: int) -> bool:
+        """
+        Сейчас ли юзер в чате.
+        """
         try:
-            return ChatUserDB.get_random(cid)
+            return ChatMembers.contains(cid, uid)
         except Exception as e:
             logger.error(e)
-        return None
+            return False
+
+    @classmethod
+    def get_random(cls, cid: int, weights: typing.Optional[typing.Dict[int, float]] = None) \
+            -> typing.Optional['ChatUser']:
+        uids = cls.get_random_uids(cid, weights=weights)
+        return ChatUser(uid=uids[0], cid=cid) if uids else None
+
+    @classmethod
+    def get_random_uids(cls, cid: int, count: int = 1,
+                        weights: typing.Optional[typing.Dict[int, float]] = None) \
+            -> typing.List[int]:
+        """
+        До `count` разных случайных участников чата.
+
+        :param weights: вес юзера, например его активность за неделю. Кого нет в словаре, у того
+            вес 1. Без весов выборка идет прямо в редисе через SRANDMEMBER.
+        """
+        try:
+            if not weights:
+                return ChatMembers.random(cid, count)
+            uids = ChatMembers.get(cid)
+        except Exception as e:
+            logger.error(e)
+            return []
+        # взвешенная выборка без повторов (Efraimidis–Spirakis): у кого больше ключ, тот и выбран
+        keys = {uid: random.random() ** (1 / max(weights.get(uid, 1), 1e-9)) for uid in uids}
+        return heapq.nlargest(count, keys, key=keys.get)
 
     @classmethod
     def get_user_chats(cls, uid, cids=None) -> typing.List[int]:
@@ -237,7 +371,3 @@ class ChatUser:
         except Exception as e:
             logger.error(e)
             return []
-
-    @staticmethod
-    def __get_key(uid, cid):
-        return f'chatuser:{cid}:{uid}'
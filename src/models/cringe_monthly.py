@@ -5,11 +5,11 @@ from threading import Lock
 from typing import List, Tuple, Optional
 
 import telegram
-from telegram.ext import run_async
 
 from src.models.user import UserDB, User
 from src.utils.cache import cache, MONTH, DAY, bot_id
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
+from src.utils.lanes import interactive_lane
 from src.utils.logger_helpers import get_logger
 from src.utils.telegram_helpers import send_long
 
@@ -70,7 +70,6 @@ class CringeMonthly:
         return uid
 
     @classmethod
-    @run_async
     def parse_message(cls, message: telegram.Message) -> None:
         msg = message.text
         if msg is None:
@@ -156,7 +155,7 @@ class CringeMonthly:
         cache.set(cls.__get_cache_key(date, cid), newdb, time=CRINGE_EXPIRE)
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
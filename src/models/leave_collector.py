@@ -6,14 +6,15 @@ from time import sleep
 
 import sqlalchemy
 import telegram
-from sqlalchemy import Column, Integer, Text, BigInteger, DateTime
+from sqlalchemy import Column, Integer, Text, BigInteger, DateTime, Index, select
 
 from src.config import CONFIG, get_config_chats
-from src.models.chat_user import ChatUser
+from src.models.chat_user import ChatUser, ChatMembers, ChatUserDB
 from src.models.user import User
 from src.utils.cache import cache, TWO_YEARS, FEW_DAYS, pure_cache
-from src.utils.db import Base, add_to_db, session_scope, retry
+from src.utils.db import Base, session_scope, retry, upsert_statement, fetch_all
 from src.utils.logger_helpers import get_logger
+from src.utils.misc import SlotsState
 from src.utils.telegram_helpers import telegram_retry
 
 logger = get_logger(__name__)
@@ -21,6 +22,9 @@ logger = get_logger(__name__)
 
 class LeaveCollectorDB(Base):
     __tablename__ = 'leave_logs'
+    __table_args__ = (
+        Index('ix_leave_logs_cid_date', 'cid', 'date'),
+    )
 
     class LeaveType(enum.Enum):
         added = 1
@@ -39,70 +43,84 @@ class LeaveCollectorDB(Base):
     @staticmethod
     @retry(logger=logger)
     def add(uid, cid, date, from_uid, leave_type):
+        """
+        Пишет событие в лог и в той же транзакции обновляет текущее состояние юзера в чате.
+        """
+        values = {'cid': cid, 'uid': uid, 'leave_type': leave_type, 'date': date,
+                  'from_uid': from_uid}
         try:
-            add_to_db(LeaveCollectorDB(uid=uid, cid=cid, date=date, from_uid=from_uid,
-                                       leave_type=leave_type))
+            with session_scope() as db:
+                db.add(LeaveCollectorDB(uid=uid, cid=cid, date=date, from_uid=from_uid,
+                                        leave_type=leave_type))
+                db.flush()
+                db.execute(upsert_statement(ChatMembershipDB, values, ['cid', 'uid'],
+                                            {'leave_type': leave_type, 'date': date,
+                                             'from_uid': from_uid}))
+                db.commit()
         except Exception as e:
             logger.error(e)
             raise Exception(f"Can't add leave_collect {uid}:{cid} to DB")
 
-    @staticmethod
-    @retry(logger=logger)
-    def get_leaves(cid, days_ago) -> typing.List[int]:
-        try:
-            with session_scope() as db:
-                q = db.query(LeaveCollectorDB).from_statement(sqlalchemy.text(
-                    f"""
-                        SELECT 
-                          t1.* 
-                        FROM leave_logs t1
-                          JOIN (SELECT 
-                                  uid, MAX(date) date 
-                                FROM leave_logs 
-                                WHERE date >= {days_ago} 
-                                AND cid = {cid} 
-                                GROUP BY uid) t2
-                          ON t1.uid = t2.uid 
-                          AND t1.date = t2.date 
-                          AND t1.leave_type in ('kicked', 'left')
-                          AND t1.cid = {cid};
-                    """)).all()
-            return [x.uid for x in q]
-        except Exception as e:
-            logger.error(e)
-            return []
+
+class ChatMembershipDB(Base):
+    """
+    Последнее событие входа/выхода для каждого юзера в чате. Поддерживается вместе с leave_logs,
+    поэтому "кто ливнул за N дней" — простой запрос по индексу.
+    """
+    __tablename__ = 'chat_membership'
+    __table_args__ = (
+        Index('ix_chat_membership_cid_date', 'cid', 'date'),
+    )
+
+    # CREATE TABLE `chat_membership` (
+    # 	`cid` BIGINT(20) NOT NULL,
+    # 	`uid` BIGINT(20) NOT NULL,
+    # 	`leave_type` ENUM('added','invite','kicked','left') NULL DEFAULT NULL,
+    # 	`date` DATETIME NULL DEFAULT NULL,
+    # 	`from_uid` BIGINT(20) NULL DEFAULT NULL,
+    # 	PRIMARY KEY (`cid`, `uid`),
+    # 	INDEX `ix_chat_membership_cid_date` (`cid`, `date`)
+    # )
+
+    cid = Column('cid', BigInteger, primary_key=True, autoincrement=False)
+    uid = Column('uid', BigInteger, primary_key=True, autoincrement=False)
+    leave_type = Column('leave_type', sqlalchemy.Enum(LeaveCollectorDB.LeaveType))
+    date = Column('date', DateTime)
+    from_uid = Column('from_uid', BigInteger)
+
+    left_types = (LeaveCollectorDB.LeaveType.kicked, LeaveCollectorDB.LeaveType.left)
+    joined_types = (LeaveCollectorDB.LeaveType.added, LeaveCollectorDB.LeaveType.invite)
 
     @staticmethod
     @retry(logger=logger)
-    def get_joins(cid, days_ago) -> typing.List[int]:
+    def get_uids(cid: int, since: datetime, leave_types) -> typing.List[int]:
+        """
+        Юзеры, у которых последнее событие начиная с `since` — одно из `leave_types`.
+        """
         try:
-            with session_scope() as db:
-                q = db.query(LeaveCollectorDB).from_statement(sqlalchemy.text(
-                    f"""
-                        SELECT
-                            t1.* 
-                        FROM leave_logs t1
-                          JOIN (SELECT 
-                                    uid, MAX(date) date 
-                                FROM leave_logs 
-                                WHERE date >= {days_ago} 
-                                AND cid = {cid} 
-                                GROUP BY uid) t2
-                          ON t1.uid = t2.uid 
-                          AND t1.date = t2.date 
-                          AND t1.leave_type in ('added', 'invite') 
-                          AND t1.cid = {cid};
-                    """)).all()
-            return [x.uid for x in q]
+            rows = fetch_all(select(ChatMembershipDB.uid)
+                             .where(ChatMembershipDB.cid == cid,
+                                    ChatMembershipDB.date >= since,
+                                    ChatMembershipDB.leave_type.in_(leave_types)))
+            return [uid for uid, in rows]
         except Exception as e:
             logger.error(e)
             return []
 
+    @classmethod
+    def get_leaves(cls, cid: int, since: datetime) -> typing.List[int]:
+        return cls.get_uids(cid, since, cls.left_types)
+
+    @classmethod
+    def get_joins(cls, cid: int, since: datetime) -> typing.List[int]:
+        return cls.get_uids(cid, since, cls.joined_types)
+
 
-class LeaveCollector:
+class LeaveCollector(SlotsState):
     """
     Здесь хранятся все входы и ливы из чата.
     """
+    __slots__ = ('id', 'uid', 'cid', 'date', 'leave_type', 'from_uid', 'reason')
     update_ktolivnul_lock = Lock()
 
     def __init__(self, id=None, uid=None, cid=None, date=None, leave_type=None, from_uid=None,
@@ -138,6 +156,11 @@ class LeaveCollector:
                                  leave_type=leave_type)
         except Exception as e:
             logger.error(e)
+            return
+        if leave_type in ChatMembershipDB.left_types:
+            ChatMembers.remove(cid, uid)
+        else:
+            ChatMembers.add(cid, uid)
 
     @staticmethod
     def add_invite(uid, cid, date, from_uid):
@@ -159,15 +182,18 @@ class LeaveCollector:
     def get_leaves(cls, cid, days=3, return_id=False):
         days_ago = (datetime.today() - timedelta(days=days)).replace(hour=0, minute=0, second=0,
                                                                      microsecond=0)
-        uids: typing.Set[int] = set(LeaveCollectorDB.get_leaves(cid, days_ago.strftime('%Y%m%d')))
+        uids: typing.Set[int] = set(ChatMembershipDB.get_leaves(cid, days_ago))
 
         # некоторые ливают, а потом возвращаются без сообщений о входе.
         # из-за отсутствия сообщения о входе, LeaveCollector думает, что они не в чате
         # (при этом сам бот в курсе, что они в чате).
         # можно было бы в `leave_check` определять невидимые входы и отмечать их,
-        # но проще просто в этом методе получить тех, кто в чате, и исключить их из выдачи.
-        chat_uids_db: typing.Set[int] = set([x.uid for x in ChatUser.get_all(cid)])
-        true_leaves = uids - chat_uids_db
+        # но проще просто в этом методе исключить из выдачи тех, кто в чате.
+        try:
+            true_leaves = uids - ChatUserDB.get_present_uids(cid, uids)
+        except Exception as e:
+            logger.error(e)
+            true_leaves = uids
 
         if return_id:
             return list(true_leaves)
@@ -177,7 +203,7 @@ class LeaveCollector:
     def get_joins(cls, cid, days=3):
         days_ago = (datetime.today() - timedelta(days=days)).replace(hour=0, minute=0, second=0,
                                                                      microsecond=0)
-        uids = LeaveCollectorDB.get_joins(cid, days_ago.strftime('%Y%m%d'))
+        uids = ChatMembershipDB.get_joins(cid, days_ago)
         return [cls.__format_uid(uid, show_username=False) for uid in uids]
 
     @staticmethod
@@ -194,7 +220,7 @@ class LeaveCollector:
                 [int(x) for x in pure_cache.get(f'ktolivnul:{chat_id}', '').split(',') if x != ''])
             if len(chat_uids_ktolivnul) == 0:
                 return
-            chat_uids_db = set([x.uid for x in ChatUser.get_all(chat_id)])
+            chat_uids_db = ChatUser.get_all_uids(chat_id)
             leaved_uids = chat_uids_db - chat_uids_ktolivnul
             if len(leaved_uids) == 0:
                 return
@@ -3,7 +3,6 @@ import re
 from datetime import datetime, timedelta
 from threading import Lock
 
-from telegram.ext import run_async
 
 from src.models.user import UserDB
 from src.models.user_stat import UserStat
@@ -47,7 +46,6 @@ class PidorWeekly:
         return uid
 
     @classmethod
-    @run_async
     def parse_message(cls, message):
         msg = message.text
         if msg is None:
@@ -2,10 +2,9 @@ import json
 import os
 from datetime import datetime
 from threading import Lock
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Dict, Set, Iterable
 
 import pytils
-from telegram.ext import run_async
 
 from src.config import CONFIG
 from src.models.chat_user import ChatUser
@@ -194,7 +193,6 @@ class ReplyTop:
         return copy
 
     @classmethod
-    @run_async
     def parse_message(cls, message):
         from_uid = message.from_user.id
         cid = message.chat_id
@@ -217,72 +215,141 @@ class ReplyTop:
 
     @classmethod
     def get_user_top_strast(cls, chat_id: int, user_id: int, date=None) -> Tuple[Optional[User], Optional[User], Optional[User]]:
-        def get_top(type: str, uid: int) -> Optional[User]:
-            if type not in db:
-                return None
-            if uid not in db[type]:
-                return None
-            replylove__ignore = CONFIG.get('replylove__ignore', [])
-            if uid in replylove__ignore:
-                return None
-            replylove__dragon_lovers = CONFIG.get('replylove__dragon_lovers', [])
-            if uid in replylove__dragon_lovers:
-                return User(0, 0, 'drakon', '🐉')
-            sorted: List[Tuple[int, int]] = sort_dict(db[type][uid])
-            if len(sorted) == 0:
-                return None
-            replylove__ignore_pairs = CONFIG.get('replylove__ignore_pairs', {}).get(str(chat_id), {}).get(str(uid), [])
-            for result_uid, count in sorted:
-                if count < 5:
-                    continue
-                if uid == result_uid:
-                    continue
-                if result_uid in replylove__dragon_lovers:
-                    continue
-                if result_uid in replylove__ignore:
-                    continue
-                if result_uid in replylove__ignore_pairs:
-                    continue
-                return User.get(result_uid)
-            return None
+        return ReplyGraph.load(chat_id, date).get_user_top_strast(user_id)
 
-        def get_top_pair(uid: int) -> Optional[User]:
-            replylove__dragon_lovers = CONFIG.get('replylove__dragon_lovers', [])
-            if uid in replylove__dragon_lovers:
-                return User(0, 0, 'drakon', '🐉')
-            replylove__ignore = CONFIG.get('replylove__ignore', [])
-            replylove__ignore_pairs = CONFIG.get('replylove__ignore_pairs', {}).get(str(chat_id), {}).get(str(uid), [])
-            pairs: List[Tuple[str, int]] = sort_dict(db['pair'])
-            for pair, count in pairs:
-                a_uid, b_uid = [get_int(x) for x in pair.split(',')]
-                strast = None
-                if a_uid is None or b_uid is None:
-                    continue
-                if count < 5:
-                    continue
-                if uid == a_uid and a_uid == b_uid:
-                    continue
-                if any(x in replylove__dragon_lovers for x in (a_uid, b_uid)):
-                    continue
-                if any(x in replylove__ignore for x in (uid, a_uid, b_uid)):
-                    continue
-                if any(x in replylove__ignore_pairs for x in (a_uid, b_uid)):
-                    continue
-                if uid == a_uid:
-                    strast = User.get(b_uid)
-                if uid == b_uid:
-                    strast = User.get(a_uid)
-                if strast:
-                    return strast
-            return None
 
+class ReplyGraph:
+    """
+    Недельный граф реплаев чата. Загружается из редиса один раз, дальше вся страсть
+    считается в памяти.
+    """
+
+    def __init__(self, chat_id: int, db: dict) -> None:
+        self.chat_id = chat_id
+        self.db = db
+        self.ignore = CONFIG.get('replylove__ignore', [])
+        self.dragon_lovers = CONFIG.get('replylove__dragon_lovers', [])
+        self.ignore_pairs = CONFIG.get('replylove__ignore_pairs', {}).get(str(chat_id), {})
+        self.users: Dict[int, Optional[User]] = {}
+        self.__pairs_by_uid: Optional[Dict[int, List[Tuple[int, int, int]]]] = None
+        self.__tops: Dict[Tuple[str, int], Optional[User]] = {}
+
+    @classmethod
+    def load(cls, chat_id: int, date=None) -> 'ReplyGraph':
         monday = get_current_monday() if date is None else get_date_monday(date)
-        db = cls.db_helper.get_db(monday, chat_id)
+        return cls(chat_id, ReplyTop.db_helper.get_db(monday, chat_id))
 
-        pair = get_top_pair(user_id)
-        inbound = get_top('inbound', user_id)
-        outbound = get_top('outbound', user_id)
-        return pair, inbound, outbound
+    def get_all_uids(self) -> Set[int]:
+        """
+        Все юзеры, которые есть в графе.
+        """
+        uids = set()
+        for type in ('inbound', 'outbound'):
+            for uid, partners in self.db.get(type, {}).items():
+                uids.add(uid)
+                uids.update(partners.keys())
+        for pair in self.db['pair'].keys():
+            uids.update(get_int(x) for x in pair.split(','))
+        uids.discard(None)
+        return uids
+
+    def prefetch_users(self, uids: Iterable[int]) -> None:
+        """
+        Загружает юзеров одним запросом, чтобы потом не ходить за каждым по отдельности.
+        """
+        missing = [uid for uid in uids if uid not in self.users]
+        found = User.get_many(missing)
+        for uid in missing:
+            self.users[uid] = found.get(uid)
+
+    def get_user(self, uid: int) -> Optional[User]:
+        if uid not in self.users:
+            self.users[uid] = User.get(uid)
+        return self.users[uid]
+
+    def get_user_top_strast(self, user_id: int) \
+            -> Tuple[Optional[User], Optional[User], Optional[User]]:
+        return self.get_top_pair(user_id), self.get_top('inbound', user_id), \
+            self.get_top('outbound', user_id)
+
+    def get_top(self, type: str, uid: int) -> Optional[User]:
+        key = (type, uid)
+        if key not in self.__tops:
+            self.__tops[key] = self.__find_top(type, uid)
+        return self.__tops[key]
+
+    def get_top_pair(self, uid: int) -> Optional[User]:
+        key = ('pair', uid)
+        if key not in self.__tops:
+            self.__tops[key] = self.__find_top_pair(uid)
+        return self.__tops[key]
+
+    def __find_top(self, type: str, uid: int) -> Optional[User]:
+        if type not in self.db:
+            return None
+        if uid not in self.db[type]:
+            return None
+        if uid in self.ignore:
+            return None
+        if uid in self.dragon_lovers:
+            return User(0, 0, 'drakon', '🐉')
+        sorted: List[Tuple[int, int]] = sort_dict(self.db[type][uid])
+        if len(sorted) == 0:
+            return None
+        ignore_pairs = self.ignore_pairs.get(str(uid), [])
+        for result_uid, count in sorted:
+            if count < 5:
+                continue
+            if uid == result_uid:
+                continue
+            if result_uid in self.dragon_lovers:
+                continue
+            if result_uid in self.ignore:
+                continue
+            if result_uid in ignore_pairs:
+                continue
+            return self.get_user(result_uid)
+        return None
+
+    def __find_top_pair(self, uid: int) -> Optional[User]:
+        if uid in self.dragon_lovers:
+            return User(0, 0, 'drakon', '🐉')
+        ignore_pairs = self.ignore_pairs.get(str(uid), [])
+        for a_uid, b_uid, count in self.__get_pairs(uid):
+            strast = None
+            if count < 5:
+                continue
+            if uid == a_uid and a_uid == b_uid:
+                continue
+            if any(x in self.dragon_lovers for x in (a_uid, b_uid)):
+                continue
+            if any(x in self.ignore for x in (uid, a_uid, b_uid)):
+                continue
+            if any(x in ignore_pairs for x in (a_uid, b_uid)):
+                continue
+            if uid == a_uid:
+                strast = self.get_user(b_uid)
+            if uid == b_uid:
+                strast = self.get_user(a_uid)
+            if strast:
+                return strast
+        return None
+
+    def __get_pairs(self, uid: int) -> List[Tuple[int, int, int]]:
+        """
+        Пары юзера по убыванию страсти. Индекс строится один раз на весь граф.
+        """
+        if self.__pairs_by_uid is None:
+            pairs_by_uid: Dict[int, List[Tuple[int, int, int]]] = {}
+            for pair, count in sort_dict(self.db['pair']):
+                a_uid, b_uid = [get_int(x) for x in pair.split(',')]
+                if a_uid is None or b_uid is None:
+                    continue
+                pairs_by_uid.setdefault(a_uid, []).append((a_uid, b_uid, count))
+                if b_uid != a_uid:
+                    pairs_by_uid.setdefault(b_uid, []).append((a_uid, b_uid, count))
+            self.__pairs_by_uid = pairs_by_uid
+        return self.__pairs_by_uid.get(uid, [])
 
 
 class ReplyTopDaily:
@@ -316,6 +383,16 @@ class ReplyLove:
         love = ' ❤' if b_pair and b_pair.uid == a.uid else ''
         return f'<b>{cls.get_fullname_or_username(a)}</b> ⟷ {cls.get_fullname_or_username(b)}{love}'
 
+    @staticmethod
+    def __get_all_users(graph: ReplyGraph) -> List[User]:
+        """
+        Все юзеры чата по алфавиту. Заодно одним запросом загружает всех юзеров графа.
+        """
+        uids = ChatUser.get_all_uids(graph.chat_id)
+        graph.prefetch_users(graph.get_all_uids() | set(uids))
+        all_users = (graph.get_user(uid) for uid in uids)
+        return sorted((user for user in all_users if user), key=lambda x: x.fullname)
+
     @classmethod
     def get_all_love(cls, chat_id: int, date=None, header='Вся страсть') -> str:
         def get_no_love_str(no_love_: List) -> str:
@@ -331,12 +408,11 @@ class ReplyLove:
                 return ''
             return f'\n\nНарциссы:\n' + '\n'.join((cls.__format_pair(a) for a in narcissist_))
 
-        all_chat_users = ChatUser.get_all(chat_id)
-        all_users = (User.get(chatuser.uid) for chatuser in all_chat_users)
-        all_users = sorted(all_users, key=lambda x: x.fullname)
-        all_love = [(user, ReplyTop.get_user_top_strast(chat_id, user.uid, date)[0]) for user in all_users if user]
+        graph = ReplyGraph.load(chat_id, date)
+        all_users = cls.__get_all_users(graph)
+        all_love = [(user, graph.get_top_pair(user.uid)) for user in all_users]
 
-        in_love = [(a, b, ReplyTop.get_user_top_strast(chat_id, b.uid, date)[0]) for a, b in all_love if b]
+        in_love = [(a, b, graph.get_top_pair(b.uid)) for a, b in all_love if b]
         narcissist = [a for a, _ in all_love if a.uid in CONFIG.get('replylove__narcissist', [])]
         no_love = [a for a, b in all_love if not b and a.uid not in CONFIG.get('replylove__narcissist', [])]
 
@@ -348,12 +424,11 @@ class ReplyLove:
 
     @classmethod
     def get_all_love_outbound(cls, chat_id: int, date=None, header='Вся исходящая страсть', no_love_show_only_count=False) -> str:
-        all_chat_users = ChatUser.get_all(chat_id)
-        all_users = (User.get(chatuser.uid) for chatuser in all_chat_users)
-        all_users = sorted(all_users, key=lambda x: x.fullname)
-        all_love = [(user, ReplyTop.get_user_top_strast(chat_id, user.uid, date)[2]) for user in all_users if user]
+        graph = ReplyGraph.load(chat_id, date)
+        all_users = cls.__get_all_users(graph)
+        all_love = [(user, graph.get_top('outbound', user.uid)) for user in all_users]
 
-        in_love = [(a, b, ReplyTop.get_user_top_strast(chat_id, b.uid, date)[2]) for a, b in all_love if b]
+        in_love = [(a, b, graph.get_top('outbound', b.uid)) for a, b in all_love if b]
         no_love = [a for a, b in all_love if not b]
 
         in_love_str = '\n'.join(cls.__format_pair(a, b, b_pair) for a, b, b_pair in in_love)
@@ -2,19 +2,28 @@ import typing
 from threading import Lock
 
 import telegram
-from sqlalchemy import Column, Integer, Text, Boolean, BigInteger
+from sqlalchemy import Column, Integer, Text, Boolean, BigInteger, Index, select
 
 from src.models.chat_user import ChatUser
-from src.utils.cache import cache, USER_CACHE_EXPIRE
-from src.utils.db import Base, add_to_db, retry, session_scope
+from src.utils.cache import USER_CACHE_EXPIRE, TouchThrottle
+from src.utils.cache_buckets import BucketedCache, modulo_bucket
+from src.utils.db import Base, retry, session_scope, upsert, fetch_first
 from src.utils.logger_helpers import get_logger
-from src.utils.misc import get_int
+from src.utils.misc import SlotsState, get_int
 
 logger = get_logger(__name__)
+# юзеры лежат в хэшах по остатку от uid, а не каждый в своем ключе
+user_cache = BucketedCache('user', USER_CACHE_EXPIRE,
+                           bucket_of=lambda uid: modulo_bucket(uid, 1024),
+                           legacy_key='user:{field}')
 
 
 class UserDB(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ux_users_uid', 'uid', unique=True),
+        Index('ix_users_username', 'username', mysql_length=64),
+    )
 
     id = Column('id', Integer, primary_key=True)
     uid = Column('uid', BigInteger)
@@ -39,7 +48,12 @@ class UserDB(Base):
     @retry(logger=logger)
     def add(cls, new_user: 'User'):
         try:
-            add_to_db(cls.copy(new_user))
+            upsert(cls,
+                   {'uid': new_user.uid, 'username': new_user.username,
+                    'fullname': new_user.fullname, 'public': new_user.public,
+                    'female': new_user.female},
+                   ['uid'],
+                   {'username': new_user.username, 'fullname': new_user.fullname})
         except Exception as e:
             logger.error(e)
             raise Exception(f"Can't add user {new_user.uid} to DB")
@@ -48,14 +62,8 @@ class UserDB(Base):
     @retry(logger=logger)
     def get(cls, uid: int) -> typing.Optional['User']:
         try:
-            with session_scope() as db:
-                q = db.query(UserDB) \
-                    .filter(UserDB.uid == uid) \
-                    .limit(1) \
-                    .all()
-            if q:
-                return User.copy(q[0])
-            return None
+            row = fetch_first(select(UserDB.__table__).where(UserDB.uid == uid).limit(1))
+            return None if row is None else User.from_row(row)
         except Exception as e:
             logger.error(e)
             raise Exception(f"Can't get user {uid} from DB")
@@ -65,14 +73,9 @@ class UserDB(Base):
     def get_by_username(cls, username: str) -> typing.Optional['User']:
         username = username.lstrip('@')
         try:
-            with session_scope() as db:
-                q = db.query(UserDB) \
-                    .filter(UserDB.username == username) \
-                    .limit(1) \
-                    .all()
-            if q:
-                return User.copy(q[0])
-            return None
+            row = fetch_first(
+                select(UserDB.__table__).where(UserDB.username == username).limit(1))
+            return None if row is None else User.from_row(row)
         except Exception as e:
             logger.error(e)
             raise Exception(f"Can't get username {username} from DB")
@@ -111,12 +114,15 @@ class UserDB(Base):
             raise Exception(f"Can't update user {uid} to DB")
 
 
-class User:
+class User(SlotsState):
     """
     Список всех юзеров, даже ливнувших.
     """
+    __slots__ = ('_id', 'uid', 'username', 'fullname', 'public', 'female')
     add_lock = Lock()
     get_lock = Lock()
+    # неизменившегося юзера продлеваем в редисе не чаще раза в полчаса
+    cache_touch = TouchThrottle(30 * 60)
 
     def __init__(self, id=None, uid=None, username=None, fullname=None, public=False, female=False):
         self._id = id  # делаем его protected, чтобы не путать с uid
@@ -140,6 +146,13 @@ class User:
             female=user.female
         )
 
+    @classmethod
+    def from_row(cls, row) -> 'User':
+        """
+        Из строки select'а по колонкам таблицы users.
+        """
+        return User(**row._mapping)
+
     @classmethod
     def add_user(cls, user: telegram.User) -> None:
         if user.is_bot:
@@ -152,20 +165,25 @@ class User:
         old_user_female = False if old_user is None else old_user.female
         new_user = User(uid=uid, username=username, fullname=fullname, female=old_user_female)
 
-        # пользователя нужно всегда обновлять в редисе (продлевать кэш, так сказать)
-        # но в базе он меняется редко. поэтому сразу обновляем редис
-        cache.set(cls.__get_cache_key(uid), new_user, time=USER_CACHE_EXPIRE)
+        # get уже положил юзера в редис. если ничего не поменялось, то только продлеваем кэш
+        if old_user is not None \
+                and old_user.username == username and old_user.fullname == fullname:
+            cls.cache_touch.touch(uid, lambda: user_cache.touch(uid))
+            return
 
-        # и только потом проверяем, нужно ли обновить в базе
-        # если нужно, то __add вызовет блокировку потока
+        # юзер новый или изменился. в базе он меняется редко, поэтому сразу обновляем редис
+        user_cache.set(uid, new_user)
+        cls.cache_touch.forget(uid)
+
+        # и только потом обновляем базу
+        # __add вызовет блокировку потока
         if old_user is not None:
             update = {}
             if old_user.username != username:
                 update['username'] = username
             if old_user.fullname != fullname:
                 update['fullname'] = fullname
-            if update:
-                cls.__add(new_user, update)
+            cls.__add(new_user, update)
             return
         cls.__add(new_user)
 
@@ -180,7 +198,7 @@ class User:
             if uid is None:
                 return None
 
-        cached = cache.get(cls.__get_cache_key(uid))
+        cached = user_cache.get(uid)
         if cached:
             return cached
 
@@ -190,20 +208,39 @@ class User:
             try:
                 user = UserDB.get(uid)
                 if user:
-                    cache.set(cls.__get_cache_key(uid), user, time=USER_CACHE_EXPIRE)
+                    user_cache.set(uid, user)
                     return user
             except Exception as e:
                 logger.error(e)
         return None
 
+    @classmethod
+    def get_many(cls, uids: typing.Iterable[int]) -> typing.Dict[int, 'User']:
+        """
+        Возвращает сразу много юзеров: из редиса одним запросом, недостающих — по одному из бд.
+        Ненайденных в результате не будет.
+        """
+        uids = list({uid for uid in uids if uid})
+        cached = user_cache.get_many(uids)
+        result = {}
+        for uid, user in zip(uids, cached):
+            if user is None:
+                user = cls.get(uid)
+            if user is not None:
+                result[uid] = user
+        return result
+
     def get_username_or_link(self) -> str:
         if self.username is not None:
             return '@{}'.format(self.username)
         return '<a href="tg://user?id={}">{}</a>'.format(self.uid, self.fullname)
 
     @classmethod
-    def clear_cache(cls):
-        cache.delete_by_pattern(cls.__get_cache_key('*'))
+    def clear_cache(cls) -> int:
+        def log_progress(scanned: int, deleted: int) -> None:
+            logger.debug(f'[user.clear_cache] scanned {scanned}, deleted {deleted}')
+
+        return user_cache.clear(progress=log_progress)
 
     @staticmethod
     def get_id_by_name(username: str) -> typing.Optional[int]:
@@ -225,7 +262,3 @@ class User:
                 UserDB.add(new_user)
             except Exception as e:
                 logger.error(e)
-
-    @staticmethod
-    def __get_cache_key(uid) -> str:
-        return f'user:{uid}'
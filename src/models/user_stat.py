@@ -1,23 +1,27 @@
 import locale
 import random
+import struct
+import time
 import typing
-from datetime import timedelta, datetime
+import uuid
+from datetime import timedelta, datetime, timezone
 from threading import Lock
 from urllib.parse import urlparse
 
 import pytils
-from sqlalchemy import Column, Integer, String, BigInteger, DateTime, func, or_
+from sqlalchemy import Column, Integer, String, BigInteger, DateTime, Index, func, or_, select
 
 import emoji_fixed as emoji
 from src.config import CONFIG
 from src.modules.antimat.antimat import Antimat
-from src.models.chat_user import ChatUser, ChatUserDB
+from src.models.chat_user import ChatUser
 from src.models.user import UserDB, User
-from src.utils.cache import USER_CACHE_EXPIRE, bot_id
-from src.utils.cache import cache
-from src.utils.db import Base, add_to_db, retry, session_scope
+from src.utils.cache import USER_CACHE_EXPIRE, MONTH, bot_id
+from src.utils.cache import cache, pure_cache
+from src.utils.db import Base, retry, session_scope, upsert, upsert_statement, fetch_all, \
+    fetch_first
 from src.utils.logger_helpers import get_logger
-from src.utils.misc import sort_dict
+from src.utils.misc import SlotsState, sort_dict
 from src.utils.time_helpers import get_current_monday, get_date_monday
 
 logger = get_logger(__name__)
@@ -25,6 +29,9 @@ logger = get_logger(__name__)
 
 class UserStatDB(Base):
     __tablename__ = 'user_stats'
+    __table_args__ = (
+        Index('ux_user_stats_monday_cid_uid', 'stats_monday', 'cid', 'uid', unique=True),
+    )
 
     id = Column('id', Integer, primary_key=True)
     stats_monday = Column('stats_monday', DateTime)
@@ -103,11 +110,27 @@ class UserStatDB(Base):
             top_domain=obj.top_domain
         )
 
+    key_columns = ['stats_monday', 'cid', 'uid']
+
+    @staticmethod
+    def get_values(obj) -> dict:
+        return {column.key: getattr(obj, column.key) for column in UserStatDB.__table__.columns
+                if column.key != 'id'}
+
+    @staticmethod
+    def is_counter(key: str) -> bool:
+        return key.endswith('_count') or key.endswith('_duration')
+
     @staticmethod
     @retry(logger=logger)
     def add(added_stat: 'UserStat') -> None:
+        # если строка уже есть (ее успели добавить параллельно), то прибавляем к ней счетчики
+        values = UserStatDB.get_values(added_stat)
+        update = {key: getattr(UserStatDB, key) + value for key, value in values.items()
+                  if UserStatDB.is_counter(key) and value}
+        update['last_activity'] = values['last_activity']
         try:
-            add_to_db(UserStatDB.copy(added_stat))
+            upsert(UserStatDB, values, UserStatDB.key_columns, update)
         except Exception as e:
             logger.error(e)
             raise Exception(f"Can't add userstat {added_stat.uid} to DB")
@@ -115,34 +138,250 @@ class UserStatDB(Base):
     @staticmethod
     @retry(logger=logger)
     def update_db(added_stat: 'UserStat', update) -> None:
+        """
+        Обновляет строку одним запросом. Если ее нет в бд, то добавляет уже обновленной.
+        Статистику добавляем даже по тем, кого нет в таблицах User|ChatUser.
+        """
+        if not update:
+            return
+        values = UserStatDB.get_values(added_stat)
+        values.update(update)
         try:
-            with session_scope() as db:
-                user_stat = db.query(UserStatDB).filter(
-                    UserStatDB.stats_monday == added_stat.stats_monday,
-                    UserStatDB.cid == added_stat.cid,
-                    UserStatDB.uid == added_stat.uid)
-                if user_stat.update(update) > 0:
-                    return
-
-            logger.error(
-                f'[userstat.update] user {added_stat.uid}:{added_stat.cid} not found in DB')
-
-            # update возвращает 0 если объекта нет в бд
-            # тогда мы добавляем его в бд и еще раз пробуем обновить
-            # статистику добавляем даже по тем, кого нет в таблицах User|ChatUser
-            add_to_db(UserStatDB.copy(added_stat))
-            with session_scope() as db:
-                user_stat = db.query(UserStatDB).filter(
-                    UserStatDB.stats_monday == added_stat.stats_monday,
-                    UserStatDB.cid == added_stat.cid,
-                    UserStatDB.uid == added_stat.uid)
-                user_stat.update(update)
+            upsert(UserStatDB, values, UserStatDB.key_columns, update)
         except Exception as e:
             logger.error(e)
             raise Exception(f"Can't update userstat {added_stat.uid}:{added_stat.cid} to DB")
 
 
-class UserStat:
+class UserStatMonthlyDB(Base):
+    __tablename__ = 'user_stats_monthly'
+
+    # CREATE TABLE `user_stats_monthly` (
+    # 	`cid` BIGINT(20) NOT NULL,
+    # 	`uid` BIGINT(20) NOT NULL,
+    # 	`month` INT(11) NOT NULL,
+    # 	`all_messages_count` INT(11) NOT NULL DEFAULT '0',
+    # 	PRIMARY KEY (`cid`, `month`, `uid`)
+    # )
+
+    cid = Column('cid', BigInteger, primary_key=True)
+    month = Column('month', Integer, primary_key=True)  # 201705
+    uid = Column('uid', BigInteger, primary_key=True)
+    all_messages_count = Column('all_messages_count', Integer, default=0)
+
+
+class UserStatYearlyDB(Base):
+    __tablename__ = 'user_stats_yearly'
+
+    # CREATE TABLE `user_stats_yearly` (
+    # 	`cid` BIGINT(20) NOT NULL,
+    # 	`uid` BIGINT(20) NOT NULL,
+    # 	`year` INT(11) NOT NULL,
+    # 	`all_messages_count` INT(11) NOT NULL DEFAULT '0',
+    # 	PRIMARY KEY (`cid`, `year`, `uid`)
+    # )
+
+    cid = Column('cid', BigInteger, primary_key=True)
+    year = Column('year', Integer, primary_key=True)
+    uid = Column('uid', BigInteger, primary_key=True)
+    all_messages_count = Column('all_messages_count', Integer, default=0)
+
+
+class UserStatRollup:
+    """
+    Помесячные и годовые суммы сообщений юзеров, чтобы годовой топ не собирать из всех недель.
+
+    Неделя целиком относится к месяцу своего понедельника — и при обновлении на лету, и при
+    пересборке (`backfill`), поэтому они сходятся. На лету бд не трогается: прибавки копятся
+    в хэше редиса (поле `cid:uid:месяц`), а в таблицы их переносит задача `flush`.
+    """
+    pending_key = 'userstat_rollups:pending'
+    flushing_key = 'userstat_rollups:flushing'
+    # общий лок `flush` и `backfill` во всех процессах
+    lock_key = 'userstat_rollups:lock'
+    flush_interval = 60
+
+    @classmethod
+    def add(cls, cid: int, uid: int, monday: datetime, count: int) -> None:
+        pure_cache.incr_hash_field(cls.pending_key, f'{cid}:{uid}:{cls.__get_month(monday)}',
+                                   count)
+
+    @classmethod
+    def flush(cls) -> int:
+        """
+        Переносит накопленные прибавки в бд. Возвращает количество записей. Пока идет
+        пересборка, ничего не делает: прибавки подождут в редисе.
+        """
+        owner = str(uuid.uuid4())
+        if not pure_cache.acquire_lease(cls.lock_key, owner, 10 * 60):
+            return 0
+        try:
+            pending = pure_cache.take_hash(cls.pending_key, cls.flushing_key)
+            months: typing.Dict[typing.Tuple[int, int, int], int] = {}
+            for field, count in pending.items():
+                cid, uid, month = (int(part) for part in field.split(':'))
+                if int(count) != 0:
+                    months[(cid, month, uid)] = int(count)
+            with session_scope() as db:
+                for (cid, month, uid), count in sorted(months.items()):
+                    db.execute(cls.__increment(UserStatMonthlyDB, UserStatMonthlyDB.month,
+                                               month, cid, uid, count))
+                for (cid, year, uid), count in sorted(cls.__sum_years(months).items()):
+                    db.execute(cls.__increment(UserStatYearlyDB, UserStatYearlyDB.year,
+                                               year, cid, uid, count))
+            pure_cache.delete(cls.flushing_key)
+            return len(months)
+        finally:
+            pure_cache.release_lease(cls.lock_key, owner)
+
+    @classmethod
+    def backfill(cls, wait: float = 60) -> int:
+        """
+        Пересобирает таблицы из всей недельной статы. Возвращает количество обработанных
+        недельных записей.
+        """
+        owner = str(uuid.uuid4())
+        deadline = time.monotonic() + wait
+        while not pure_cache.acquire_lease(cls.lock_key, owner, 60 * 60):
+            if time.monotonic() > deadline:
+                raise Exception("Can't rebuild rollups: they are being flushed")
+            time.sleep(1)
+        try:
+            months: typing.Dict[typing.Tuple[int, int, int], int] = {}
+            rows_count = 0
+            with session_scope() as db:
+                # первое чтение фиксирует снимок бд (repeatable read). Под локом записи
+                # недельной статы: все, что попало в снимок, из прибавок выбрасываем, а все,
+                # что записано позже, прибавится при следующем flush
+                with UserStat.add_lock:
+                    db.query(UserStatDB.id).limit(1).all()
+                    pure_cache.delete(cls.pending_key)
+                    pure_cache.delete(cls.flushing_key)
+                q = db.query(UserStatDB.cid, UserStatDB.uid, UserStatDB.stats_monday,
+                             UserStatDB.all_messages_count) \
+                    .filter(UserStatDB.all_messages_count > 0) \
+                    .yield_per(10000)
+                for cid, uid, monday, count in q:
+                    rows_count += 1
+                    month_key = (cid, cls.__get_month(monday), uid)
+                    months[month_key] = months.get(month_key, 0) + count
+
+                db.query(UserStatMonthlyDB).delete()
+                db.query(UserStatYearlyDB).delete()
+                db.bulk_insert_mappings(UserStatMonthlyDB, [
+                    {'cid': cid, 'month': month, 'uid': uid, 'all_messages_count': count}
+                    for (cid, month, uid), count in months.items()])
+                db.bulk_insert_mappings(UserStatYearlyDB, [
+                    {'cid': cid, 'year': year, 'uid': uid, 'all_messages_count': count}
+                    for (cid, year, uid), count in cls.__sum_years(months).items()])
+            return rows_count
+        finally:
+            pure_cache.release_lease(cls.lock_key, owner)
+
+    @staticmethod
+    def __get_month(monday: datetime) -> int:
+        return monday.year * 100 + monday.month
+
+    @staticmethod
+    def __sum_years(months: typing.Dict[typing.Tuple[int, int, int], int]) \
+            -> typing.Dict[typing.Tuple[int, int, int], int]:
+        years: typing.Dict[typing.Tuple[int, int, int], int] = {}
+        for (cid, month, uid), count in months.items():
+            year_key = (cid, month // 100, uid)
+            years[year_key] = years.get(year_key, 0) + count
+        return years
+
+    @staticmethod
+    def __increment(model, period_column, period: int, cid: int, uid: int, count: int):
+        return upsert_statement(
+            model,
+            {'cid': cid, period_column.key: period, 'uid': uid, 'all_messages_count': count},
+            ['cid', period_column.key, 'uid'],
+            {'all_messages_count': model.all_messages_count + count})
+
+    @staticmethod
+    def get_year(cid: int, year: int) -> typing.List[typing.Tuple[int, int]]:
+        """
+        Юзеры и их количество сообщений за год, по убыванию.
+        """
+        return fetch_all(select(UserStatYearlyDB.uid, UserStatYearlyDB.all_messages_count)
+                         .where(UserStatYearlyDB.cid == cid, UserStatYearlyDB.year == year,
+                                UserStatYearlyDB.all_messages_count > 0)
+                         .order_by(UserStatYearlyDB.all_messages_count.desc()))
+
+    @staticmethod
+    def get_month(cid: int, year: int, month: int) -> typing.List[typing.Tuple[int, int]]:
+        return fetch_all(select(UserStatMonthlyDB.uid, UserStatMonthlyDB.all_messages_count)
+                         .where(UserStatMonthlyDB.cid == cid,
+                                UserStatMonthlyDB.month == year * 100 + month,
+                                UserStatMonthlyDB.all_messages_count > 0)
+                         .order_by(UserStatMonthlyDB.all_messages_count.desc()))
+
+
+# счетчики, которые складываются при каждом новом сообщении. Порядок фиксирован: он же
+# используется в бинарном формате `UserStat.to_bytes`
+COUNTER_FIELDS = (
+    'all_messages_count',
+    'sent_replies_count',
+    'received_replies_count',
+    'forwards_count',
+    'text_messages_count',
+    'text_messages_with_obscene_count',
+    'audios_count',
+    'documents_count',
+    'gifs_count',
+    'photos_count',
+    'stickers_count',
+    'videos_count',
+    'video_notes_count',
+    'video_notes_duration',
+    'voices_count',
+    'voices_duration',
+    'games_count',
+    'sent_mentions_count',
+    'received_mentions_count',
+    'hashtags_count',
+    'bot_commands_count',
+    'urls_count',
+    'emails_count',
+    'words_count',
+    'obscene_words_count',
+    'chars_count',
+    'chars_wo_space_count',
+    'emoji_count',
+)
+
+_NONE_INT = -2 ** 63  # так в бинарном формате записывается None у целых полей
+_NONE_STR = 0xFFFF
+_DT_NONE, _DT_NAIVE, _DT_UTC = 0, 1, 2
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_UTC = _EPOCH.replace(tzinfo=timezone.utc)
+# id, uid, cid; stats_monday; last_activity; счетчики; score; длина top_domain
+_USERSTAT_STRUCT = struct.Struct(f'<qqqBqBq{len(COUNTER_FIELDS)}iqH')
+
+
+def _pack_datetime(value: typing.Optional[datetime]) -> typing.Tuple[int, int]:
+    if value is None:
+        return _DT_NONE, 0
+    if value.tzinfo is None:
+        return _DT_NAIVE, (value - _EPOCH) // timedelta(microseconds=1)
+    return _DT_UTC, (value - _EPOCH_UTC) // timedelta(microseconds=1)
+
+
+def _unpack_datetime(kind: int, micros: int) -> typing.Optional[datetime]:
+    if kind == _DT_NONE:
+        return None
+    epoch = _EPOCH if kind == _DT_NAIVE else _EPOCH_UTC
+    return epoch + timedelta(microseconds=micros)
+
+
+def _userstat_from_bytes(data: bytes) -> 'UserStat':
+    return UserStat.from_bytes(data)
+
+
+class UserStat(SlotsState):
+    __slots__ = ('id', 'stats_monday', 'uid', 'cid', 'last_activity') + COUNTER_FIELDS + \
+                ('score', 'top_domain')
     add_lock = Lock()
     get_lock = Lock()
 
@@ -262,6 +501,70 @@ class UserStat:
             top_domain=userstat.top_domain,
         )
 
+    def __reduce__(self):
+        return _userstat_from_bytes, (self.to_bytes(),)
+
+    def to_bytes(self) -> bytes:
+        """
+        Компактный бинарный формат с фиксированным порядком полей. В нем стата лежит в редисе.
+        """
+        def int_or_none(value):
+            return _NONE_INT if value is None else value
+
+        top_domain = b'' if self.top_domain is None else self.top_domain.encode('utf-8')
+        return _USERSTAT_STRUCT.pack(
+            int_or_none(self.id), int_or_none(self.uid), int_or_none(self.cid),
+            *_pack_datetime(self.stats_monday),
+            *_pack_datetime(self.last_activity),
+            *(getattr(self, key) or 0 for key in COUNTER_FIELDS),
+            int_or_none(self.score),
+            _NONE_STR if self.top_domain is None else len(top_domain),
+        ) + top_domain
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'UserStat':
+        values = _USERSTAT_STRUCT.unpack_from(data)
+        stat_id, uid, cid, monday_kind, monday, activity_kind, activity = values[:7]
+        counters = values[7:-2]
+        score, top_domain_len = values[-2:]
+        stat = cls.__new__(cls)
+        stat.id = None if stat_id == _NONE_INT else stat_id
+        stat.uid = None if uid == _NONE_INT else uid
+        stat.cid = None if cid == _NONE_INT else cid
+        stat.stats_monday = _unpack_datetime(monday_kind, monday)
+        stat.last_activity = _unpack_datetime(activity_kind, activity)
+        for key, value in zip(COUNTER_FIELDS, counters):
+            setattr(stat, key, value)
+        stat.score = None if score == _NONE_INT else score
+        if top_domain_len == _NONE_STR:
+            stat.top_domain = None
+        else:
+            offset = _USERSTAT_STRUCT.size
+            stat.top_domain = data[offset:offset + top_domain_len].decode('utf-8')
+        return stat
+
+    def get_counters(self) -> typing.Tuple[int, ...]:
+        return tuple(getattr(self, key) or 0 for key in COUNTER_FIELDS)
+
+    def add_counters(self, other: 'UserStat') -> typing.Dict[str, int]:
+        """
+        Прибавляет положительные счетчики `other`. Возвращает измененные поля с новыми значениями.
+        """
+        changed = {}
+        for key, old_value, new_value in zip(COUNTER_FIELDS, self.get_counters(),
+                                             other.get_counters()):
+            if new_value > 0:
+                changed[key] = old_value + new_value
+                setattr(self, key, changed[key])
+        return changed
+
+    @classmethod
+    def from_row(cls, row) -> 'UserStat':
+        """
+        Из строки select'а по колонкам таблицы user_stats.
+        """
+        return UserStat(**row._mapping)
+
     @classmethod
     def add(cls, added_stat: 'UserStat') -> None:
         if added_stat.uid == bot_id():
@@ -279,11 +582,18 @@ class UserStat:
                 if old_stat is not None:
                     updated_stat = cls.__update(old_stat, added_stat)
                     cache.set(key, updated_stat, time=USER_CACHE_EXPIRE)
-                    return
-                UserStatDB.add(added_stat)
-                cache.set(key, added_stat, time=USER_CACHE_EXPIRE)
+                else:
+                    UserStatDB.add(added_stat)
+                    cache.set(key, added_stat, time=USER_CACHE_EXPIRE)
             except Exception as e:
                 logger.error(e)
+                return
+            if added_stat.all_messages_count > 0:
+                # только счетчик в редисе: в бд его перенесет UserStatRollup.flush
+                try:
+                    UserStatRollup.add(cid, uid, monday, added_stat.all_messages_count)
+                except Exception as e:
+                    logger.error(e)
 
     @classmethod
     def get(cls, monday, uid, cid) -> typing.Optional['UserStat']:
@@ -294,17 +604,15 @@ class UserStat:
         # лок, чтобы в редис попали точно такие же данные, как в бд
         with cls.get_lock:
             try:
-                with session_scope() as db:
-                    q = db.query(UserStatDB) \
-                        .filter(UserStatDB.stats_monday == monday,
-                                UserStatDB.cid == cid,
-                                UserStatDB.uid == uid) \
-                        .limit(1) \
-                        .all()
-                    if q:
-                        userstat = cls.copy(q[0])
-                        cache.set(cls.__get_cache_key(monday, uid, cid), userstat)
-                        return userstat
+                row = fetch_first(select(UserStatDB.__table__)
+                                  .where(UserStatDB.stats_monday == monday,
+                                         UserStatDB.cid == cid,
+                                         UserStatDB.uid == uid)
+                                  .limit(1))
+                if row is not None:
+                    userstat = cls.from_row(row)
+                    cache.set(cls.__get_cache_key(monday, uid, cid), userstat)
+                    return userstat
             except Exception as e:
                 logger.error(e)
         return None
@@ -453,78 +761,65 @@ class UserStat:
     @classmethod
     def get_chat_stats(cls, cid, date=None):
         last_monday = get_current_monday() if date is None else get_date_monday(date)
+        stat_columns = list(UserStatDB.__table__.columns)
+        user_columns = [UserDB.id, UserDB.username, UserDB.fullname, UserDB.public, UserDB.female]
         try:
-            with session_scope() as db:
-                # noinspection PyUnresolvedReferences
-                q = db.query(UserStatDB, UserDB) \
-                    .filter(UserStatDB.stats_monday == last_monday) \
-                    .filter(UserStatDB.uid == UserDB.uid) \
-                    .filter(UserStatDB.cid == cid) \
-                    .filter(UserStatDB.all_messages_count > 0) \
-                    .order_by(UserStatDB.all_messages_count.desc()) \
-                    .all()
-            return [(UserStat.copy(userstat), User.copy(user)) for userstat, user in q]
+            rows = fetch_all(select(*stat_columns, *user_columns)
+                             .where(UserStatDB.stats_monday == last_monday,
+                                    UserStatDB.uid == UserDB.uid,
+                                    UserStatDB.cid == cid,
+                                    UserStatDB.all_messages_count > 0)
+                             .order_by(UserStatDB.all_messages_count.desc()))
         except Exception:
             return []
+        # колонки идут по порядку: сначала стата, потом юзер
+        stat_keys = [column.key for column in stat_columns]
+        split = len(stat_keys)
+        result = []
+        for row in rows:
+            userstat = UserStat(**dict(zip(stat_keys, row[:split])))
+            user_id, username, fullname, public, female = row[split:]
+            result.append((userstat, User(id=user_id, uid=userstat.uid, username=username,
+                                          fullname=fullname, public=public, female=female)))
+        return result
 
     @classmethod
     def get_chat_year(cls, cid: int, year: int):
-        def get_year_all_msg_count():
-            try:
-                with session_scope() as db:
-                    q = db.query(func.sum(UserStatDB.all_messages_count)) \
-                        .filter(UserStatDB.last_activity >= datetime(year, 1, 1)) \
-                        .filter(UserStatDB.last_activity < datetime(year + 1, 1, 1)) \
-                        .filter(UserStatDB.cid == cid) \
-                        .all()[0][0]
-                if q is None:
-                    return 0
-            except Exception as e:
-                logger.error(e)
-                return 0
-            count = int(q)
-            return count
-
-        top_chart = ''
-        uids = []
-        all_msg_count = get_year_all_msg_count()
+        try:
+            q = UserStatRollup.get_year(cid, year)
+        except Exception as e:
+            logger.error(e)
+            q = []
+        return cls.__format_rollup(q)
 
-        q = []
+    @classmethod
+    def get_chat_month(cls, cid: int, year: int, month: int):
         try:
-            with session_scope() as db:
-                # noinspection PyUnresolvedReferences
-                q = db.execute(f"""
-SELECT `uid`, SUM(`all_messages_count`) AS `count`
-FROM `user_stats`
-WHERE `last_activity` >= '{year}-01-01'
-  AND `last_activity` < '{year + 1}-01-01'
-  AND `cid` = {cid}
-  AND `all_messages_count` > 0
-GROUP BY `uid`
-ORDER BY `count` DESC
-                """)
-                q = [(r[0], int(r[1])) for r in q]
+            q = UserStatRollup.get_month(cid, year, month)
         except Exception as e:
             logger.error(e)
+            q = []
+        return cls.__format_rollup(q)
+
+    @classmethod
+    def __format_rollup(cls, q: typing.List[typing.Tuple[int, int]]):
         if len(q) == 0:
             return {'users_count': 0, 'top_chart': '', 'msg_count': 0, 'percent': 0, 'uids': []}
 
-        user_position = 0
-        asc_msg_count = 0
-        q_all_length = len(q)  # if type(q) is list else len(q.all())
-        for uid, count in q:
-            user_position += 1
-            asc_msg_count += count
+        top_chart = ''
+        uids = []
+        all_msg_count = sum(count for _, count in q)
+        users = User.get_many(uid for uid, _ in q)
+        for user_position, (uid, count) in enumerate(q, start=1):
             raw_percent = count * 100 / all_msg_count
             percent = cls.number_format(raw_percent, 2)
-            user = User.get(uid)
+            user = users.get(uid)
             name = user.fullname if user else uid
             top_chart += f"{user_position}. {name} — {count} ({percent}%)\n"
             uids.append(uid)
 
-        users_count = q_all_length
         return {
-            'users_count': users_count,
+            'users_count': len(q),
             'top_chart': top_chart,
             'msg_count': all_msg_count,
             'uids': uids
@@ -538,22 +833,9 @@ ORDER BY `count` DESC
         top_chart = ''
         uids = []
         last_monday = get_current_monday() if date is None else get_date_monday(date)
-        all_msg_count = cls.__get_all_msg_count(last_monday, cid)
-
-        q = []
-        try:
-            with session_scope() as db:
-                # noinspection PyUnresolvedReferences
-                q = db.query(UserStatDB, UserDB) \
-                    .filter(UserStatDB.stats_monday == last_monday) \
-                    .filter(UserStatDB.uid == UserDB.uid) \
-                    .filter(UserStatDB.cid == cid) \
-                    .filter(UserStatDB.all_messages_count > 0) \
-                    .order_by(UserStatDB.all_messages_count.desc()) \
-                    .all()
-                q = [(UserStat.copy(userstat), User.copy(user)) for userstat, user in q]
-        except Exception as e:
-            logger.error(e)
+        ranking = WeeklyRankingSnapshot.get(cid, last_monday)
+        all_msg_count = ranking.msg_count
+        q = ranking.rows
         if len(q) == 0:
             return {'users_count': 0, 'top_chart': '', 'msg_count': 0, 'percent': 0, 'uids': []}
 
@@ -562,20 +844,17 @@ ORDER BY `count` DESC
         if salo:
             q = q[::-1]
 
-        magic_percent = 100
         q_all_length = len(q)  # if type(q) is list else len(q.all())
-        #if not salo and q_all_length > 25:
-            #magic_percent = 146
 
-        for user_stat, user in q:
-            count = user_stat.all_messages_count
+        for row in q:
+            count = row.all_messages_count
             user_position += 1
             asc_msg_count += count
-            raw_percent = count * magic_percent / all_msg_count
-            percent = cls.number_format(raw_percent, 2)
-            user_mat = '' if not mat else cls.__get_user_mat(user_stat)
-            top_chart += f"<b>{user_position}. {user.fullname}</b> — <b>{count}</b> ({percent}%){user_mat}\n"
-            uids.append(user.uid)
+            percent = cls.number_format(row.percent, 2)
+            user_mat = '' if not mat else cls.__get_user_mat(row)
+            top_chart += f"<b>{user_position}. {row.fullname}</b> — <b>{count}</b> " \
+                         f"({percent}%){user_mat}\n"
+            uids.append(row.uid)
             if not fullstat and user_position >= CONFIG['top_users_num']:
                 break
             if salo and count > 15:
@@ -585,16 +864,11 @@ ORDER BY `count` DESC
             users_count = q_all_length
         else:
             users_count = user_position
-            all_users: typing.List[ChatUser] = []
-            try:
-                all_users = ChatUserDB.get_all(cid)
-            except Exception as e:
-                logger.error(e)
-            active_user_ids = [x.uid for _, x in q]
+            active_user_ids = {row.uid for row in q}
             silent_lines = []
-            for chat_user in all_users:
-                if chat_user.uid not in active_user_ids:
-                    user = User.get(chat_user.uid)
+            for uid in sorted(ChatUser.get_all_uids(cid)):
+                if uid not in active_user_ids:
+                    user = User.get(uid)
                     if user is not None:
                         username_if_salo = ' @{}'.format(user.username) if tag_salo else ''
                         silent_lines.append("<b>{}</b>{}\n".format(user.fullname, username_if_salo))
@@ -630,32 +904,32 @@ ORDER BY `count` DESC
         msg = f'. Мат: {obscene_count} ({msg_percent}%)'
         return msg
 
+    @classmethod
+    def get_activity_weights(cls, cid: int) -> typing.Dict[int, float]:
+        """
+        Веса для `ChatUser.get_random`: чем больше юзер пишет на этой неделе, тем чаще выпадает.
+        """
+        try:
+            ranking = WeeklyRankingSnapshot.get(cid, get_current_monday())
+        except Exception as e:
+            logger.error(e)
+            return {}
+        return {row.uid: row.all_messages_count + 1 for row in ranking.rows}
+
     @classmethod
     def get_user_position(cls, user_id, cid, date):
         position = -1
         msg_count = 0
         last_monday = get_current_monday() if date is None else get_date_monday(date)
 
-        try:
-            with session_scope() as db:
-                # noinspection PyUnresolvedReferences
-                q = db.query(UserStatDB, UserDB) \
-                    .filter(UserStatDB.stats_monday == last_monday) \
-                    .filter(UserStatDB.uid == UserDB.uid) \
-                    .filter(UserStatDB.cid == cid) \
-                    .filter(UserStatDB.all_messages_count > 0) \
-                    .order_by(UserStatDB.all_messages_count.desc()) \
-                    .all()
-                q = [(UserStat.copy(userstat), User.copy(user)) for userstat, user in q]
-            if q:
-                position = 0
-                for userstat, user in q:
-                    position += 1
-                    if userstat.uid == user_id:
-                        msg_count = userstat.all_messages_count
-                        break
-        except Exception as e:
-            logger.error(e)
+        rows = WeeklyRankingSnapshot.get(cid, last_monday).rows
+        if rows:
+            position = 0
+            for row in rows:
+                position += 1
+                if row.uid == user_id:
+                    msg_count = row.all_messages_count
+                    break
         return {
             'position': position,
             'msg_count': msg_count
@@ -668,20 +942,20 @@ ORDER BY `count` DESC
         """
         last_monday = get_current_monday() if date is None else get_date_monday(date)
         try:
-            with session_scope() as db:
-                # noinspection PyUnresolvedReferences
-                q = db.query(UserStatDB, UserDB) \
-                    .filter(UserStatDB.stats_monday == last_monday) \
-                    .filter(UserStatDB.uid == UserDB.uid) \
-                    .filter(UserStatDB.cid == cid) \
-                    .filter(or_(
-                        UserStatDB.emoji_count > 0,
-                        UserStatDB.stickers_count > 0,
-                        UserStatDB.gifs_count > 0
-                    )) \
-                    .order_by(UserStatDB.emoji_count.desc()) \
-                    .all()
-                q = [(UserStat.copy(userstat), User.copy(user)) for userstat, user in q]
+            # noinspection PyUnresolvedReferences
+            q = fetch_all(select(UserStatDB.uid,
+                                 UserStatDB.all_messages_count,
+                                 UserStatDB.words_count,
+                                 UserStatDB.emoji_count)
+                          .where(UserStatDB.stats_monday == last_monday,
+                                 UserStatDB.uid == UserDB.uid,
+                                 UserStatDB.cid == cid,
+                                 or_(
+                                     UserStatDB.emoji_count > 0,
+                                     UserStatDB.stickers_count > 0,
+                                     UserStatDB.gifs_count > 0
+                                 ))
+                          .order_by(UserStatDB.emoji_count.desc()))
             if not q:
                 return None
         except Exception as e:
@@ -690,45 +964,20 @@ ORDER BY `count` DESC
 
         # получаем соотношение количества эмодзи к сообщениям
         users_by_emoji = {}
-        for user_stat, user in q:
-            count = user_stat.all_messages_count
+        for uid, count, words_count, emoji_count in q:
             # учитываем только тек, кто написал от 30 сообщений
-            if count < 30 or user_stat.words_count < 500:
+            if count < 30 or words_count < 500:
                 continue
-            users_by_emoji[user.uid] = user_stat.emoji_count / count
+            users_by_emoji[uid] = emoji_count / count
 
         if len(users_by_emoji) > 0:
             uid, _ = random.choice(sort_dict(users_by_emoji)[:10])
         else:
-            _, user = random.choice(q)
-            uid = user.uid
+            uid = random.choice(q)[0]
         logger.info(f"kroshka {cid}:{uid}")
         user = User.get(uid)
         return user
 
-    @staticmethod
-    def __get_all_msg_count(monday, cid):
-        # key = 'all_msg_{}_{}'.format(monday.strftime("%Y%m%d"), cid)
-        # cached = cache.get(key)
-        # if cached is not None:
-        #     return int(cached)
-
-        try:
-            with session_scope() as db:
-                q = db.query(func.sum(UserStatDB.all_messages_count)) \
-                    .filter(UserStatDB.stats_monday == monday) \
-                    .filter(UserStatDB.cid == cid) \
-                    .all()[0][0]
-            if q is None:
-                # cache.set(key, str(0), time=USER_CACHE_EXPIRE)
-                return 0
-        except Exception as e:
-            logger.error(e)
-            return 0
-        count = int(q)
-        # cache.set(key, str(count), time=USER_CACHE_EXPIRE)
-        return count
-
     @staticmethod
     def __update(old_stat, added_stat):
         update = {}
@@ -742,16 +991,7 @@ ORDER BY `count` DESC
             old_stat.top_domain = added_stat.top_domain
             update['top_domain'] = added_stat.top_domain
 
-        for key in old_stat.__dict__.keys():
-            if key.startswith('_'):
-                continue
-            if not key.endswith('_count') and not key.endswith('_duration'):
-                continue
-            old_value = getattr(old_stat, key, 0)
-            new_value = getattr(added_stat, key, 0)
-            if new_value > 0:
-                update[key] = old_value + new_value
-                setattr(old_stat, key, update[key])
+        update.update(old_stat.add_counters(added_stat))
 
         try:
             UserStatDB.update_db(added_stat, update)
@@ -892,6 +1132,122 @@ ORDER BY `count` DESC
         return f'userstat:{monday.strftime("%Y%m%d")}:{cid}:{uid}'
 
 
+class WeeklyRankingRow(typing.NamedTuple):
+    uid: int
+    fullname: str
+    all_messages_count: int
+    percent: float  # процент от всех сообщений чата за неделю
+    text_messages_count: int
+    text_messages_with_obscene_count: int
+    words_count: int
+    obscene_words_count: int
+
+
+class WeeklyRanking:
+    """
+    Недельный рейтинг чата: юзеры по убыванию количества сообщений и общее количество сообщений.
+    """
+
+    def __init__(self, monday: datetime, cid: int, rows: typing.List[WeeklyRankingRow],
+                 msg_count: int, built_at: float, frozen: bool) -> None:
+        self.monday = monday
+        self.cid = cid
+        self.rows = rows
+        self.msg_count = msg_count
+        self.built_at = built_at
+        self.frozen = frozen  # неделя закончилась, рейтинг больше не изменится
+
+    def __repr__(self) -> str:
+        return f"<WeeklyRanking('{self.monday}', '{self.cid}', '{self.msg_count}')>"
+
+
+class WeeklyRankingSnapshot:
+    """
+    Готовые недельные рейтинги чатов в редисе. Из них отвечают `/top`, `/all`, `/silent`, `/whois`
+    и недельная стата, вместо того чтобы каждый раз ходить в мускул.
+
+    Рейтинг собирается при чтении, если он старше `max_age`, и только одним потоком на чат:
+    остальные в это время получают устаревший рейтинг, а если его нет — ждут сборки. Чаты,
+    где рейтинг никто не смотрит, мускул не нагружают. Рейтинг прошедшей недели собирается
+    один раз и замораживается.
+    """
+    max_age = 2 * 60  # секунд
+    __locks: typing.Dict[int, Lock] = {}
+    __locks_lock = Lock()
+
+    @classmethod
+    def get(cls, cid: int, monday: datetime) -> WeeklyRanking:
+        # дата из сообщения телеграма с таймзоной, а get_current_monday() — без
+        monday = monday.replace(tzinfo=None)
+        cached: typing.Optional[WeeklyRanking] = cache.get(cls.__get_cache_key(monday, cid))
+        if cached is not None and cls.__is_fresh(cached):
+            return cached
+        lock = cls.__get_lock(cid)
+        if not lock.acquire(blocking=cached is None):
+            return cached
+        try:
+            # пока ждали лок, рейтинг мог собрать другой поток
+            cached = cache.get(cls.__get_cache_key(monday, cid))
+            if cached is not None and cls.__is_fresh(cached):
+                return cached
+            return cls.build(cid, monday)
+        finally:
+            lock.release()
+
+    @classmethod
+    def build(cls, cid: int, monday: datetime) -> WeeklyRanking:
+        frozen = monday < get_current_monday()
+        built_at = time.time()
+        try:
+            msg_count = fetch_first(select(func.sum(UserStatDB.all_messages_count))
+                                    .where(UserStatDB.stats_monday == monday,
+                                           UserStatDB.cid == cid))[0]
+            # noinspection PyUnresolvedReferences
+            q = fetch_all(select(UserStatDB.uid,
+                                 UserDB.fullname,
+                                 UserStatDB.all_messages_count,
+                                 UserStatDB.text_messages_count,
+                                 UserStatDB.text_messages_with_obscene_count,
+                                 UserStatDB.words_count,
+                                 UserStatDB.obscene_words_count)
+                          .where(UserStatDB.stats_monday == monday,
+                                 UserStatDB.uid == UserDB.uid,
+                                 UserStatDB.cid == cid,
+                                 UserStatDB.all_messages_count > 0)
+                          .order_by(UserStatDB.all_messages_count.desc()))
+        except Exception as e:
+            logger.error(e)
+            return WeeklyRanking(monday, cid, [], 0, built_at, False)
+
+        msg_count = 0 if msg_count is None else int(msg_count)
+        rows = [WeeklyRankingRow(uid, fullname, count, count * 100 / msg_count,
+                                 text_count, text_obscene_count, words_count, obscene_words_count)
+                for uid, fullname, count, text_count, text_obscene_count, words_count,
+                    obscene_words_count in q]
+        ranking = WeeklyRanking(monday, cid, rows, msg_count, built_at, frozen)
+        cache.set(cls.__get_cache_key(monday, cid), ranking,
+                  time=MONTH if frozen else USER_CACHE_EXPIRE)
+        return ranking
+
+    @classmethod
+    def __is_fresh(cls, ranking: WeeklyRanking) -> bool:
+        if ranking.frozen:
+            return True
+        # незамороженный рейтинг прошедшей недели мог не увидеть ее последние сообщения
+        if ranking.monday < get_current_monday():
+            return False
+        return time.time() - ranking.built_at < cls.max_age
+
+    @classmethod
+    def __get_lock(cls, cid: int) -> Lock:
+        with cls.__locks_lock:
+            return cls.__locks.setdefault(cid, Lock())
+
+    @staticmethod
+    def __get_cache_key(monday: datetime, cid: int) -> str:
+        return f'userstat_ranking:{monday.strftime("%Y%m%d")}:{cid}'
+
+
 class UserDomains:
     lock = Lock()
 
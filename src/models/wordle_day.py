@@ -5,12 +5,12 @@ from typing import Optional, List
 
 import telegram
 from sqlalchemy import Column, Integer, BigInteger, Boolean
-from telegram.ext import run_async
 
 from src.models.user import User
 from src.utils.cache import bot_id
-from src.utils.db import Base, add_to_db, session_scope, retry
+from src.utils.db import Base, session_scope, retry, upsert
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
+from src.utils.lanes import interactive_lane
 from src.utils.logger_helpers import get_logger
 from src.utils.telegram_helpers import send_long
 
@@ -62,12 +62,11 @@ class WordleDayDB(Base):
     @retry(logger=logger)
     def add(wordle: WordleDayRecord):
         try:
-            if WordleDayDB.exists(wordle):
-                logger.error(f'Wordle already exists: {wordle}')
-                return
-            add_to_db(WordleDayDB(
-                day=wordle.day, uid=wordle.user_id, attempts=wordle.attempts, won=wordle.won
-            ))
+            # если запись уже есть, то она остается как была
+            upsert(WordleDayDB,
+                   {'day': wordle.day, 'uid': wordle.user_id, 'attempts': wordle.attempts,
+                    'won': wordle.won},
+                   ['day', 'uid'])
         except Exception as e:
             logger.error(e)
             raise Exception(f"Can't add wordle_day {wordle.user_id} to DB")
@@ -178,7 +177,6 @@ class WordleDay:
     lock = Lock()
 
     @classmethod
-    @run_async
     def check_message(cls, message: telegram.Message) -> None:
         wordle = parse_wordle_message(message)
         if wordle is None:
@@ -258,7 +256,7 @@ def get_user_fullname(uid) -> str:
     return fullname
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -282,7 +280,7 @@ def wordle_stats(bot: telegram.Bot, update: telegram.Update):
     send_long(bot, update.message.chat_id, f"{header}\n\n{body}")
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -10,7 +10,7 @@ from src.modules.antimat.antimat import Antimat
 from src.utils.cache import pure_cache, TWO_YEARS, cache, MONTH
 from src.utils.callback_helpers import get_callback_data
 from src.utils.logger_helpers import get_logger
-from src.utils.telegram_helpers import telegram_retry, dsp
+from src.utils.telegram_helpers import telegram_retry, dsp, Priority
 
 logger = get_logger(__name__)
 CACHE_PREFIX = 'matshowtime'
@@ -202,7 +202,8 @@ class ChannelMessage:
         likes, dislikes = poll.get_count()
         msg.likes = likes
         msg.dislikes = dislikes
-        dsp(cls.__update_buttons_and_answer, bot, msg, query, text)
+        dsp.put(cls.__update_buttons_and_answer, (bot, msg, query, text),
+                chat_id=matshowtime.channel_id, priority=Priority.INTERACTIVE)
 
     @classmethod
     def __update_buttons_and_answer(cls, bot, msg, query, text):
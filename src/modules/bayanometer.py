@@ -15,10 +15,10 @@ import telegram
 from PIL import Image
 from PIL.Image import Resampling
 from pytils.numeral import get_plural
-from telegram.ext import run_async
 
 from src.config import CONFIG
 from src.utils.cache import cache, TWO_DAYS, YEAR, USER_CACHE_EXPIRE
+from src.utils.cache_buckets import BucketedCache
 from src.utils.callback_helpers import get_callback_data
 from src.utils.handlers_helpers import is_command_enabled_for_chat
 from src.utils.telegram_helpers import get_photo_url
@@ -27,6 +27,9 @@ from src.utils.logger_helpers import get_logger
 logger = get_logger(__name__)
 
 KEY_PREFIX = 'bayanometer'
+# хэши картинок по id сообщения: хэш на чат, разбитый на поколения по году
+photo_hashes_cache = BucketedCache(f'{KEY_PREFIX}:photo_hashes', YEAR, generations=True,
+                                   legacy_key=f'{KEY_PREFIX}:photo:{{bucket}}:message_id:{{field}}')
 BAYANOMETER_SHOW_ORIG = 'bayanometer_show_orig'
 
 
@@ -227,7 +230,7 @@ class Photo:
             if photo is None:
                 photo = Photo(message_id, datetime.datetime.now(), user_id)
             cache.set(key, photo, time=YEAR)
-        cache.set(f'{KEY_PREFIX}:photo:{chat_id}:message_id:{message_id}', dict(hashes), time=YEAR)
+        photo_hashes_cache.set(message_id, dict(hashes), bucket=chat_id)
 
     @classmethod
     def __save(cls, url, chat_id, message_id):
@@ -241,7 +244,7 @@ class Photo:
 
     @classmethod
     def __double_check(cls, hashes: List, chat_id: int, message_id: int) -> bool:
-        orig_hashes_dict = cache.get(f'{KEY_PREFIX}:photo:{chat_id}:message_id:{message_id}', {})
+        orig_hashes_dict = photo_hashes_cache.get(message_id, bucket=chat_id, default={})
         hashes_dict = dict(hashes)
 
         def check_hash(hash_method) -> bool:
@@ -432,7 +435,6 @@ class URL:
 
 class Bayanometer:
     @classmethod
-    @run_async
     def check(cls, bot: telegram.Bot, update: telegram.Update) -> None:
         chat_id = update.message.chat_id
         if not is_command_enabled_for_chat(chat_id, 'bayanometer'):
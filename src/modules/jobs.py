@@ -1,21 +1,23 @@
 from datetime import datetime
 
 import telegram
-from telegram.ext import run_async
 
 from src.config import get_config_chats
 from src.dayof.day_manager import DayOfManager
 from src.models.cringe_monthly import send_monthly_cringe_for_chat
+from src.models.chat_user import ChatMembers
 from src.models.leave_collector import LeaveCollector
 from src.models.reply_top import ReplyDumper
+from src.models.user_stat import UserStatRollup
 from src.commands.weather import send_alert_if_full_moon
 from src.modules.rogovdays import send_rogovdays_daily
 from src.utils.cache import pure_cache, FEW_DAYS
 from src.utils.handlers_helpers import is_command_enabled_for_chat
+from src.utils.lanes import heavy_io_lane
 from src.utils.time_helpers import today_str
 
 
-@run_async
+@heavy_io_lane
 def daily_midnight(bot: telegram.Bot, _):
     # особый режим сегодняшнего дня
     DayOfManager.midnight(bot)
@@ -38,7 +40,7 @@ def daily_midnight(bot: telegram.Bot, _):
                 send_monthly_cringe_for_chat(bot, chat_id)
 
 
-@run_async
+@heavy_io_lane
 def daily_afternoon(bot: telegram.Bot, _):
     DayOfManager.afternoon(bot)
 
@@ -47,3 +49,19 @@ def every_hour(bot: telegram.Bot, _) -> None:
     # go_go_watchmen(bot)
     DayOfManager.morning(bot)
     LeaveCollector.check_left_users(bot)
+
+
+def reconcile_chat_members(bot: telegram.Bot, _) -> None:
+    """
+    Сверяет участников чатов в редисе с бд.
+    """
+    for chat in get_config_chats():
+        if chat.chat_id < 0:
+            ChatMembers.reconcile(chat.chat_id)
+
+
+def flush_user_stat_rollups(bot: telegram.Bot, _) -> None:
+    """
+    Переносит накопленные в редисе прибавки помесячной и годовой статы в бд.
+    """
+    UserStatRollup.flush()
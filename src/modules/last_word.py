@@ -1,21 +1,22 @@
 import telegram
-from telegram.ext import run_async
 
-from src.utils.cache import cache, TWO_YEARS
+from src.utils.cache import TWO_YEARS
+from src.utils.cache_buckets import BucketedCache
 from src.utils.logger_helpers import get_logger
 
 logger = get_logger(__name__)
+# последние слова лежат в хэше чата: поле — uid, значение — (message_id, date)
+last_word_cache = BucketedCache('last_word', TWO_YEARS, legacy_key='last_word:{bucket}:{field}')
 
 
-def get_last_word_cache_key(cid, uid) -> str:
-    return f'last_word:{cid}:{uid}'
+def get_last_word(cid, uid):
+    return last_word_cache.get(uid, bucket=cid)
 
 
 def callback_last_word(bot: telegram.Bot, _: telegram.Update, query, data):
     uid = query.from_user.id
     cid = query.message.chat_id
-    msg_ids = [result[0] for result in
-               (cache.get(get_last_word_cache_key(cid, _uid)) for _uid in data['leaves_uid']) if
+    msg_ids = [result[0] for result in last_word_cache.get_many(data['leaves_uid'], bucket=cid) if
                result is not None and isinstance(result, tuple)]
     if len(msg_ids) == 0:
         try:
@@ -35,12 +36,11 @@ def callback_last_word(bot: telegram.Bot, _: telegram.Update, query, data):
             pass
 
 
-@run_async
 def last_word(_: telegram.Bot, update: telegram.Update):
     message = update.message
     left = message.left_chat_member is not None
     join = message.new_chat_members is not None and len(message.new_chat_members) > 0
     if left or join:
         return
-    cache.set(get_last_word_cache_key(update.message.chat_id, update.message.from_user.id),
-              (message.message_id, message.date), time=TWO_YEARS)
+    last_word_cache.set(update.message.from_user.id, (message.message_id, message.date),
+                        bucket=update.message.chat_id)
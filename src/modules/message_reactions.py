@@ -3,7 +3,7 @@ import re
 
 import requests
 import telegram
-from telegram.ext import run_async
+from telegram import MessageEntity
 
 from src.commands.khaleesi.khaleesi import Khaleesi
 from src.commands.khaleesi.random_khaleesi import RandomKhaleesi
@@ -25,10 +25,12 @@ from src.modules.rogovdays import rogovdays_check_message
 from src.modules.threads import process_message_for_threads
 from src.modules.tiktok import process_message_for_tiktok
 from src.modules.twitter import process_message_for_twitter
-from src.utils.cache import cache, TWO_DAYS, USER_CACHE_EXPIRE, pure_cache
-from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
+from src.utils.async_pipeline import AsyncPipeline, Stage
+from src.utils.cache import cache, TWO_DAYS, USER_CACHE_EXPIRE, async_cache, async_pure_cache
+from src.utils.handlers_decorators import chat_guard, collect_message_stats, command_guard
 from src.utils.handlers_helpers import is_command_enabled_for_chat, \
     check_command_is_off
+from src.utils.lanes import passive_lane
 from src.utils.logger_helpers import get_logger
 from src.utils.telegram_helpers import get_sticker_set_fixed
 from src.utils.time_helpers import get_current_monday_str, today_str
@@ -39,20 +41,35 @@ re_gdeleha = re.compile(r"(где л[её]ха|л[её]ха где)[!?.]*\s*$",
 re_suicide = re.compile(r"\S*с[уиаы][иые]ц+[иые][тд]\S*", re.IGNORECASE)
 
 
-@run_async
 @chat_guard
 def message(bot, update):
-    leave_check(bot, update)
-    message_reactions(bot, update)
-    check_photo_reactions(bot, update)
+    """
+    Все обычные сообщения групп. Обработка идет в конвейере, воркер диспетчера сразу свободен.
+    """
+    passive_pipeline.submit(bot, update)
+
+
+def collect_stats_stage(_: telegram.Bot, update: telegram.Update) -> None:
+    collect_message_stats(update.message)
+
+
+def reactions_stage(bot: telegram.Bot, update: telegram.Update) -> None:
+    # на сообщения ботов не реагируем, остальное — для всех сообщений
+    if is_from_human(bot, update):
+        message_reactions(bot, update)
     random_khaleesi(bot, update)
     last_word(bot, update)
     mat_notify(bot, update)
-    Bayanometer.check(bot, update)
+
+
+def links_stage(bot: telegram.Bot, update: telegram.Update) -> None:
     tiktok_video(bot, update)
     instagram_video(bot, update)
     twitter_video(bot, update)
     threads_video(bot, update)
+
+
+def weekly_stage(_: telegram.Bot, update: telegram.Update) -> None:
     PidorWeekly.parse_message(update.message)
     if is_command_enabled_for_chat(update.message.chat_id, 'monthly:cringe'):
         CringeMonthly.parse_message(update.message)
@@ -61,11 +78,25 @@ def message(bot, update):
         rogovdays_check_message(update.effective_message)
     if is_command_enabled_for_chat(update.message.chat_id, 'wordle_day'):
         WordleDay.check_message(update.effective_message)
-    update_stickers(bot, update)
-    pure_cache.incr(f"metrics:messages:{today_str()}")
 
 
-@run_async
+async def count_message(_: telegram.Bot, __: telegram.Update) -> None:
+    await async_pure_cache.incr(f"metrics:messages:{today_str()}")
+
+
+def has_links(_: telegram.Bot, update: telegram.Update) -> bool:
+    return bool(update.message.parse_entities([MessageEntity.URL, MessageEntity.TEXT_LINK]))
+
+
+def has_photos(bot: telegram.Bot, update: telegram.Update) -> bool:
+    return bool(update.message.photo) or has_links(bot, update)
+
+
+def is_from_human(_: telegram.Bot, update: telegram.Update) -> bool:
+    return not update.message.from_user.is_bot
+
+
+@passive_lane
 def send_gdeleha(bot, chat_id, msg_id, user_id):
     if user_id in CONFIG.get('leha_ids', []) or user_id in CONFIG.get('leha_anya', []):
         bot.sendMessage(chat_id, "Леха — это ты!", reply_to_message_id=msg_id)
@@ -90,7 +121,7 @@ def send_gdeleha(bot, chat_id, msg_id, user_id):
     ])
 
 
-@run_async
+@passive_lane
 def send_pidor(bot, update):
     chat_id = update.message.chat_id
     msg_id = update.message.message_id
@@ -106,7 +137,7 @@ def send_pidor(bot, update):
     bot.sendSticker(chat_id, sticker_id, reply_to_message_id=msg_id)
 
 
-@run_async
+@passive_lane
 def send_random_sticker_from_stickerset(bot: telegram.Bot, chat_id: int,
                                         stickerset_name: str) -> None:
     key = f'stickerset:{stickerset_name}'
@@ -118,13 +149,11 @@ def send_random_sticker_from_stickerset(bot: telegram.Bot, chat_id: int,
     bot.send_sticker(chat_id, sticker)
 
 
-@run_async
+@passive_lane
 def send_random_sticker(bot: telegram.Bot, chat_id, stickers) -> None:
     bot.send_sticker(chat_id, random.choice(stickers))
 
 
-@chat_guard
-@collect_stats
 @command_guard
 def message_reactions(bot: telegram.Bot, update: telegram.Update) -> None:
     """
@@ -191,17 +220,16 @@ def threads_video(bot: telegram.Bot, update: telegram.Update) -> None:
     process_message_for_threads(update.effective_message)
 
 
-@run_async
-def update_stickers(_: telegram.Bot, update: telegram.Update) -> None:
+async def update_stickers(_: telegram.Bot, update: telegram.Update) -> None:
     """
     Добавление стикера в использованные
     """
     if not update.message.sticker:
         return
     cache_key = f'pipinder:monday_stickersets:{get_current_monday_str()}'
-    monday_stickersets = set(cache.get(cache_key, set()))
+    monday_stickersets = set(await async_cache.get(cache_key, set()))
     monday_stickersets.add(update.message.sticker.set_name)
-    cache.set(cache_key, monday_stickersets, time=USER_CACHE_EXPIRE)
+    await async_cache.set(cache_key, monday_stickersets, time=USER_CACHE_EXPIRE)
 
 
 def check_photo_reactions(bot: telegram.Bot, update: telegram.Update) -> None:
@@ -238,7 +266,6 @@ def photo_reactions(bot: telegram.Bot, update: telegram.Update, img_url=None):
         call_osenya(bot, update, key_media_group, img_url)
 
 
-@run_async
 def call_osenya(bot: telegram.Bot, update: telegram.Update, key_media_group: str,
                 img_url=None):
     if img_url is None:
@@ -309,3 +336,21 @@ def random_khaleesi(bot, update):
         RandomKhaleesi.increase_khaleesi_time(chat_id)
         bot.sendMessage(chat_id, '{} 🐉'.format(khaleesed),
                         reply_to_message_id=update.message.message_id)
+
+
+passive_pipeline = AsyncPipeline.from_config('passive', [
+    # сначала участники и статистика: реакции и команды проверяют то, что они записали
+    [
+        Stage('leave_check', leave_check),
+        Stage('collect_stats', collect_stats_stage),
+    ],
+    [
+        Stage('reactions', reactions_stage),
+        Stage('weekly', weekly_stage),
+        Stage('photo_reactions', check_photo_reactions, 'http', when=has_photos),
+        Stage('bayanometer', Bayanometer.check, 'http', when=has_photos),
+        Stage('links', links_stage, 'http', when=has_links),
+        Stage('stickers', update_stickers, 'async', when=lambda _, update: update.message.sticker),
+        Stage('count', count_message, 'async'),
+    ],
+])
@@ -2,9 +2,9 @@ import re
 from typing import Optional
 
 import telegram
-from telegram.ext import run_async
 
 from src.utils.cache import pure_cache
+from src.utils.lanes import heavy_io_lane
 from src.utils.logger_helpers import get_logger
 
 logger = get_logger(__name__)
@@ -18,7 +18,6 @@ def get_cache_key(cid) -> str:
     return f'rogovdays:{cid}'
 
 
-@run_async
 def rogovdays_check_message(message: telegram.Message) -> None:
     text_lower = get_text_lower(message)
     if text_lower is None:
@@ -56,7 +55,7 @@ def reset_days_counter(message: telegram.Message) -> None:
     pure_cache.delete(get_cache_key(cid))
 
 
-@run_async
+@heavy_io_lane
 def send_rogovdays_daily(bot: telegram.Bot, cid) -> None:
     # каждый день в полночь мы увеличиваем количество дней на единицу.
     # если значения нет, то incr делает его равным 1.
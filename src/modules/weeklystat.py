@@ -1,17 +1,16 @@
 import random
 import typing
 from datetime import datetime, timedelta
-from time import sleep
+from multiprocessing.dummy import Pool as ThreadPool
 
 import pytils
 import telegram
 from telegram import ParseMode, ChatAction
-from telegram.ext import run_async
 
 import emoji_fixed as emoji
 import src.config as config
 from src.config import CMDS
-from src.commands.topmat import send_topmat
+from src.commands.topmat import get_topmat_msg
 from src.models.cringe_monthly import CringeMonthly
 from src.models.igor_weekly import IgorWeekly
 from src.models.pidor_weekly import PidorWeekly
@@ -22,14 +21,16 @@ from src.utils.cache import cache, MONTH, bot_id
 from src.utils.handlers_decorators import chat_guard, collect_stats, command_guard
 from src.utils.handlers_helpers import is_command_enabled_for_chat, \
     get_command_name, check_admin
+from src.utils.lanes import heavy_io_lane, interactive_lane
 from src.utils.logger_helpers import get_logger
 from src.utils.misc import get_int, chunks
-from src.utils.telegram_helpers import dsp, send_long
+from src.utils.telegram_helpers import dsp, send_long, Priority
 
 logger = get_logger(__name__)
+WEEKLY_WORKERS = 4  # сколько чатов считаем одновременно
 
 
-@run_async
+@interactive_lane
 @chat_guard
 @collect_stats
 @command_guard
@@ -46,7 +47,22 @@ def stats(bot, update):
     send_stats(bot, chat_id, update.message.chat.title, command, update.message.date)
 
 
+class ReportMessage(typing.NamedTuple):
+    """
+    Сообщение недельного отчета. Если телеграм не примет `text` (например, из-за ссылки на юзера),
+    то вместо него отправится `fallback`.
+    """
+    text: str
+    fallback: typing.Optional[str] = None
+
+
 def send_stats(bot, chat_id, chat_title, command, date, tag_salo=False, mat=False):
+    msg = get_stats_msg(chat_id, chat_title, command, date, tag_salo=tag_salo, mat=mat)
+    send_long(bot, chat_id, msg)
+    logger.info(f'Group {chat_id} requested stats')
+
+
+def get_stats_msg(chat_id, chat_title, command, date, tag_salo=False, mat=False) -> str:
     users_count_caption = ''
     top_chart_caption = ''
     percent_needed = False
@@ -78,42 +94,40 @@ def send_stats(bot, chat_id, chat_title, command, date, tag_salo=False, mat=Fals
                                info['top_chart'],
                                top_chart_caption,
                                percents)
-    send_long(bot, chat_id, msg)
-    logger.info(f'Group {chat_id} requested stats')
     if salo:
         cache.set(f'weekgoal:{chat_id}:salo_uids', info['uids'][0:3], time=MONTH)
     elif fullstat:
         cache.set(f'weekgoal:{chat_id}:top_pidori_uids', info['uids'][0:3], time=MONTH)
+    return msg
 
 
-def send_top_kroshka(bot, chat_id, monday):
+def get_top_kroshka_msg(chat_id, monday) -> typing.Optional[ReportMessage]:
     kroshka = UserStat.get_top_kroshka(chat_id, monday)
     if not kroshka:
-        return
+        return None
     cache.set(f'weekgoal:{chat_id}:kroshka_uid', kroshka.uid, time=MONTH)
     emoj = ''.join(random.sample(list(emoji.UNICODE_EMOJI), 5))
     she = 'Она' if kroshka.female else 'Он'
-    msg = f'Замечательная крошка-картошка <a href="tg://user?id={kroshka.uid}">🥔</a> недели —\n\n<b>{kroshka.fullname}</b> ❤️❤️❤️\n\n{she} получает эти прекрасные эмодзи: {emoj}'
-    try:
-        send_long(bot, chat_id, msg)
-    except Exception:
-        msg = f'Замечательная крошка-картошка 🥔 недели —\n\n<b>{kroshka.fullname}</b> ❤️❤️❤️\n\n{she} получает эти прекрасные эмодзи: {emoj}'
-        send_long(bot, chat_id, f'{msg}\n\n{kroshka.get_username_or_link()}')
+    msg = f'Замечательная крошка-картошка <a href="tg://user?id={kroshka.uid}">🥔</a> недели —\n\n' \
+          f'<b>{kroshka.fullname}</b> ❤️❤️❤️\n\n{she} получает эти прекрасные эмодзи: {emoj}'
+    fallback = f'Замечательная крошка-картошка 🥔 недели —\n\n' \
+               f'<b>{kroshka.fullname}</b> ❤️❤️❤️\n\n{she} получает эти прекрасные эмодзи: {emoj}'
+    return ReportMessage(msg, f'{fallback}\n\n{kroshka.get_username_or_link()}')
 
 
-def send_alllove(bot, chat_id, prev_monday):
+def get_alllove_msg(chat_id, prev_monday) -> ReportMessage:
     msg = ReplyLove.get_all_love(chat_id, date=prev_monday, header='Вся страсть за неделю')
-    send_long(bot, chat_id, msg)
+    return ReportMessage(msg)
 
 
-def send_alllove_outbound(bot, chat_id, prev_monday):
+def get_alllove_outbound_msg(chat_id, prev_monday) -> ReportMessage:
     msg = ReplyLove.get_all_love_outbound(chat_id, date=prev_monday,
                                           header='Вся исходящая страсть за неделю',
                                           no_love_show_only_count=True)
-    send_long(bot, chat_id, msg)
+    return ReportMessage(msg)
 
 
-def send_replytop(bot, chat_id, prev_monday):
+def get_replytop_msg(chat_id, prev_monday) -> ReportMessage:
     stats = ReplyTop.get_stats(chat_id, prev_monday)
     msg = "<b>Кто кого реплаит</b>\n\n"
 
@@ -151,18 +165,18 @@ def send_replytop(bot, chat_id, prev_monday):
         random.shuffle(names)
         msg += f"{count}. <b>{names[0]}</b> ⟷ <b>{names[1]}</b>\n"
 
-    send_long(bot, chat_id, msg)
+    return ReportMessage(msg)
 
 
-def send_pidorweekly(bot, chat_id, prev_monday):
+def get_pidorweekly_msg(chat_id, prev_monday) -> typing.Optional[ReportMessage]:
     uid = PidorWeekly.get_top_pidor(chat_id, prev_monday)
     logger.info(f"pidor {chat_id}:{uid}")
     if not uid:
-        return
+        return None
     user = User.get(uid)
     if not user:
         logger.error(f'None user {uid}')
-        return
+        return None
     cache.set(f'weekgoal:{chat_id}:pidorweekly_uid', user.uid, time=MONTH)
     pidorom = 'пидоршей' if user.female else 'пидором'
     header = f"И {pidorom} недели становится... <a href='tg://user?id={user.uid}'>👯‍♂</a> \n\n"
@@ -171,72 +185,103 @@ def send_pidorweekly(bot, chat_id, prev_monday):
                     ':volcano:']
     random.shuffle(random_emoji)
     body += "{} Ура!".format(emoji.emojize(''.join(random_emoji)))
-    try:
-        send_long(bot, chat_id, f'{header}{body}')
-    except Exception:
-        header = f"И {pidorom} недели становится... 👯‍♂ \n\n"
-        send_long(bot, chat_id, f'{header}{body}\n\n{user.get_username_or_link()}')
+    fallback_header = f"И {pidorom} недели становится... 👯‍♂ \n\n"
+    return ReportMessage(f'{header}{body}',
+                         f'{fallback_header}{body}\n\n{user.get_username_or_link()}')
 
 
-def send_igorweekly(bot: telegram.Bot, chat_id: int, prev_monday: datetime):
+def get_igorweekly_msg(chat_id: int, prev_monday: datetime) -> typing.Optional[ReportMessage]:
     uid = IgorWeekly.get_top_igor(chat_id, prev_monday)
     if not uid:
-        return
+        return None
     user = User.get(uid)
     if not user:
         logger.error(f'None user {uid}')
-        return
+        return None
     cache.set(f'weekgoal:{chat_id}:igorweekly_uid', user.uid, time=MONTH)
     igorem = 'игорессой' if user.female else 'игорем'
     header = f"И {igorem} недели становится... <a href='tg://user?id={user.uid}'>👯‍♂</a> \n\n"
     body = "🎉     <b>{}</b>    🎉\n\nУра!".format(user.fullname)
-    try:
-        send_long(bot, chat_id, f'{header}{body}')
-    except Exception:
-        header = f"И {igorem} недели становится... 👯‍♂ \n\n"
-        send_long(bot, chat_id, f'{header}{body}\n\n{user.get_username_or_link()}')
+    fallback_header = f"И {igorem} недели становится... 👯‍♂ \n\n"
+    return ReportMessage(f'{header}{body}',
+                         f'{fallback_header}{body}\n\n{user.get_username_or_link()}')
 
 
-@run_async
+@heavy_io_lane
 def weekly_stats(bot: telegram.Bot, _) -> None:
     today = datetime.today()
     # эта штука запускается в понедельник ночью, поэтому мы откладываем неделю назад
     prev_monday = (today - timedelta(days=today.weekday() + 7)).replace(hour=0, minute=0, second=0,
                                                                         microsecond=0)
-    for chat in config.get_config_chats():
-        if not is_command_enabled_for_chat(chat.chat_id, 'weeklystat'):
-            continue
-        send_weekly_for_chat(bot, chat.chat_id, chat.disabled_commands, chat.enabled_commands,
-                             prev_monday)
+    chats = [chat for chat in config.get_config_chats()
+             if is_command_enabled_for_chat(chat.chat_id, 'weeklystat')]
+    if not chats:
+        return
+
+    def build(chat: config.ChatInConfig) -> typing.Tuple[int, typing.List[ReportMessage]]:
+        return chat.chat_id, get_weekly_for_chat(chat.chat_id, chat.disabled_commands,
+                                                 chat.enabled_commands, prev_monday)
 
+    # отчеты всех чатов считаются параллельно. Готовый отчет сразу уходит в очередь отправки,
+    # а она уже сама следит за лимитами телеграма
+    pool = ThreadPool(min(WEEKLY_WORKERS, len(chats)))
+    for chat_id, messages in pool.imap_unordered(build, chats):
+        send_report(bot, chat_id, messages)
+    pool.close()
+    pool.join()
 
-def send_weekly_for_chat(bot: telegram.Bot, chat_id: int, disabled_commands: typing.List[str],
-                         enabled_commands: typing.List[str], prev_monday: datetime) -> None:
+
+def get_weekly_for_chat(chat_id: int, disabled_commands: typing.List[str],
+                        enabled_commands: typing.List[str],
+                        prev_monday: datetime) -> typing.List[ReportMessage]:
     logger.info(f'weekly_stats for chat {chat_id}')
+    messages: typing.List[ReportMessage] = []
+
+    def add(msg: typing.Optional[ReportMessage]) -> None:
+        if msg:
+            messages.append(msg)
+
     try:
-        send_stats(bot, chat_id, 'Стата за прошлую неделю',
-                   CMDS['admins']['all_stat']['name'], prev_monday)
-        sleep(1)
-        send_stats(bot, chat_id, 'Стата за прошлую неделю',
-                   CMDS['admins']['silent_guys']['name'], prev_monday, tag_salo=True)
-        sleep(1)
+        add(ReportMessage(get_stats_msg(chat_id, 'Стата за прошлую неделю',
+                                        CMDS['admins']['all_stat']['name'], prev_monday)))
+        add(ReportMessage(get_stats_msg(chat_id, 'Стата за прошлую неделю',
+                                        CMDS['admins']['silent_guys']['name'], prev_monday,
+                                        tag_salo=True)))
         if 'weeklystat:top_kroshka' not in disabled_commands:
-            send_top_kroshka(bot, chat_id, prev_monday)
-            sleep(1)
+            add(get_top_kroshka_msg(chat_id, prev_monday))
         if 'weeklystat:pidorweekly' not in disabled_commands:
-            send_pidorweekly(bot, chat_id, prev_monday)
-            sleep(1)
+            add(get_pidorweekly_msg(chat_id, prev_monday))
         if 'weeklystat:igorweekly' in enabled_commands:
-            send_igorweekly(bot, chat_id, prev_monday)
-            sleep(1)
-        send_replytop(bot, chat_id, prev_monday)
-        sleep(1)
-        send_alllove(bot, chat_id, prev_monday)
-        sleep(1)
-        send_alllove_outbound(bot, chat_id, prev_monday)
-        sleep(1)
-        send_topmat(bot, chat_id, chat_id, prev_monday)
-        sleep(1)
+            add(get_igorweekly_msg(chat_id, prev_monday))
+        add(get_replytop_msg(chat_id, prev_monday))
+        add(get_alllove_msg(chat_id, prev_monday))
+        add(get_alllove_outbound_msg(chat_id, prev_monday))
+        add(ReportMessage(get_topmat_msg(chat_id, prev_monday)))
     except Exception as e:
-        logger.error("Failed to send weekly stats to %s: %s" % (chat_id, repr(e)))
+        logger.error("Failed to build weekly stats for %s: %s" % (chat_id, repr(e)))
         logger.error(e)
+    return messages
+
+
+def send_report(bot: telegram.Bot, chat_id: int, messages: typing.List[ReportMessage]) -> None:
+    """
+    Ставит сообщения отчета в очередь отправки. Внутри чата порядок сообщений сохраняется.
+    """
+    for message in messages:
+        text_chunks = list(chunks(message.text, 4096))
+        if len(text_chunks) > 1:
+            for chunk in text_chunks:
+                dsp.put(bot.send_message, (chat_id, chunk), {'parse_mode': ParseMode.HTML},
+                        chat_id=chat_id, priority=Priority.REPORT)
+            continue
+        dsp.put(_send_report_message, (bot, chat_id, message), chat_id=chat_id,
+                priority=Priority.REPORT)
+
+
+def _send_report_message(bot: telegram.Bot, chat_id: int, message: ReportMessage) -> None:
+    try:
+        bot.send_message(chat_id, message.text, parse_mode=ParseMode.HTML)
+    except telegram.error.BadRequest:
+        if not message.fallback:
+            raise
+        bot.send_message(chat_id, message.fallback, parse_mode=ParseMode.HTML)
@@ -0,0 +1,212 @@
+"""
+Конвейер на asyncio для фоновой обработки сообщений.
+
+Обработчик телеграма только отдает апдейт в конвейер (`submit`) и сразу освобождает воркер
+диспетчера. Конвейер работает на своем цикле asyncio в отдельном потоке и состоит из шагов:
+шаги выполняются по очереди, а этапы внутри шага — одновременно.
+
+Этапы бывают трех видов:
+
+- `async` — корутина прямо на цикле. Так работают этапы, которым нужен только редис
+  (`AsyncCache`, `AsyncPureCache` из `src/utils/cache.py`, поверх `redis.asyncio`);
+- `db` — обычная блокирующая функция (модели на SQLAlchemy) в полосе `passive`
+  (`src/utils/lanes.py`), по-умолчанию размером с пул соединений с бд, чтобы потоки не стояли
+  в очереди за соединением;
+- `http` — блокирующая функция с походами во внешние сервисы в полосе `heavy_io`, чтобы
+  медленные скачивания видео не задерживали статистику.
+
+Так в обработке одновременно может быть до `max_in_flight` сообщений, а потоков нужно
+только на бд и http. Сообщения сверх этого ждут своей очереди в конвейере, но не больше
+`max_backlog`: остальные отбрасываются. `submit` никогда не ждет, ведь его вызывает поток
+диспетчера, и если бы он встал, то встали бы и команды, и нажатия кнопок.
+
+Настройки — в разделе `passive_pipeline` конфига, размеры пулов — в разделе `lanes`.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Coroutine, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from src.config import CONFIG
+from src.utils.lanes import Lane, heavy_io_lane, passive_lane
+from src.utils.logger_helpers import get_logger
+from src.utils.metrics import metrics
+from src.utils.profiler import profiler
+
+logger = get_logger(__name__)
+
+KINDS = ('async', 'db', 'http')
+
+
+class Stage(NamedTuple):
+    name: str
+    func: Callable
+    kind: str = 'db'
+    # не запускать этап (и не занимать поток), если он заведомо ничего не сделает
+    when: Optional[Callable[..., bool]] = None
+
+
+class LoopThread:
+    """
+    Цикл asyncio в отдельном потоке, запускается при первом обращении.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name=self.name, daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def submit(self, coro: Coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+loop_thread = LoopThread('AsyncPipeline')
+
+
+class AsyncPipeline:
+    # для метрик
+    registry: Dict[str, 'AsyncPipeline'] = {}
+
+    def __init__(self, name: str, steps: List[List[Stage]],
+                 lanes: Optional[Dict[str, Lane]] = None, max_in_flight: int = 1000,
+                 max_backlog: int = 10000) -> None:
+        for step in steps:
+            for stage in step:
+                if stage.kind not in KINDS:
+                    raise ValueError(f'Unknown stage kind: {stage.kind}')
+        self.name = name
+        self.steps = steps
+        self.lanes = lanes or {'db': passive_lane, 'http': heavy_io_lane}
+        self.max_in_flight = max_in_flight
+        self.max_backlog = max_backlog
+        self._running = 0
+        self._backlog: Deque[Tuple[tuple, Future]] = deque()
+        self._idle = threading.Condition()
+        self.dropped = 0
+        AsyncPipeline.registry[name] = self
+
+    @classmethod
+    def from_config(cls, name: str, steps: List[List[Stage]]) -> 'AsyncPipeline':
+        config = CONFIG.get('passive_pipeline', {})
+        return cls(name, steps, max_in_flight=config.get('max_in_flight', 1000),
+                   max_backlog=config.get('max_backlog', 10000))
+
+    @property
+    def in_flight(self) -> int:
+        return self._running + len(self._backlog)
+
+    @property
+    def backlog(self) -> int:
+        return len(self._backlog)
+
+    def submit(self, *args) -> Future:
+        """
+        Вызывается из обычного (синхронного) обработчика и не блокирует его. Этапы получают
+        те же аргументы. Если сообщение отброшено, возвращается отмененный future.
+        """
+        future: Future = Future()
+        with self._idle:
+            if self._running < self.max_in_flight:
+                self._running += 1
+                dropped = 0
+            elif len(self._backlog) < self.max_backlog:
+                self._backlog.append((args, future))
+                return future
+            else:
+                self.dropped += 1
+                dropped = self.dropped
+        if dropped:
+            future.cancel()
+            if dropped % 1000 == 1:
+                logger.warning(f'[{self.name}] backlog is full, {dropped} messages dropped')
+            return future
+        self.__start(args, future)
+        return future
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ждет, пока обработаются все отданные сообщения. Для тестов и бенчмарка.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self.in_flight:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._idle.wait(left)
+        return True
+
+    async def _run(self, args: tuple) -> None:
+        for step in self.steps:
+            stages = [stage for stage in step if stage.when is None or stage.when(*args)]
+            await asyncio.gather(*(self._run_stage(stage, args) for stage in stages))
+
+    async def _run_stage(self, stage: Stage, args: tuple) -> None:
+        name = f'{self.name}.{stage.name}'
+        if stage.kind == 'async':
+            start = time.perf_counter()
+            failed = False
+            try:
+                await stage.func(*args)
+            except Exception:
+                failed = True
+                logger.exception(f'[{name}] failed')
+            finally:
+                metrics.observe(name, time.perf_counter() - start, failed)
+            return
+        lane = self.lanes[stage.kind]
+        await asyncio.wrap_future(lane.submit(self.__run_blocking, name, stage.func, args))
+
+    @staticmethod
+    def __run_blocking(name: str, func: Callable, args: tuple) -> Any:
+        try:
+            with metrics.track_handler(name), profiler.watch(name, _get_chat_id(args)):
+                return func(*args)
+        except Exception:
+            # ошибка одного этапа не мешает остальным
+            logger.exception(f'[{name}] failed')
+
+    def __start(self, args: tuple, future: Future) -> None:
+        def done(run: Future) -> None:
+            self.__done()
+            if run.cancelled():
+                future.cancel()
+            elif run.exception() is not None:
+                future.set_exception(run.exception())
+            else:
+                future.set_result(run.result())
+
+        future.set_running_or_notify_cancel()
+        loop_thread.submit(self._run(args)).add_done_callback(done)
+
+    def __done(self) -> None:
+        # освободившееся место сразу отдается следующему сообщению из очереди
+        with self._idle:
+            if self._backlog:
+                args, future = self._backlog.popleft()
+            else:
+                self._running -= 1
+                if not self._running:
+                    self._idle.notify_all()
+                return
+        self.__start(args, future)
+
+
+def _get_chat_id(args: tuple) -> Optional[int]:
+    for arg in args:
+        chat = getattr(arg, 'effective_chat', None)
+        if chat is not None:
+            return chat.id
+    return None
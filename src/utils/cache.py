@@ -1,23 +1,111 @@
 import pickle
-from typing import Optional, List, Union, Set
+import threading
+import time as time_module
+from typing import Optional, List, Union, Set, Callable, Hashable, Dict, Tuple
 
 import redis
+import redis.asyncio
+from redis.client import Pipeline
 
 from src.config import CONFIG
+from src.utils.memory_cache import AsyncMemoryRedis, MemoryRedis, MemoryStore, register_script
+from src.utils.metrics import metrics
+
+
+class InstrumentedPipeline(Pipeline):
+    """
+    Пайплайн считается в метриках одним запросом.
+    """
+
+    def execute(self, raise_on_error=True):
+        start = time_module.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            metrics.record_call('redis', time_module.perf_counter() - start)
+
+
+class InstrumentedRedis(redis.StrictRedis):
+    """
+    Редис, который записывает в метрики число и время запросов.
+    """
+
+    def execute_command(self, *args, **options):
+        start = time_module.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            metrics.record_call('redis', time_module.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction,
+                                    shard_hint)
+
+
+class InstrumentedAsyncRedis(redis.asyncio.StrictRedis):
+    async def execute_command(self, *args, **options):
+        start = time_module.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            metrics.record_call('redis', time_module.perf_counter() - start)
+
+
+def create_clients(config: dict) -> tuple:
+    """
+    Клиенты кэша: для пиклов (байты) и для PureCache (строки).
+
+    `backend` в конфиге: 'redis' (по-умолчанию) или 'memory' — кэш в памяти процесса,
+    см. `src/utils/memory_cache.py`.
+    """
+    backend = config.get('backend', 'redis')
+    if backend == 'memory':
+        memory_config = config.get('memory', {})
+        store = MemoryStore(snapshot=memory_config.get('snapshot'),
+                            snapshot_interval=memory_config.get('snapshot_interval', 300))
+        return MemoryRedis(store), MemoryRedis(store, decode_responses=True)
+    if backend != 'redis':
+        raise ValueError(f'Unknown cache backend: {backend}')
+    redis_config = config['redis']
+    return (InstrumentedRedis(host=redis_config['host'], port=redis_config['port'],
+                              db=redis_config['db']),
+            InstrumentedRedis(host=redis_config['host'], port=redis_config['port'],
+                              db=redis_config['db'], charset='utf-8', decode_responses=True))
+
 
 if 'cache' in CONFIG:
-    _redis = redis.StrictRedis(host=CONFIG['cache']['redis']['host'],
-                               port=CONFIG['cache']['redis']['port'],
-                               db=CONFIG['cache']['redis']['db'])
-    _pure_redis = redis.StrictRedis(host=CONFIG['cache']['redis']['host'],
-                                    port=CONFIG['cache']['redis']['port'],
-                                    db=CONFIG['cache']['redis']['db'], charset='utf-8',
-                                    decode_responses=True)
+    _redis, _pure_redis = create_clients(CONFIG['cache'])
 else:
     print("Can't connect to Redis")
     _redis = None
     _pure_redis = None
 
+_ASYNC_CLIENT_OPTIONS = ('host', 'port', 'db', 'username', 'password', 'socket_timeout',
+                         'encoding', 'decode_responses')
+_async_clients: Dict[Tuple[int, int], tuple] = {}
+
+
+def get_async_clients() -> tuple:
+    """
+    Клиенты для корутин на цикле конвейера (`src/utils/async_pipeline.py`), с теми же настройками,
+    что и обычные. Соединения `redis.asyncio` привязаны к циклу, поэтому клиенты нужно
+    использовать только на нем.
+    """
+    key = (id(_redis), id(_pure_redis))
+    clients = _async_clients.get(key)
+    if clients is None:
+        clients = _async_clients[key] = (_to_async(_redis), _to_async(_pure_redis))
+    return clients
+
+
+def _to_async(client):
+    if isinstance(client, MemoryRedis):
+        return AsyncMemoryRedis(client)
+    options = client.connection_pool.connection_kwargs
+    return InstrumentedAsyncRedis(**{k: v for k, v in options.items()
+                                     if k in _ASYNC_CLIENT_OPTIONS})
+
+
 USER_CACHE_EXPIRE = 15 * 24 * 60 * 60  # 15 дней
 MONTH = 30 * 24 * 60 * 60  # 30 дней
 DAY = 1 * 24 * 60 * 60  # день
@@ -28,6 +116,36 @@ YEAR = 31556926  # год
 TWO_YEARS = 2 * YEAR
 
 
+def scan_delete(client, pattern: str, batch_size: int = 500,
+                progress: Optional[Callable[[int, int], None]] = None) -> int:
+    """
+    Удаляет ключи по паттерну порциями: SCAN + UNLINK.
+
+    В отличие от KEYS, SCAN не блокирует редис на весь перебор, а UNLINK освобождает память
+    в фоне. Между порциями редис успевает обслужить остальных.
+
+    :param progress: вызывается после каждой порции с (просмотрено ключей, удалено ключей)
+    :return: сколько ключей удалено
+    """
+    scanned = 0
+    deleted = 0
+    batch = []
+    for key in client.scan_iter(match=pattern, count=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            scanned += len(batch)
+            deleted += client.unlink(*batch)
+            batch = []
+            if progress:
+                progress(scanned, deleted)
+    if batch:
+        scanned += len(batch)
+        deleted += client.unlink(*batch)
+        if progress:
+            progress(scanned, deleted)
+    return deleted
+
+
 class Cache:
     @staticmethod
     def get(key, default=None):
@@ -36,23 +154,146 @@ class Cache:
             return pickle.loads(cached)
         return default
 
+    @staticmethod
+    def get_many(keys: List[str], default=None) -> list:
+        """
+        Как get, но для списка ключей за один запрос к редису.
+        """
+        if not keys:
+            return []
+        return [pickle.loads(cached) if cached else default for cached in _redis.mget(keys)]
+
     @staticmethod
     def set(key, val, time=None):
         return _redis.set(key, pickle.dumps(val), ex=time)
 
+    @staticmethod
+    def touch(key, time):
+        """
+        Только продлевает время жизни ключа, без перезаписи значения.
+        """
+        return _redis.expire(key, time)
+
     @staticmethod
     def delete(key):
         return _redis.delete(key)
 
     @staticmethod
-    def delete_by_pattern(pattern: str):
+    def delete_by_pattern(pattern: str, batch_size: int = 500,
+                          progress: Optional[Callable[[int, int], None]] = None) -> int:
         """
         Удаляет ключи из кэша по паттерну. Пример паттерна: 'user:*'
 
-        See: https://stackoverflow.com/a/27561399/136559
+        Возвращает количество удаленных ключей. Подробнее в `scan_delete`.
+        """
+        return scan_delete(_redis, pattern, batch_size, progress)
+
+
+class TouchThrottle:
+    """
+    Продлевает ключ не чаще раза в `interval` секунд. Время последнего продления помнится в памяти
+    процесса, поэтому частые вызовы вообще не доходят до редиса.
+
+    Само продление делает `refresh`: это может быть и `cache.touch`, и продление поля хэша.
+    """
+    max_size = 100_000
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._touched = {}
+        self._lock = threading.Lock()
+
+    def touch(self, key: Hashable, refresh: Callable[[], None]) -> None:
+        now = time_module.monotonic()
+        with self._lock:
+            last = self._touched.get(key)
+            if last is not None and now - last < self.interval:
+                return
+            if len(self._touched) >= self.max_size:
+                self._prune(now)
+            self._touched[key] = now
+        refresh()
+
+    def forget(self, key: Hashable) -> None:
         """
-        lua = "for i, name in ipairs(redis.call('KEYS', ARGV[1])) do redis.call('DEL', name); end"
-        _redis.eval(lua, 0, pattern)
+        Ключ перезаписали целиком, его время жизни уже обновлено.
+        """
+        with self._lock:
+            self._touched[key] = time_module.monotonic()
+
+    def _prune(self, now: float) -> None:
+        self._touched = {k: t for k, t in self._touched.items() if now - t < self.interval}
+
+
+_UPDATE_EXISTING_SET_LUA = """
+    if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+    if ARGV[1] ~= '' then redis.call('SADD', KEYS[1], ARGV[1]) end
+    if ARGV[2] ~= '' then redis.call('SREM', KEYS[1], ARGV[2]) end
+    return 1
+"""
+
+
+def _update_existing_set(client, keys: list, args: list) -> int:
+    """
+    То же, что `_UPDATE_EXISTING_SET_LUA`, для кэша в памяти.
+    """
+    if not client.exists(keys[0]):
+        return 0
+    if args[0] != '':
+        client.sadd(keys[0], args[0])
+    if args[1] != '':
+        client.srem(keys[0], args[1])
+    return 1
+
+
+register_script(_UPDATE_EXISTING_SET_LUA, _update_existing_set)
+
+_ACQUIRE_LEASE_LUA = """
+    local owner = redis.call('GET', KEYS[1])
+    if owner ~= false and owner ~= ARGV[1] then return 0 end
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+"""
+
+_RELEASE_LEASE_LUA = """
+    if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+    return redis.call('DEL', KEYS[1])
+"""
+
+
+def _acquire_lease(client, keys: list, args: list) -> int:
+    owner = client.get(keys[0])
+    if owner is not None and owner != str(args[0]):
+        return 0
+    client.set(keys[0], args[0], px=int(args[1]))
+    return 1
+
+
+def _release_lease(client, keys: list, args: list) -> int:
+    if client.get(keys[0]) != str(args[0]):
+        return 0
+    return client.delete(keys[0])
+
+
+register_script(_ACQUIRE_LEASE_LUA, _acquire_lease)
+register_script(_RELEASE_LEASE_LUA, _release_lease)
+
+_TAKE_HASH_LUA = """
+    if redis.call('EXISTS', KEYS[2]) == 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+        redis.call('RENAME', KEYS[1], KEYS[2])
+    end
+    return redis.call('HGETALL', KEYS[2])
+"""
+
+
+def _take_hash(client, keys: list, args: list) -> list:
+    if not client.exists(keys[1]) and client.exists(keys[0]):
+        client.hset(keys[1], mapping=client.hgetall(keys[0]))
+        client.delete(keys[0])
+    return [item for pair in client.hgetall(keys[1]).items() for item in pair]
+
+
+register_script(_TAKE_HASH_LUA, _take_hash)
 
 
 class PureCache:
@@ -119,6 +360,77 @@ class PureCache:
     def get_set(cls, key: str) -> Set[str]:
         return set(_pure_redis.smembers(f'{cls.prefix}:{key}'))
 
+    @classmethod
+    def remove_from_set(cls, key: str, value) -> None:
+        _pure_redis.srem(f'{cls.prefix}:{key}', value)
+
+    @classmethod
+    def is_in_set(cls, key: str, value) -> bool:
+        return bool(_pure_redis.sismember(f'{cls.prefix}:{key}', value))
+
+    @classmethod
+    def update_existing_set(cls, key: str, add=None, remove=None) -> bool:
+        """
+        Добавляет/удаляет элемент, только если множество уже есть в редисе. Иначе неполное
+        множество выглядело бы как настоящее. Возвращает, было ли оно в редисе.
+        """
+        add = '' if add is None else add
+        remove = '' if remove is None else remove
+        return bool(_pure_redis.eval(_UPDATE_EXISTING_SET_LUA, 1, f'{cls.prefix}:{key}',
+                                     add, remove))
+
+    @classmethod
+    def acquire_lease(cls, key: str, owner: str, ttl: float) -> bool:
+        """
+        Берет аренду ключа на `ttl` секунд или продлевает ее, если она уже у `owner`.
+        Возвращает False, если аренда у кого-то другого.
+        """
+        return bool(_pure_redis.eval(_ACQUIRE_LEASE_LUA, 1, f'{cls.prefix}:{key}', owner,
+                                     int(ttl * 1000)))
+
+    @classmethod
+    def release_lease(cls, key: str, owner: str) -> bool:
+        """
+        Отдает аренду, только если она у `owner`.
+        """
+        return bool(_pure_redis.eval(_RELEASE_LEASE_LUA, 1, f'{cls.prefix}:{key}', owner))
+
+    @classmethod
+    def random_from_set(cls, key: str, count: int) -> List[str]:
+        """
+        До `count` разных случайных элементов множества (SRANDMEMBER).
+        """
+        return _pure_redis.srandmember(f'{cls.prefix}:{key}', count)
+
+    @classmethod
+    def replace_set(cls, key: str, values: Union[list, tuple, Set], time=None) -> None:
+        """
+        Атомарно заменяет множество целиком.
+        """
+        full_key = f'{cls.prefix}:{key}'
+        pipe = _pure_redis.pipeline()
+        pipe.delete(full_key)
+        if values:
+            pipe.sadd(full_key, *values)
+        if time:
+            pipe.expire(full_key, time)
+        pipe.execute()
+
+    @classmethod
+    def incr_hash_field(cls, key: str, field: str, amount: int = 1) -> int:
+        return _pure_redis.hincrby(f'{cls.prefix}:{key}', field, amount)
+
+    @classmethod
+    def take_hash(cls, key: str, staging_key: str) -> Dict[str, str]:
+        """
+        Атомарно забирает хэш: переносит его в `staging_key` и возвращает содержимое. Если
+        в `staging_key` осталось что-то с прошлого раза (обработка упала), возвращает это, а
+        новые данные остаются ждать в `key`. После обработки `staging_key` нужно удалить.
+        """
+        items = _pure_redis.eval(_TAKE_HASH_LUA, 2, f'{cls.prefix}:{key}',
+                                 f'{cls.prefix}:{staging_key}')
+        return dict(zip(items[::2], items[1::2]))
+
     @classmethod
     def get_list(cls, key: str) -> List[str]:
         return _pure_redis.lrange(f'{cls.prefix}:{key}', 0, -1)
@@ -128,8 +440,48 @@ class PureCache:
         _pure_redis.delete(f'__pure__:{key}')
 
 
+class AsyncCache:
+    """
+    Как Cache, но для корутин на цикле конвейера.
+    """
+
+    @staticmethod
+    async def get(key, default=None):
+        cached = await get_async_clients()[0].get(key)
+        if cached:
+            return pickle.loads(cached)
+        return default
+
+    @staticmethod
+    async def set(key, val, time=None):
+        return await get_async_clients()[0].set(key, pickle.dumps(val), ex=time)
+
+
+class AsyncPureCache:
+    """
+    Как PureCache, но для корутин на цикле конвейера.
+    """
+    prefix = PureCache.prefix
+
+    @classmethod
+    async def get(cls, key: str, default: Optional[str] = None) -> Optional[str]:
+        cached = await get_async_clients()[1].get(f'{cls.prefix}:{key}')
+        if cached:
+            return cached
+        return default
+
+    @classmethod
+    async def incr(cls, key: str, amount: int = 1) -> int:
+        client = get_async_clients()[1]
+        value = await client.incr(f'{cls.prefix}:{key}', amount)
+        await client.expire(f'{cls.prefix}:{key}', USER_CACHE_EXPIRE)
+        return value
+
+
 cache = Cache()
 pure_cache = PureCache()
+async_cache = AsyncCache()
+async_pure_cache = AsyncPureCache()
 _bot_id = None
 
 def bot_id():
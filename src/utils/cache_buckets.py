@@ -0,0 +1,303 @@
+"""
+Семейства мелких ключей, сложенные в хэши.
+
+У каждого ключа в редисе есть накладные расходы порядка сотни байт, а значения у нас часто
+меньше. Поэтому вместо `last_word:{cid}:{uid}` храним хэш `last_word:h:{cid}` с полем `{uid}`.
+Маленькие хэши редис хранит компактно (listpack), пока в них не больше `hash-max-listpack-entries`
+полей и значения не длиннее `hash-max-listpack-value` байт.
+
+Время жизни:
+
+- если редис умеет TTL у полей хэша (7.4+), то у каждого поля свой TTL через HEXPIRE;
+- иначе у всего хэша общий TTL, который продлевается при каждой записи;
+- для семейств, которые растут без конца (колбэки, хэши картинок), хэши делятся на поколения
+  длиной в TTL. Пишем в текущее, читаем из текущего и прошлого, так что значение живет от TTL
+  до двух TTL. Старое поколение удаляется редисом целиком.
+
+Старые ключи переносятся командой:
+
+    python -m src.utils.cache_buckets
+
+Пока перенос не сделан, при промахе значение ищется и по старому ключу.
+"""
+import pickle
+import re
+import time
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from src.utils import cache as cache_module
+from src.utils.cache import scan_delete
+from src.utils.logger_helpers import get_logger
+
+logger = get_logger(__name__)
+
+_redis_version: Optional[Tuple[int, int]] = None
+
+
+def get_redis_version() -> Tuple[int, int]:
+    global _redis_version
+    if _redis_version is None:
+        try:
+            version = cache_module._redis.info('server').get('redis_version', '0')
+            _redis_version = tuple(int(x) for x in (version.split('.') + ['0'])[:2])
+        except Exception:
+            _redis_version = (0, 0)
+    return _redis_version
+
+
+def is_field_ttl_supported() -> bool:
+    return get_redis_version() >= (7, 4)
+
+
+def is_expire_flags_supported() -> bool:
+    """
+    Флаги NX/XX/GT/LT у EXPIRE есть с редиса 7.0.
+    """
+    return get_redis_version() >= (7, 0)
+
+
+def modulo_bucket(value, buckets: int) -> str:
+    """
+    Номер хэша для семейств без естественной группировки: по uid или по crc32 строки.
+    """
+    if isinstance(value, str) and value.lstrip('-').isdigit():
+        value = int(value)
+    if isinstance(value, int):
+        return str(value % buckets)
+    return str(zlib.crc32(str(value).encode('utf-8')) % buckets)
+
+
+class BucketedCache:
+    """
+    Семейство ключей, разложенное по хэшам. Значения пиклятся, как в `Cache`.
+
+    :param family: префикс семейства, хэши называются `{family}:h:{bucket}`
+    :param ttl: время жизни значения
+    :param bucket_of: как получить имя хэша из поля, если оно не указано явно
+    :param generations: делить хэши на поколения (для семейств, которые растут без конца)
+    :param legacy_key: формат старого ключа с `{bucket}` и/или `{field}`, например
+        `'last_word:{bucket}:{field}'`. Нужен для чтения до переноса и для самого переноса.
+    """
+    registry: Dict[str, 'BucketedCache'] = {}
+
+    def __init__(self, family: str, ttl: int,
+                 bucket_of: Optional[Callable[[str], str]] = None,
+                 generations: bool = False,
+                 legacy_key: Optional[str] = None) -> None:
+        self.family = family
+        self.ttl = ttl
+        self.bucket_of = bucket_of
+        self.generations = generations
+        self.legacy_key = legacy_key
+        self._migrated = legacy_key is None
+        BucketedCache.registry[family] = self
+
+    def get(self, field, bucket=None, default=None):
+        bucket, field = self.__locate(field, bucket)
+        for key in self.__read_keys(bucket):
+            cached = cache_module._redis.hget(key, field)
+            if cached:
+                return pickle.loads(cached)
+        if not self.__is_migrated():
+            return cache_module.cache.get(self.__legacy(bucket, field), default)
+        return default
+
+    def get_many(self, fields: Iterable, bucket=None, default=None) -> list:
+        """
+        Как get, но за один запрос к редису.
+        """
+        located = [self.__locate(field, bucket) for field in fields]
+        pipe = cache_module._redis.pipeline(transaction=False)
+        for b, field in located:
+            for key in self.__read_keys(b):
+                pipe.hget(key, field)
+        values = iter(pipe.execute())
+        result = []
+        for b, field in located:
+            found = None
+            for _ in self.__read_keys(b):
+                cached = next(values)
+                if found is None and cached:
+                    found = pickle.loads(cached)
+            if found is None and not self.__is_migrated():
+                found = cache_module.cache.get(self.__legacy(b, field))
+            result.append(default if found is None else found)
+        return result
+
+    def set(self, field, value, bucket=None, ttl: Optional[int] = None) -> None:
+        bucket, field = self.__locate(field, bucket)
+        self.__write(self.__write_key(bucket), {field: pickle.dumps(value)}, ttl or self.ttl)
+
+    def touch(self, field, bucket=None) -> None:
+        """
+        Продлевает значение. Без TTL у полей продлевается весь хэш, поколения не продлеваются.
+        """
+        bucket, field = self.__locate(field, bucket)
+        key = self.__write_key(bucket)
+        if self.generations:
+            return
+        if is_field_ttl_supported():
+            cache_module._redis.hexpire(key, self.ttl, field)
+        else:
+            cache_module._redis.expire(key, self.ttl)
+
+    def delete(self, field, bucket=None) -> None:
+        bucket, field = self.__locate(field, bucket)
+        for key in self.__read_keys(bucket):
+            cache_module._redis.hdel(key, field)
+        if not self.__is_migrated():
+            cache_module.cache.delete(self.__legacy(bucket, field))
+
+    def clear(self, progress: Optional[Callable[[int, int], None]] = None) -> int:
+        deleted = scan_delete(cache_module._redis, f'{self.family}:h:*', progress=progress)
+        if self.legacy_key is not None:
+            deleted += scan_delete(cache_module._redis, self.__legacy('*', '*'), progress=progress)
+        return deleted
+
+    def migrate(self, batch_size: int = 500) -> int:
+        """
+        Переносит старые ключи в хэши с сохранением оставшегося времени жизни.
+        """
+        if self.legacy_key is None:
+            return 0
+        moved = 0
+        parse = self.__legacy_regex()
+        batch: List[str] = []
+
+        def flush() -> int:
+            pipe = cache_module._redis.pipeline(transaction=False)
+            for key in batch:
+                pipe.get(key)
+                pipe.pttl(key)
+            values = pipe.execute(raise_on_error=False)
+            moved_keys = []
+            for i, key in enumerate(batch):
+                value, pttl = values[2 * i], values[2 * i + 1]
+                match = parse.match(key)
+                if not isinstance(value, bytes) or match is None:
+                    continue
+                groups = match.groupdict()
+                bucket, field = self.__locate(groups['field'], groups.get('bucket'))
+                ttl = self.ttl if pttl is None or pttl < 0 else max(pttl // 1000, 1)
+                # бот продолжает работать, и в хэше уже может быть значение новее
+                self.__write(self.__write_key(bucket), {field: value}, ttl, replace=False)
+                moved_keys.append(key)
+            if moved_keys:
+                cache_module._redis.unlink(*moved_keys)
+            return len(moved_keys)
+
+        own_prefix = f'{self.family}:h:'
+        for key in cache_module._redis.scan_iter(match=self.__legacy('*', '*'), count=batch_size):
+            key = key.decode('utf-8') if isinstance(key, bytes) else key
+            # под старый паттерн могут попасть и сами хэши
+            if key.startswith(own_prefix):
+                continue
+            batch.append(key)
+            if len(batch) >= batch_size:
+                moved += flush()
+                batch = []
+        if batch:
+            moved += flush()
+        cache_module.pure_cache.set(self.__migrated_key(), '1')
+        self._migrated = True
+        logger.info(f'[cache_buckets] {self.family}: moved {moved} keys')
+        return moved
+
+    def __write(self, key: str, mapping: dict, ttl: int, replace: bool = True) -> None:
+        pipe = cache_module._redis.pipeline(transaction=False)
+        if replace:
+            pipe.hset(key, mapping=mapping)
+        else:
+            for field, value in mapping.items():
+                pipe.hsetnx(key, field, value)
+        extend = False
+        if self.generations:
+            # поколение удаляется целиком, когда из него уже никто не читает. Без NX время
+            # продлевается каждой записью, и поколение живет до двух TTL после последней
+            if is_expire_flags_supported():
+                pipe.expire(key, 2 * self.ttl, nx=True)
+            else:
+                pipe.expire(key, 2 * self.ttl)
+        elif is_field_ttl_supported():
+            # хэш удалится сам, когда истекут все его поля
+            pipe.hexpire(key, ttl, *mapping.keys())
+        elif replace:
+            pipe.expire(key, ttl)
+        elif is_expire_flags_supported():
+            # при переносе не укорачиваем время жизни всего хэша
+            pipe.expire(key, ttl, nx=True)
+            pipe.expire(key, ttl, gt=True)
+        else:
+            extend = True
+        pipe.execute()
+        if extend:
+            # то же без флагов, не атомарно: при переносе это не страшно
+            current = cache_module._redis.ttl(key)
+            if current == -1 or 0 <= current < ttl:
+                cache_module._redis.expire(key, ttl)
+
+    def __locate(self, field, bucket) -> Tuple[str, str]:
+        field = str(field)
+        if bucket is None:
+            bucket = self.bucket_of(field)
+        return str(bucket), field
+
+    def __generation(self) -> int:
+        return int(time.time()) // self.ttl
+
+    def __write_key(self, bucket: str) -> str:
+        if self.generations:
+            return f'{self.family}:h:{self.__generation()}:{bucket}'
+        return f'{self.family}:h:{bucket}'
+
+    def __read_keys(self, bucket: str) -> List[str]:
+        if self.generations:
+            generation = self.__generation()
+            return [f'{self.family}:h:{generation}:{bucket}',
+                    f'{self.family}:h:{generation - 1}:{bucket}']
+        return [f'{self.family}:h:{bucket}']
+
+    def __legacy(self, bucket, field) -> str:
+        return self.legacy_key.format(bucket=bucket, field=field)
+
+    def __legacy_regex(self):
+        parts = re.split(r'(\{bucket\}|\{field\})', self.legacy_key)
+        pattern = ''.join(
+            '(?P<bucket>.+?)' if part == '{bucket}' else
+            '(?P<field>.+)' if part == '{field}' else re.escape(part)
+            for part in parts)
+        return re.compile(f'^{pattern}$')
+
+    def __migrated_key(self) -> str:
+        return f'cache_buckets:migrated:{self.family}'
+
+    def __is_migrated(self) -> bool:
+        if not self._migrated:
+            self._migrated = cache_module.pure_cache.get(self.__migrated_key()) is not None
+        return self._migrated
+
+
+def import_families() -> None:
+    """
+    Семейства регистрируются при импорте своих модулей.
+    """
+    # noinspection PyUnresolvedReferences
+    import src.models.chat_user
+    # noinspection PyUnresolvedReferences
+    import src.models.user
+    # noinspection PyUnresolvedReferences
+    import src.modules.bayanometer
+    # noinspection PyUnresolvedReferences
+    import src.modules.last_word
+    # noinspection PyUnresolvedReferences
+    import src.utils.callback_helpers
+
+
+def migrate_all() -> Dict[str, int]:
+    import_families()
+    return {family: bucketed.migrate() for family, bucketed in BucketedCache.registry.items()}
+
+
+if __name__ == '__main__':
+    print(migrate_all())
@@ -1,16 +1,208 @@
+"""
+Данные инлайн-кнопок.
+
+Телеграм хранит у кнопки `callback_data` до 64 байт. Небольшие данные (модуль, действие, id)
+кодируются прямо в нее: компактный бинарный формат, подпись HMAC, base64url. Подпись нужна,
+чтобы нельзя было подделать нажатие со своими данными. Если данные не влезают или в них есть
+то, что формат не умеет (например, объекты моделей), они по-старому сохраняются в редис под
+uuid, а в кнопку пишется ключ.
+
+Формат: `_` + base64url(версия, значение, первые 8 байт HMAC-SHA256). Значение — это None,
+bool, int, str, list или dict из них. Часто встречающиеся строки (ключи и названия модулей)
+записываются одним байтом по индексу в `WORDS`. Алфавит base64url подходит и для диплинков
+(`?start=`), куда уходит `callback_data` в `last_word`.
+"""
+import base64
+import hashlib
+import hmac
 import uuid
+from typing import Any, List, Optional, Tuple
 
 import telegram
 
-from src.utils.cache import cache, USER_CACHE_EXPIRE
+from src.config import CONFIG
+from src.utils.cache import USER_CACHE_EXPIRE
+from src.utils.cache_buckets import BucketedCache, modulo_bucket
+
+# колбэков много и они одноразовые, поэтому хэши делятся на поколения
+callback_cache = BucketedCache('callback', USER_CACHE_EXPIRE,
+                               bucket_of=lambda key: modulo_bucket(key, 256),
+                               generations=True, legacy_key='callback:{field}')
+
+MAX_CALLBACK_DATA = 64
+PREFIX = '_'  # uuid с него не начинается
+VERSION = 1
+TAG_SIZE = 8
+
+# индекс строки — ее код, поэтому только дописывать в конец: старые кнопки живут в чатах вечно
+WORDS = (
+    'name', 'module', 'value', 'id', 'message_id', 'active_id', 'chat_id', 'card_id',
+    'spoiler_id', 'case_uid', 'heart', 'type', 'bot_command', 'plohish_id', 'valid_cmd_name',
+    'leaves_uid', 'dayof', 'matshowtime', 'spoiler', 'i_stat', 'send_video', 'instagram',
+    'fsb_day', 'valentine_day', 'last_word', '/off', 'bayanometer_show_orig',
+    'matshowtime_like_click', 'matshowtime_dislike_click', 'spoiler_show_click',
+    'istat_show_click', 'send_video_upload', 'like', 'dislike', 'begin', 'stuk', 'donate', 'wtf',
+    'chat', 'revn', 'mig', 'about',
+)
+_WORD_CODES = {word: code for code, word in enumerate(WORDS)}
+
+# коды 0x00-0x7f — строки из WORDS
+_NONE, _TRUE, _FALSE, _INT, _STR, _LIST, _DICT = range(0x80, 0x87)
 
 
 def get_callback_data(data) -> str:
+    encoded = encode_callback_data(data)
+    if encoded is not None:
+        return encoded
     key = str(uuid.uuid4())
-    cache.set(f'callback:{key}', data, time=USER_CACHE_EXPIRE)
+    callback_cache.set(key, data)
     return key
 
 
+def get_callback_data_by_key(key: str):
+    if key.startswith(PREFIX):
+        return decode_callback_data(key)
+    return callback_cache.get(key)
+
+
+def encode_callback_data(data) -> Optional[str]:
+    """
+    Данные в виде `callback_data` или None, если их нужно хранить в редисе.
+    """
+    secret = _get_secret()
+    if secret is None:
+        return None
+    payload = bytearray([VERSION])
+    if not _write(payload, data):
+        return None
+    payload += _sign(secret, payload)
+    encoded = PREFIX + base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+    if len(encoded) > MAX_CALLBACK_DATA:
+        return None
+    return encoded
+
+
+def decode_callback_data(callback_data: str):
+    """
+    None, если данные испорчены или подписаны не нами.
+    """
+    secret = _get_secret()
+    if secret is None:
+        return None
+    encoded = callback_data[len(PREFIX):]
+    try:
+        payload = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+    except ValueError:
+        return None
+    body, tag = payload[:-TAG_SIZE], payload[-TAG_SIZE:]
+    if len(body) < 2 or body[0] != VERSION or not hmac.compare_digest(tag, _sign(secret, body)):
+        return None
+    try:
+        value, position = _read(body, 1)
+    except (IndexError, TypeError, UnicodeDecodeError, ValueError):
+        return None
+    return value if position == len(body) else None
+
+
 def remove_inline_keyboard(bot: telegram.Bot, chat_id: int, message_id: int) -> None:
     reply_markup = telegram.InlineKeyboardMarkup([])
     bot.editMessageReplyMarkup(chat_id, message_id, reply_markup=reply_markup)
+
+
+def _get_secret() -> Optional[bytes]:
+    secret = CONFIG.get('callback_secret') or CONFIG.get('bot_token')
+    if not secret:
+        return None
+    return hashlib.sha256(f'callback_data:{secret}'.encode('utf-8')).digest()
+
+
+def _sign(secret: bytes, payload: bytes) -> bytes:
+    return hmac.new(secret, bytes(payload), hashlib.sha256).digest()[:TAG_SIZE]
+
+
+def _write(out: bytearray, value: Any) -> bool:
+    """
+    Дописывает значение в `out`. False, если тип не поддерживается: тогда данные идут в редис,
+    где пикл сохранит их как есть (кортежи, объекты).
+    """
+    value_type = type(value)
+    if value is None:
+        out.append(_NONE)
+    elif value_type is bool:
+        out.append(_TRUE if value else _FALSE)
+    elif value_type is int:
+        out.append(_INT)
+        _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif value_type is str:
+        code = _WORD_CODES.get(value)
+        if code is not None:
+            out.append(code)
+            return True
+        raw = value.encode('utf-8')
+        out.append(_STR)
+        _write_varint(out, len(raw))
+        out += raw
+    elif value_type is list:
+        out.append(_LIST)
+        _write_varint(out, len(value))
+        return all(_write(out, item) for item in value)
+    elif value_type is dict:
+        out.append(_DICT)
+        _write_varint(out, len(value))
+        return all(type(key) is str and _write(out, key) and _write(out, item)
+                   for key, item in value.items())
+    else:
+        return False
+    return True
+
+
+def _read(data: bytes, position: int) -> Tuple[Any, int]:
+    tag = data[position]
+    position += 1
+    if tag < len(WORDS):
+        return WORDS[tag], position
+    if tag == _NONE:
+        return None, position
+    if tag in (_TRUE, _FALSE):
+        return tag == _TRUE, position
+    if tag == _INT:
+        number, position = _read_varint(data, position)
+        return (number // 2 if number % 2 == 0 else -(number + 1) // 2), position
+    if tag == _STR:
+        size, position = _read_varint(data, position)
+        if position + size > len(data):
+            raise ValueError('truncated string')
+        return data[position:position + size].decode('utf-8'), position + size
+    if tag == _LIST:
+        size, position = _read_varint(data, position)
+        items: List[Any] = []
+        for _ in range(size):
+            item, position = _read(data, position)
+            items.append(item)
+        return items, position
+    if tag == _DICT:
+        size, position = _read_varint(data, position)
+        result = {}
+        for _ in range(size):
+            key, position = _read(data, position)
+            result[key], position = _read(data, position)
+        return result, position
+    raise ValueError(f'unknown tag {tag}')
+
+
+def _write_varint(out: bytearray, number: int) -> None:
+    while number >= 0x80:
+        out.append(number & 0x7f | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _read_varint(data: bytes, position: int) -> Tuple[int, int]:
+    number = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
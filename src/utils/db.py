@@ -1,10 +1,12 @@
 from contextlib import contextmanager
+from typing import List, Optional
 
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from src.config import CONFIG
+from src.utils.db_stats import InstrumentedQueuePool, instrument_engine
 from src.utils.logger_helpers import get_logger
 from src.utils.misc import retry
 
@@ -43,8 +45,80 @@ def add_to_db(value):
         raise Exception("Can't add value to DB")
 
 
+def fetch_all(statement) -> list:
+    """
+    Выполняет select из SQLAlchemy Core без сессии: без identity map, expunge и коммита.
+    Строки можно сразу превращать в легкие модели через `row._mapping`.
+    """
+    with engine.connect() as conn:
+        return conn.execute(statement).fetchall()
+
+
+def fetch_first(statement):
+    with engine.connect() as conn:
+        return conn.execute(statement).first()
+
+
+def upsert_statement(model, values: dict, index_elements: List[str],
+                     update: Optional[dict] = None):
+    """
+    Вставка или обновление одним запросом: в mysql это `INSERT ... ON DUPLICATE KEY UPDATE`,
+    в sqlite — `INSERT ... ON CONFLICT DO UPDATE`.
+
+    :param index_elements: колонки первичного или уникального ключа (нужны для sqlite)
+    :param update: что обновить, если строка уже есть. Значения могут ссылаться на текущие,
+        например `{'count': Model.count + 1}`. Если пусто, то существующая строка не меняется.
+    """
+    table = model.__table__
+    if engine.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        stmt = sqlite_insert(table).values(**values)
+        if not update:
+            return stmt.on_conflict_do_nothing(index_elements=index_elements)
+        return stmt.on_conflict_do_update(index_elements=index_elements, set_=update)
+
+    from sqlalchemy.dialects.mysql import insert as mysql_insert
+    stmt = mysql_insert(table).values(**values)
+    if not update:
+        # ничего не меняющее обновление, чтобы дубль не был ошибкой
+        first = index_elements[0]
+        return stmt.on_duplicate_key_update(**{first: getattr(table.c, first)})
+    return stmt.on_duplicate_key_update(**update)
+
+
+def upsert(model, values: dict, index_elements: List[str], update: Optional[dict] = None) -> None:
+    with session_scope() as db:
+        db.execute(upsert_statement(model, values, index_elements, update))
+
+
+def get_engine_options(url: str, pool_config: dict) -> dict:
+    """
+    Параметры движка из `database_pool` в конфиге. У sqlite свой пул, настройки пула к нему
+    не применяются.
+    """
+    options = {'convert_unicode': True, 'echo': False}
+    if url.startswith('sqlite'):
+        return options
+    options.update({
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': pool_config.get('size', 10),
+        'max_overflow': pool_config.get('max_overflow', 20),
+        'pool_timeout': pool_config.get('timeout', 10),
+        # mysql закрывает неактивные соединения через wait_timeout (8 часов по-умолчанию)
+        'pool_recycle': pool_config.get('recycle', 3600),
+        'pool_pre_ping': pool_config.get('pre_ping', True),
+    })
+    return options
+
+
+def create_db_engine(url: str, pool_config: dict):
+    db_engine = create_engine(url, **get_engine_options(url, pool_config))
+    instrument_engine(db_engine, slow_query_ms=pool_config.get('slow_query_ms', 500))
+    return db_engine
+
+
 if 'database' in CONFIG:
-    engine = create_engine(CONFIG['database'], convert_unicode=True, echo=False)
+    engine = create_db_engine(CONFIG['database'], CONFIG.get('database_pool', {}))
     Base.metadata.create_all(engine)
 
     session_factory = sessionmaker(bind=engine)
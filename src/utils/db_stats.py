@@ -0,0 +1,182 @@
+"""
+Статистика работы с бд: время запросов, ожидание соединения из пула и лог медленных запросов.
+
+Хуки вешаются на движок в `instrument_engine`. Собранное лежит в `db_stats` и доступно
+через `db_stats.snapshot()`. Время считается отдельно по каждому запросу, приведенному к общему
+виду (`normalize_sql`), но не больше чем для `DbStats.max_statements` разных запросов: остальные
+попадают в общий `OTHER_STATEMENTS`.
+"""
+import re
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Callable, Deque, Dict, List, NamedTuple, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from src.utils.logger_helpers import get_logger
+
+logger = get_logger(__name__)
+
+# границы корзин гистограммы, в секундах
+BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5.)
+
+_re_spaces = re.compile(r'\s+')
+_re_strings = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_re_numbers = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_re_in_list = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+# куда идут запросы сверх лимита
+OTHER_STATEMENTS = 'other'
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(statement: str) -> str:
+    """
+    Приводит запрос к общему виду: литералы заменяются на `?`, списки в `IN (...)` схлопываются.
+    Так одинаковые запросы с разными параметрами попадают в лог одной строкой.
+    """
+    sql = _re_spaces.sub(' ', statement).strip()
+    sql = _re_strings.sub('?', sql)
+    sql = _re_numbers.sub('?', sql)
+    return _re_in_list.sub('(...)', sql)
+
+
+def get_statement_type(statement: str) -> str:
+    first = statement.lstrip().split(None, 1)
+    if not first:
+        return 'other'
+    verb = first[0].lower()
+    return verb if verb in ('select', 'insert', 'update', 'delete') else 'other'
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина — все что больше
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def to_dict(self) -> dict:
+        return {'buckets': self.buckets, 'counts': list(self.counts),
+                'count': self.count, 'sum': self.sum}
+
+
+class SlowQuery(NamedTuple):
+    sql: str
+    duration: float
+    at: float
+
+
+class DbStats:
+    max_slow_queries = 100
+    max_statements = 200
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.slow_query_threshold = 0.5
+        self.statements: Dict[str, Histogram] = {}
+        self.checkout_wait = Histogram()
+        self.checkout_timeouts = 0
+        self.errors = 0
+        self.slow_queries: Deque[SlowQuery] = deque(maxlen=self.max_slow_queries)
+        # кому еще сообщать о каждом запросе (метрики обработчиков)
+        self.listeners: List[Callable[[float], None]] = []
+
+    def observe_statement(self, statement: str, duration: float) -> None:
+        sql = normalize_sql(statement)
+        with self.lock:
+            histogram = self.statements.get(sql)
+            if histogram is None:
+                if len(self.statements) >= self.max_statements:
+                    sql_key = OTHER_STATEMENTS
+                    histogram = self.statements.get(sql_key)
+                else:
+                    sql_key = sql
+                if histogram is None:
+                    histogram = self.statements[sql_key] = Histogram()
+            histogram.observe(duration)
+        for listener in self.listeners:
+            listener(duration)
+        if duration >= self.slow_query_threshold:
+            with self.lock:
+                self.slow_queries.append(SlowQuery(sql, duration, time.time()))
+            logger.warning(f'[db] slow query {duration:.3f} sec: {sql}')
+
+    def observe_checkout(self, duration: float) -> None:
+        with self.lock:
+            self.checkout_wait.observe(duration)
+
+    def add_checkout_timeout(self) -> None:
+        with self.lock:
+            self.checkout_timeouts += 1
+
+    def add_error(self) -> None:
+        with self.lock:
+            self.errors += 1
+
+    def get_slow_queries(self) -> List[SlowQuery]:
+        with self.lock:
+            return list(self.slow_queries)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'statements': {k: v.to_dict() for k, v in self.statements.items()},
+                'checkout_wait': self.checkout_wait.to_dict(),
+                'checkout_timeouts': self.checkout_timeouts,
+                'errors': self.errors,
+                'slow_queries': len(self.slow_queries),
+            }
+
+
+db_stats = DbStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    Пул, который замеряет, сколько поток ждал свободное соединение.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            db_stats.add_checkout_timeout()
+            logger.error(f'[db] pool exhausted: {self.status()}')
+            raise
+        db_stats.observe_checkout(time.perf_counter() - start)
+        return conn
+
+
+def instrument_engine(engine, slow_query_ms: int = 500) -> None:
+    db_stats.slow_query_threshold = slow_query_ms / 1000
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_start'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('query_start', None)
+        if start is not None:
+            db_stats.observe_statement(statement, time.perf_counter() - start)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        if context.connection is not None:
+            context.connection.info.pop('query_start', None)
+        db_stats.add_error()
@@ -1,3 +1,4 @@
+import types
 from functools import wraps
 
 import telegram
@@ -10,6 +11,9 @@ from src.models.user_stat import UserStat
 from src.commands.i_stat.add_message_handler import IStatAddMessage
 from src.utils.handlers_helpers import check_command_is_off, get_command_name, \
     send_chat_access_denied, is_command_enabled_for_chat, check_user_is_plohish
+from src.utils.lanes import Lane
+from src.utils.metrics import metrics, get_handler_name
+from src.utils.profiler import profiler
 
 
 def only_users_from_main_chat(func):
@@ -77,13 +81,87 @@ def collect_stats(func):
     def decorator(bot: telegram.Bot, update: telegram.Update):
         if update.message.from_user.is_bot:
             return
-        User.add_user(update.message.from_user)
-        UserStat.add(UserStat.parse_message_stat(update.message.from_user.id,
-                                                 update.message.chat_id,
-                                                 update.message,
-                                                 update.message.parse_entities()))
-        ReplyTop.parse_message(update.message)
-        IStatAddMessage.add_message(update.message)
+        collect_message_stats(update.message)
         return func(bot, update)
 
     return decorator
+
+
+def collect_message_stats(message: telegram.Message) -> None:
+    """
+    Тело `collect_stats`. Отдельно — для этапа конвейера обычных сообщений.
+    """
+    if message.from_user.is_bot:
+        return
+    User.add_user(message.from_user)
+    UserStat.add(UserStat.parse_message_stat(message.from_user.id, message.chat_id, message,
+                                             message.parse_entities()))
+    ReplyTop.parse_message(message)
+    IStatAddMessage.add_message(message)
+
+
+def measure_handler(func):
+    """
+    Метрики обработчика: число апдейтов, время, запросы к редису и бд.
+    Медленные апдейты профилируются, если это включено в конфиге (см. src/utils/profiler.py)
+    """
+    name = get_handler_name(func)
+
+    @wraps(func)
+    def decorator(*args, **kwargs):
+        with metrics.track_handler(name), profiler.watch(name, _get_chat_id(args)):
+            return func(*args, **kwargs)
+
+    return decorator
+
+
+def _get_chat_id(args):
+    for arg in args[:2]:
+        if isinstance(arg, telegram.Update):
+            return arg.effective_chat.id if arg.effective_chat else None
+        if isinstance(arg, telegram.Message):
+            return arg.chat_id
+    return None
+
+
+def instrument_handlers(dp) -> None:
+    """
+    Вешает measure_handler на все зарегистрированные обработчики.
+
+    Обработчик в полосе (`src/utils/lanes.py`) при вызове только ставит себя в ее очередь.
+    Поэтому замер ставится внутрь, под полосу: так считается время работы в потоке полосы.
+    Очередь и занятость пула `run_async` считаются в самом `dp.run_async`, через который
+    идет вся его работа.
+    """
+    for handlers in dp.handlers.values():
+        for handler in handlers:
+            handler.callback = _instrument_callback(handler.callback)
+    _instrument_run_async(dp)
+
+
+def _instrument_callback(callback):
+    func = getattr(callback, '__func__', callback)
+    unwrapped = Lane.unwrap(func)
+    if unwrapped is None:
+        return measure_handler(callback)
+    # очередь и занятость полосы она считает сама
+    lane, original = unwrapped
+    lane_func = lane(measure_handler(original))
+    if func is not callback:
+        return types.MethodType(lane_func, callback.__self__)
+    return lane_func
+
+
+def _instrument_run_async(dp) -> None:
+    run_async = dp.run_async
+
+    def run(func, *args, **kwargs):
+        with metrics.async_running():
+            return func(*args, **kwargs)
+
+    @wraps(run_async)
+    def measured_run_async(func, *args, **kwargs):
+        metrics.async_enqueued()
+        return run_async(run, func, *args, **kwargs)
+
+    dp.run_async = measured_run_async
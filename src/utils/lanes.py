@@ -0,0 +1,151 @@
+"""
+Полосы (lanes) — отдельные пулы потоков вместо общего пула `run_async` диспетчера.
+
+Раньше команды (`/weather`, `/whois`, `/pomogite`) стояли в одной очереди из 32 воркеров
+с подсчетом статистики, реакциями и скачиваниями. Когда в чатах флуд, ответ на команду ждал,
+пока разберутся сотни обычных сообщений. Теперь у каждого вида работы своя очередь:
+
+- `interactive_lane` — команды и нажатия кнопок, то есть то, где человек ждет ответа;
+- `passive_lane` — статистика и реакции на обычные сообщения. Почти вся эта работа ходит в бд,
+  поэтому по-умолчанию пул размером с пул соединений, как и этапы `db` у конвейера;
+- `heavy_io_lane` — долгое: внешние сервисы, скачивания, картинки, ежедневные рассылки
+  по всем чатам.
+
+Полоса используется как `@run_async`: функция ставится в очередь полосы и сразу возвращает
+`Future`. Размеры полос — в разделе `lanes` конфига. Для каждой полосы в метрики отдаются
+размер, занятые потоки, длина очереди и загрузка (`bot_lane_*`).
+"""
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import wraps
+from typing import Callable, Dict, Optional, Tuple
+
+from src.config import CONFIG
+from src.utils.logger_helpers import get_logger
+
+logger = get_logger(__name__)
+
+# None — по размеру пула соединений с бд
+DEFAULT_WORKERS: Dict[str, Optional[int]] = {'interactive': 16, 'passive': None, 'heavy_io': 16}
+
+
+class Lane:
+    def __init__(self, name: str, workers: Optional[int] = None) -> None:
+        self.name = name
+        self._workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Condition()
+        self.queued = 0
+        self.busy = 0
+        self.tasks = 0
+        self.errors: Counter = Counter()
+        self.wait_total = 0.
+        self.wait_max = 0.
+
+    @property
+    def workers(self) -> int:
+        if self._workers is None:
+            self._workers = get_configured_workers(self.name)
+        return self._workers
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        # пул создается при первой задаче, когда конфиг уже точно прочитан
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers,
+                                                        thread_name_prefix=f'lane-{self.name}')
+        return self._executor
+
+    @property
+    def in_flight(self) -> int:
+        return self.queued + self.busy
+
+    @property
+    def saturation(self) -> float:
+        """
+        Доля занятых потоков. Если она держится у единицы, а очередь растет, полосе мало потоков.
+        """
+        return self.busy / self.workers if self.workers else 0
+
+    def __call__(self, func: Callable) -> Callable:
+        lane = self
+
+        @wraps(func)
+        def lane_func(*args, **kwargs) -> Future:
+            return lane.submit(func, *args, **kwargs)
+
+        # по этим атрибутам instrument_handlers находит исходную функцию и полосу (см. unwrap)
+        lane_func.lane = lane
+        lane_func.lane_wrapper = lane_func
+        return lane_func
+
+    @staticmethod
+    def unwrap(func: Callable) -> Optional[Tuple['Lane', Callable]]:
+        """
+        Полоса и исходная функция, если `func` — обертка полосы, иначе None.
+
+        Внешние декораторы с @wraps копируют себе атрибуты обертки, поэтому она узнается
+        по ссылке на саму себя.
+        """
+        if getattr(func, 'lane_wrapper', None) is not func:
+            return None
+        return func.lane, func.__wrapped__
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            self.queued += 1
+        return self.executor.submit(self.__run, time.perf_counter(), func, args, kwargs)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ждет, пока полоса не опустеет. Для тестов и бенчмарка.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self.in_flight:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._lock.wait(left)
+        return True
+
+    def __run(self, enqueued: float, func: Callable, args: tuple, kwargs: dict):
+        wait = time.perf_counter() - enqueued
+        with self._lock:
+            self.queued -= 1
+            self.busy += 1
+            self.tasks += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            # как и run_async, ошибку только логируем: результат задач никто не ждет
+            with self._lock:
+                self.errors[type(e).__name__] += 1
+            logger.exception(f'[lane {self.name}] {getattr(func, "__qualname__", func)} failed')
+        finally:
+            with self._lock:
+                self.busy -= 1
+                self._lock.notify_all()
+
+
+def get_configured_workers(name: str) -> int:
+    config = CONFIG.get('lanes', {}).get(name, {})
+    if 'workers' in config:
+        return int(config['workers'])
+    default = DEFAULT_WORKERS.get(name)
+    if default is None:
+        return int(CONFIG.get('database_pool', {}).get('size', 10))
+    return default
+
+
+interactive_lane = Lane('interactive')
+passive_lane = Lane('passive')
+heavy_io_lane = Lane('heavy_io')
+
+LANES = (interactive_lane, passive_lane, heavy_io_lane)
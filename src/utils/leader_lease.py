@@ -0,0 +1,131 @@
+"""
+Лидерство в кластере через аренду ключа в редисе.
+
+Каждый воркер кластера регистрирует у себя все задачи из `add_jobs`, но выполняет их только
+лидер — тот, у кого сейчас аренда. Лидер продлевает аренду каждую треть `ttl`. Если он упал
+или потерял связь с редисом, аренда истекает и ее забирает другой воркер.
+
+Себя лидером воркер считает только две трети `ttl` с начала последнего удачного продления,
+то есть раньше, чем ключ истечет в редисе. Так два воркера не бывают лидерами одновременно,
+даже если продление зависло.
+
+Задача, время которой пришлось на смену лидера, ни на ком не выполнится. Поэтому `guard` с
+именем задачи запоминает в редисе время ее последнего выполнения, а при получении аренды
+вызываются `on_acquire`-колбэки: через них `add_jobs` запускает пропущенные задачи.
+"""
+import os
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from functools import wraps
+from typing import Callable, List, Optional
+
+import redis
+
+from src.utils.cache import pure_cache
+from src.utils.logger_helpers import get_logger
+
+logger = get_logger(__name__)
+
+
+class LeaderLease:
+    def __init__(self, name: str, owner: Optional[str] = None, ttl: float = 60) -> None:
+        self.key = f'leader_lease:{name}'
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        self.ttl = ttl
+        self._leader_until = 0.
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._on_acquire: List[Callable[[], None]] = []
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._leader_until
+
+    def renew(self) -> bool:
+        started = time.monotonic()
+        was_leader = self.is_leader
+        try:
+            acquired = pure_cache.acquire_lease(self.key, self.owner, self.ttl)
+        except redis.RedisError as e:
+            logger.warning(f'[leader_lease] {self.key}: {e}')
+            acquired = False
+        if acquired:
+            self._leader_until = started + self.ttl * 2 / 3
+        else:
+            self._leader_until = 0.
+        if acquired != was_leader:
+            logger.info(f'[leader_lease] {self.owner} {"is" if acquired else "is not"} '
+                        f'the leader of {self.key}')
+        if acquired and not was_leader:
+            for callback in self._on_acquire:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f'[leader_lease] on_acquire: {repr(e)}')
+        return acquired
+
+    def on_acquire(self, callback: Callable[[], None]) -> None:
+        """
+        Колбэк при получении аренды. Вызывается из потока продления, поэтому должен быть
+        быстрым: долгую работу стоит отдать в очередь задач.
+        """
+        self._on_acquire.append(callback)
+
+    def start(self) -> None:
+        self.renew()
+        self._thread = threading.Thread(target=self.__run, name='LeaderLease', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._leader_until = 0.
+        # отдаем аренду сразу, чтобы другой воркер не ждал, пока она истечет
+        try:
+            pure_cache.release_lease(self.key, self.owner)
+        except redis.RedisError as e:
+            logger.warning(f'[leader_lease] {self.key}: {e}')
+
+    def guard(self, func: Callable, name: Optional[str] = None) -> Callable:
+        """
+        Декоратор для задач: выполнять только на лидере. С `name` время выполнения задачи
+        запоминается (`get_last_run`). Если задача вернула Future (полосы из `lanes`),
+        то время запоминается, когда она закончится.
+        """
+
+        @wraps(func)
+        def decorator(*args, **kwargs):
+            if not self.is_leader:
+                logger.debug(f'[leader_lease] skip {func.__name__}: not the leader')
+                return None
+            result = func(*args, **kwargs)
+            if name is not None:
+                if isinstance(result, Future):
+                    result.add_done_callback(lambda _: self.set_last_run(name))
+                else:
+                    self.set_last_run(name)
+            return result
+
+        return decorator
+
+    @staticmethod
+    def get_last_run(name: str) -> Optional[float]:
+        """
+        Unix-время последнего выполнения задачи или None, если его не запоминали.
+        """
+        last_run = pure_cache.get(f'job_last_run:{name}')
+        return None if last_run is None else float(last_run)
+
+    @staticmethod
+    def set_last_run(name: str, when: Optional[float] = None) -> None:
+        try:
+            pure_cache.set(f'job_last_run:{name}', time.time() if when is None else when)
+        except redis.RedisError as e:
+            logger.warning(f'[leader_lease] job {name}: {e}')
+
+    def __run(self) -> None:
+        while not self._stop.wait(self.ttl / 3):
+            self.renew()
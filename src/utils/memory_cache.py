@@ -0,0 +1,589 @@
+"""
+Кэш в памяти процесса вместо редиса: для небольших инсталляций без редиса, тестов и бенчмарков.
+
+`MemoryRedis` повторяет ту часть API redis-py, которой пользуются `Cache`, `PureCache`
+и `BucketedCache`: строки с TTL, счетчики, списки, множества, хэши с TTL у полей (как в 7.4),
+SCAN, пайплайны. Значения кодируются тем же `Encoder`, что и в redis-py, поэтому клиент
+без `decode_responses` возвращает байты, а с ним — строки. Оба клиента работают с одним
+`MemoryStore`, как с одной базой редиса.
+
+Lua-скриптов нет: для `eval` нужна python-версия скрипта, см. `register_script`.
+
+Истекшие ключи удаляются при обращении и фоновым потоком раз в `sweep_interval` секунд.
+Если указан `snapshot`, то тот же поток раз в `snapshot_interval` секунд сохраняет данные
+на диск (pickle), еще раз они сохраняются при выходе и загружаются при старте.
+"""
+import atexit
+import fnmatch
+import os
+import pickle
+import random
+import threading
+import time as time_module
+from datetime import timedelta
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import redis
+from redis.connection import Encoder
+
+from src.utils.logger_helpers import get_logger
+from src.utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+REDIS_VERSION = '7.4.0'  # версия, чьи команды поддерживаются (TTL у полей хэшей)
+
+_scripts: Dict[str, Callable[['MemoryRedis', list, list], Any]] = {}
+
+
+def register_script(script: str, func: Callable[['MemoryRedis', list, list], Any]) -> None:
+    """
+    Python-версия lua-скрипта для `MemoryRedis.eval`: `func(client, keys, args)`.
+    Выполняется под блокировкой хранилища, то есть атомарно, как и в редисе.
+    """
+    _scripts[script] = func
+
+
+def _wrong_type() -> redis.ResponseError:
+    return redis.ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+
+
+def _seconds(value) -> float:
+    return value.total_seconds() if isinstance(value, timedelta) else value
+
+
+class MemoryStore:
+    def __init__(self, snapshot: Optional[str] = None, snapshot_interval: int = 300,
+                 sweep_interval: int = 60) -> None:
+        self.lock = threading.RLock()
+        self.data: Dict[bytes, Any] = {}
+        self.expires: Dict[bytes, float] = {}  # ключ -> unix-время истечения
+        self.field_expires: Dict[bytes, Dict[bytes, float]] = {}
+        self.snapshot = snapshot
+        self.snapshot_interval = snapshot_interval
+        self.sweep_interval = sweep_interval
+        self._saved_at = time_module.monotonic()
+        if snapshot:
+            self.load()
+            atexit.register(self.save)
+        if sweep_interval:
+            threading.Thread(target=self.__maintenance_loop, name='MemoryCacheMaintenance',
+                             daemon=True).start()
+
+    def get(self, key: bytes, kind: Optional[type] = None, now: Optional[float] = None):
+        """
+        Значение живого ключа или None. Если у ключа другой тип, то WRONGTYPE, как в редисе.
+        """
+        now = time_module.time() if now is None else now
+        expire = self.expires.get(key)
+        if expire is not None and expire <= now:
+            self.remove(key)
+            return None
+        value = self.data.get(key)
+        if value is None:
+            return None
+        if kind is not None and not isinstance(value, kind):
+            raise _wrong_type()
+        if isinstance(value, dict) and key in self.field_expires:
+            self.__expire_fields(key, now)
+            if key not in self.data:
+                return None
+        return value
+
+    def put(self, key: bytes, value, keep_ttl: bool = False) -> None:
+        self.data[key] = value
+        self.field_expires.pop(key, None)
+        if not keep_ttl:
+            self.expires.pop(key, None)
+
+    def remove(self, key: bytes) -> bool:
+        self.expires.pop(key, None)
+        self.field_expires.pop(key, None)
+        return self.data.pop(key, None) is not None
+
+    def remove_if_empty(self, key: bytes) -> None:
+        if not self.data.get(key, True):
+            self.remove(key)
+
+    def sweep(self) -> None:
+        with self.lock:
+            now = time_module.time()
+            for key in [key for key, expire in self.expires.items() if expire <= now]:
+                self.remove(key)
+            for key in list(self.field_expires):
+                self.__expire_fields(key, now)
+
+    def save(self) -> None:
+        if not self.snapshot:
+            return
+        with self.lock:
+            self.sweep()
+            payload = pickle.dumps({'data': self.data, 'expires': self.expires,
+                                    'field_expires': self.field_expires},
+                                   protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            directory = os.path.dirname(self.snapshot)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp = f'{self.snapshot}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp, self.snapshot)
+            self._saved_at = time_module.monotonic()
+        except Exception as e:
+            logger.error(f"[memory_cache] can't save snapshot {self.snapshot}: {e}")
+
+    def load(self) -> None:
+        try:
+            with open(self.snapshot, 'rb') as f:
+                payload = pickle.loads(f.read())
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"[memory_cache] can't load snapshot {self.snapshot}: {e}")
+            return
+        with self.lock:
+            self.data = payload['data']
+            self.expires = payload['expires']
+            self.field_expires = payload['field_expires']
+            self.sweep()
+        logger.info(f'[memory_cache] loaded {len(self.data)} keys from {self.snapshot}')
+
+    def __expire_fields(self, key: bytes, now: float) -> None:
+        fields = self.field_expires[key]
+        value = self.data.get(key)
+        for field in [field for field, expire in fields.items() if expire <= now]:
+            del fields[field]
+            if isinstance(value, dict):
+                value.pop(field, None)
+        if not fields:
+            del self.field_expires[key]
+        if isinstance(value, dict):
+            self.remove_if_empty(key)
+
+    def __maintenance_loop(self) -> None:
+        while True:
+            time_module.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+                elapsed = time_module.monotonic() - self._saved_at
+                if self.snapshot and elapsed >= self.snapshot_interval:
+                    self.save()
+            except Exception as e:
+                logger.error(f'[memory_cache] maintenance failed: {e}')
+
+
+def _command(func):
+    """
+    Команда выполняется под блокировкой хранилища и считается в метриках как запрос к редису:
+    это тот же кэш, только без сети. В пайплайне вызывается `__wrapped__` без метрик.
+    """
+
+    @wraps(func)
+    def wrapper(self: 'MemoryRedis', *args, **kwargs):
+        start = time_module.perf_counter()
+        try:
+            with self.store.lock:
+                return func(self, *args, **kwargs)
+        finally:
+            metrics.record_call('redis', time_module.perf_counter() - start)
+
+    return wrapper
+
+
+class MemoryRedis:
+    def __init__(self, store: MemoryStore, decode_responses: bool = False) -> None:
+        self.store = store
+        self.encoder = Encoder('utf-8', 'strict', decode_responses)
+
+    def _key(self, name) -> bytes:
+        return self.encoder.encode(name)
+
+    def _out(self, value):
+        return self.encoder.decode(value) if value is not None else None
+
+    # строки
+
+    @_command
+    def get(self, name):
+        return self._out(self.store.get(self._key(name), bytes))
+
+    @_command
+    def mget(self, keys, *args) -> list:
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        result = []
+        for key in keys + list(args):
+            value = self.store.get(self._key(key))
+            result.append(self._out(value) if isinstance(value, bytes) else None)
+        return result
+
+    @_command
+    def set(self, name, value, ex=None, px=None, nx: bool = False, xx: bool = False,
+            keepttl: bool = False) -> Optional[bool]:
+        key = self._key(name)
+        exists = self.store.get(key) is not None
+        if (nx and exists) or (xx and not exists):
+            return None
+        self.store.put(key, self.encoder.encode(value), keep_ttl=keepttl)
+        if ex is not None:
+            self.store.expires[key] = time_module.time() + _seconds(ex)
+        elif px is not None:
+            self.store.expires[key] = time_module.time() + _seconds(px) / 1000
+        return True
+
+    @_command
+    def incr(self, name, amount: int = 1) -> int:
+        key = self._key(name)
+        value = self.store.get(key, bytes)
+        try:
+            number = int(value or 0) + amount
+        except ValueError:
+            raise redis.ResponseError('value is not an integer or out of range')
+        self.store.put(key, str(number).encode(), keep_ttl=True)
+        return number
+
+    incrby = incr
+
+    # ключи
+
+    @_command
+    def delete(self, *names) -> int:
+        return sum(self.store.remove(self._key(name)) for name in names
+                   if self.store.get(self._key(name)) is not None)
+
+    unlink = delete
+
+    @_command
+    def exists(self, *names) -> int:
+        return sum(self.store.get(self._key(name)) is not None for name in names)
+
+    @_command
+    def expire(self, name, time, nx: bool = False, xx: bool = False, gt: bool = False,
+               lt: bool = False) -> bool:
+        key = self._key(name)
+        if self.store.get(key) is None:
+            return False
+        current = self.store.expires.get(key)
+        new = time_module.time() + _seconds(time)
+        # как в редисе: ключ без TTL для GT и LT считается вечным
+        if (nx and current is not None) or (xx and current is None) \
+                or (gt and (current is None or new <= current)) \
+                or (lt and current is not None and new >= current):
+            return False
+        if _seconds(time) <= 0:
+            self.store.remove(key)
+        else:
+            self.store.expires[key] = new
+        return True
+
+    @_command
+    def pttl(self, name) -> int:
+        key = self._key(name)
+        if self.store.get(key) is None:
+            return -2
+        expire = self.store.expires.get(key)
+        return -1 if expire is None else max(int((expire - time_module.time()) * 1000), 0)
+
+    @_command
+    def ttl(self, name) -> int:
+        key = self._key(name)
+        if self.store.get(key) is None:
+            return -2
+        expire = self.store.expires.get(key)
+        return -1 if expire is None else max(int(round(expire - time_module.time())), 0)
+
+    def scan_iter(self, match=None, count=None, _type=None) -> Iterator:
+        """
+        Перебирает снимок списка ключей, поэтому не держит блокировку во время перебора.
+        """
+        with self.store.lock:
+            keys = list(self.store.data)
+        pattern = self._key(match) if match is not None else None
+        for key in keys:
+            if pattern is not None and not fnmatch.fnmatchcase(key, pattern):
+                continue
+            with self.store.lock:
+                if self.store.get(key) is None:
+                    continue
+            yield self._out(key)
+
+    @_command
+    def flushdb(self, asynchronous: bool = False) -> bool:
+        self.store.data.clear()
+        self.store.expires.clear()
+        self.store.field_expires.clear()
+        return True
+
+    # списки
+
+    @_command
+    def rpush(self, name, *values) -> int:
+        key = self._key(name)
+        items = self.store.get(key, list)
+        if items is None:
+            items = []
+            self.store.put(key, items)
+        items.extend(self.encoder.encode(value) for value in values)
+        return len(items)
+
+    @_command
+    def lrange(self, name, start: int, end: int) -> list:
+        items = self.store.get(self._key(name), list) or []
+        length = len(items)
+        start = max(length + start, 0) if start < 0 else start
+        end = length + end if end < 0 else end
+        return [self._out(item) for item in items[start:end + 1]]
+
+    @_command
+    def llen(self, name) -> int:
+        return len(self.store.get(self._key(name), list) or [])
+
+    # множества
+
+    @_command
+    def sadd(self, name, *values) -> int:
+        key = self._key(name)
+        members = self.store.get(key, set)
+        if members is None:
+            members = set()
+            self.store.put(key, members)
+        before = len(members)
+        members.update(self.encoder.encode(value) for value in values)
+        return len(members) - before
+
+    @_command
+    def srem(self, name, *values) -> int:
+        key = self._key(name)
+        members = self.store.get(key, set)
+        if members is None:
+            return 0
+        before = len(members)
+        members.difference_update(self.encoder.encode(value) for value in values)
+        self.store.remove_if_empty(key)
+        return before - len(members)
+
+    @_command
+    def smembers(self, name) -> set:
+        return {self._out(member) for member in self.store.get(self._key(name), set) or ()}
+
+    @_command
+    def sismember(self, name, value) -> bool:
+        return self.encoder.encode(value) in (self.store.get(self._key(name), set) or ())
+
+    @_command
+    def scard(self, name) -> int:
+        return len(self.store.get(self._key(name), set) or ())
+
+    @_command
+    def srandmember(self, name, number: Optional[int] = None):
+        members = list(self.store.get(self._key(name), set) or ())
+        if number is None:
+            return self._out(random.choice(members)) if members else None
+        if number < 0:
+            chosen = random.choices(members, k=-number) if members else []
+        else:
+            chosen = random.sample(members, min(number, len(members)))
+        return [self._out(member) for member in chosen]
+
+    # хэши
+
+    @_command
+    def hget(self, name, key):
+        fields = self.store.get(self._key(name), dict)
+        return self._out(fields.get(self.encoder.encode(key))) if fields else None
+
+    @_command
+    def hgetall(self, name) -> dict:
+        fields = self.store.get(self._key(name), dict) or {}
+        return {self._out(field): self._out(value) for field, value in fields.items()}
+
+    @_command
+    def hlen(self, name) -> int:
+        return len(self.store.get(self._key(name), dict) or {})
+
+    @_command
+    def hset(self, name, key=None, value=None, mapping: Optional[dict] = None,
+             items: Optional[list] = None) -> int:
+        pairs = []
+        if key is not None:
+            pairs.append((key, value))
+        if mapping:
+            pairs.extend(mapping.items())
+        if items:
+            pairs.extend(zip(items[::2], items[1::2]))
+        return self.__hset(self._key(name), pairs, replace=True)
+
+    @_command
+    def hsetnx(self, name, key, value) -> bool:
+        return bool(self.__hset(self._key(name), [(key, value)], replace=False))
+
+    @_command
+    def hincrby(self, name, key, amount: int = 1) -> int:
+        name = self._key(name)
+        fields = self.store.get(name, dict)
+        if fields is None:
+            fields = {}
+            self.store.put(name, fields)
+        key = self.encoder.encode(key)
+        try:
+            number = int(fields.get(key) or 0) + amount
+        except ValueError:
+            raise redis.ResponseError('hash value is not an integer')
+        # в отличие от HSET, TTL поля не сбрасывается
+        fields[key] = str(number).encode()
+        return number
+
+    @_command
+    def hdel(self, name, *keys) -> int:
+        name = self._key(name)
+        fields = self.store.get(name, dict)
+        if not fields:
+            return 0
+        field_expires = self.store.field_expires.get(name, {})
+        deleted = 0
+        for key in keys:
+            key = self.encoder.encode(key)
+            field_expires.pop(key, None)
+            deleted += fields.pop(key, None) is not None
+        self.store.remove_if_empty(name)
+        return deleted
+
+    @_command
+    def hexpire(self, name, seconds, *fields, nx: bool = False, xx: bool = False,
+                gt: bool = False, lt: bool = False) -> List[int]:
+        """
+        Коды ответа как в редисе: -2 — поля нет, 0 — условие не выполнено, 1 — TTL выставлен,
+        2 — поле удалено, потому что TTL не положительный.
+        """
+        name = self._key(name)
+        values = self.store.get(name, dict)
+        now = time_module.time()
+        result = []
+        for field in fields:
+            field = self.encoder.encode(field)
+            if not values or field not in values:
+                result.append(-2)
+                continue
+            field_expires = self.store.field_expires.setdefault(name, {})
+            current = field_expires.get(field)
+            new = now + _seconds(seconds)
+            if (nx and current is not None) or (xx and current is None) \
+                    or (gt and (current is None or new <= current)) \
+                    or (lt and current is not None and new >= current):
+                result.append(0)
+            elif _seconds(seconds) <= 0:
+                values.pop(field)
+                field_expires.pop(field, None)
+                result.append(2)
+            else:
+                field_expires[field] = new
+                result.append(1)
+        if not self.store.field_expires.get(name, True):
+            del self.store.field_expires[name]
+        self.store.remove_if_empty(name)
+        return result
+
+    def __hset(self, name: bytes, pairs: list, replace: bool) -> int:
+        fields = self.store.get(name, dict)
+        if fields is None:
+            fields = {}
+            self.store.put(name, fields)
+        field_expires = self.store.field_expires.get(name, {})
+        added = 0
+        for key, value in pairs:
+            key = self.encoder.encode(key)
+            if key in fields and not replace:
+                continue
+            added += key not in fields
+            fields[key] = self.encoder.encode(value)
+            # как в редисе: перезапись поля сбрасывает его TTL
+            field_expires.pop(key, None)
+        self.store.remove_if_empty(name)
+        return added
+
+    # прочее
+
+    @_command
+    def eval(self, script: str, numkeys: int, *keys_and_args):
+        func = _scripts.get(script)
+        if func is None:
+            raise redis.ResponseError(
+                'NOSCRIPT no python version of the script for the memory cache')
+        return func(self, list(keys_and_args[:numkeys]), list(keys_and_args[numkeys:]))
+
+    def info(self, section: Optional[str] = None) -> dict:
+        with self.store.lock:
+            return {'redis_version': REDIS_VERSION, 'backend': 'memory',
+                    'db0': {'keys': len(self.store.data), 'expires': len(self.store.expires)}}
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> 'MemoryPipeline':
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline:
+    """
+    Команды копятся и выполняются разом под блокировкой хранилища, то есть всегда как MULTI/EXEC.
+    """
+
+    def __init__(self, client: MemoryRedis) -> None:
+        self.client = client
+        self.commands: List[tuple] = []
+
+    def __getattr__(self, name: str):
+        command = getattr(MemoryRedis, name, None)
+        raw = getattr(command, '__wrapped__', None)
+        if raw is None:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs) -> 'MemoryPipeline':
+            self.commands.append((raw, args, kwargs))
+            return self
+
+        return queue
+
+    def __len__(self) -> int:
+        return len(self.commands)
+
+    def __enter__(self) -> 'MemoryPipeline':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.commands = []
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        commands, self.commands = self.commands, []
+        results = []
+        start = time_module.perf_counter()
+        with self.client.store.lock:
+            for raw, args, kwargs in commands:
+                try:
+                    results.append(raw(self.client, *args, **kwargs))
+                except redis.ResponseError as e:
+                    results.append(e)
+        metrics.record_call('redis', time_module.perf_counter() - start)
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, redis.ResponseError):
+                    raise result
+        return results
+
+
+class AsyncMemoryRedis:
+    """
+    Тот же клиент для корутин. Команды в памяти не ждут сеть, поэтому выполняются прямо на цикле.
+    """
+
+    def __init__(self, client: MemoryRedis) -> None:
+        self.client = client
+
+    def __getattr__(self, name: str):
+        method = getattr(self.client, name)
+
+        async def command(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return command
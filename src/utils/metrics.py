@@ -0,0 +1,229 @@
+"""
+Метрики бота в текстовом формате Prometheus.
+
+По каждому обработчику: сколько апдейтов он обработал, сколько из них с ошибкой, гистограмма
+времени обработки, сколько за это время было запросов к редису и к бд и сколько они заняли.
+Запросы привязываются к обработчику через thread-local: обработчик выполняется целиком
+в одном потоке.
+
+Прочие показатели (загрузка воркеров, очередь исходящих сообщений) регистрируются через
+`metrics.register_gauge` и считаются в момент запроса метрик.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple, Union
+
+from src.utils.db_stats import Histogram, db_stats, get_statement_type
+
+BACKENDS = ('redis', 'mysql')
+
+GaugeValue = Union[float, Dict[Tuple[Tuple[str, str], ...], float]]
+
+_local = threading.local()
+
+
+class HandlerStats:
+    def __init__(self) -> None:
+        self.updates = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.calls = {backend: 0 for backend in BACKENDS}
+        self.seconds = {backend: 0. for backend in BACKENDS}
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.handlers: Dict[str, HandlerStats] = {}
+        self.calls = {backend: 0 for backend in BACKENDS}
+        self.seconds = {backend: 0. for backend in BACKENDS}
+        self.async_queued = 0
+        self.async_busy = 0
+        self.gauges: List[Tuple[str, str, Callable[[], GaugeValue], str]] = []
+        # получают (обработчик, время) каждого апдейта, например для перцентилей в бенчмарке
+        self.observers: List[Callable[[str, float], None]] = []
+
+    def register_gauge(self, name: str, help_text: str, func: Callable[[], GaugeValue],
+                       kind: str = 'gauge') -> None:
+        """
+        `func` возвращает число или словарь {(('label', 'value'), ...): число}.
+        Для счетчиков, которые ведутся где-то еще, `kind='counter'`.
+        """
+        self.gauges.append((name, help_text, func, kind))
+
+    def record_call(self, backend: str, duration: float) -> None:
+        """
+        Запрос к редису или бд. Если сейчас идет обработка апдейта, то запрос записывается
+        на его обработчик.
+        """
+        with self.lock:
+            self.calls[backend] += 1
+            self.seconds[backend] += duration
+        calls = getattr(_local, 'calls', None)
+        if calls is not None:
+            count, seconds = calls.get(backend, (0, 0.))
+            calls[backend] = (count + 1, seconds + duration)
+
+    @contextmanager
+    def track_handler(self, name: str):
+        previous = getattr(_local, 'calls', None)
+        calls: Dict[str, Tuple[int, float]] = {}
+        _local.calls = calls
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            _local.calls = previous
+            self.__observe_handler(name, duration, calls, failed)
+
+    def observe(self, name: str, duration: float, failed: bool = False) -> None:
+        """
+        Для корутин: thread-local не отличает их друг от друга, поэтому запросы к редису
+        и бд на них не записываются, только время.
+        """
+        self.__observe_handler(name, duration, {}, failed)
+
+    def async_enqueued(self) -> None:
+        with self.lock:
+            self.async_queued += 1
+
+    @contextmanager
+    def async_running(self):
+        with self.lock:
+            self.async_queued -= 1
+            self.async_busy += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.async_busy -= 1
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self.lock:
+            handlers = sorted(self.handlers.items())
+            self.__render_handlers(lines, handlers)
+            lines.append('# TYPE bot_backend_calls_total counter')
+            for backend in BACKENDS:
+                lines.append(f'bot_backend_calls_total{{backend="{backend}"}} '
+                             f'{self.calls[backend]}')
+            lines.append('# TYPE bot_backend_seconds_total counter')
+            for backend in BACKENDS:
+                lines.append(f'bot_backend_seconds_total{{backend="{backend}"}} '
+                             f'{self.seconds[backend]:.6f}')
+            lines.append('# TYPE bot_async_queued gauge')
+            lines.append(f'bot_async_queued {self.async_queued}')
+            lines.append('# TYPE bot_async_busy gauge')
+            lines.append(f'bot_async_busy {self.async_busy}')
+        self.__render_db(lines)
+        self.__render_gauges(lines)
+        return '\n'.join(lines) + '\n'
+
+    def __observe_handler(self, name: str, duration: float, calls: Dict[str, Tuple[int, float]],
+                          failed: bool) -> None:
+        with self.lock:
+            stats = self.handlers.get(name)
+            if stats is None:
+                stats = self.handlers[name] = HandlerStats()
+            stats.updates += 1
+            if failed:
+                stats.errors += 1
+            stats.latency.observe(duration)
+            for backend, (count, seconds) in calls.items():
+                stats.calls[backend] += count
+                stats.seconds[backend] += seconds
+        for observer in self.observers:
+            observer(name, duration)
+
+    @staticmethod
+    def __render_handlers(lines: List[str], handlers: List[Tuple[str, HandlerStats]]) -> None:
+        lines.append('# HELP bot_handler_updates_total Updates processed by the handler')
+        lines.append('# TYPE bot_handler_updates_total counter')
+        for name, stats in handlers:
+            lines.append(f'bot_handler_updates_total{{handler="{name}"}} {stats.updates}')
+        lines.append('# TYPE bot_handler_errors_total counter')
+        for name, stats in handlers:
+            lines.append(f'bot_handler_errors_total{{handler="{name}"}} {stats.errors}')
+        lines.append('# HELP bot_handler_seconds Time spent in the handler')
+        lines.append('# TYPE bot_handler_seconds histogram')
+        for name, stats in handlers:
+            render_histogram(lines, 'bot_handler_seconds', f'handler="{name}"', stats.latency)
+        lines.append('# HELP bot_handler_backend_calls_total '
+                     'Redis and database calls made by the handler')
+        lines.append('# TYPE bot_handler_backend_calls_total counter')
+        for name, stats in handlers:
+            for backend in BACKENDS:
+                labels = f'handler="{name}",backend="{backend}"'
+                lines.append(f'bot_handler_backend_calls_total{{{labels}}} {stats.calls[backend]}')
+        lines.append('# TYPE bot_handler_backend_seconds_total counter')
+        for name, stats in handlers:
+            for backend in BACKENDS:
+                labels = f'handler="{name}",backend="{backend}"'
+                lines.append(f'bot_handler_backend_seconds_total{{{labels}}} '
+                             f'{stats.seconds[backend]:.6f}')
+
+    @staticmethod
+    def __render_db(lines: List[str]) -> None:
+        snapshot = db_stats.snapshot()
+        lines.append('# TYPE bot_db_statement_seconds histogram')
+        for sql, histogram in sorted(snapshot['statements'].items()):
+            labels = f'type="{get_statement_type(sql)}",statement="{escape_label(sql)}"'
+            render_histogram(lines, 'bot_db_statement_seconds', labels, histogram)
+        lines.append('# TYPE bot_db_pool_checkout_seconds histogram')
+        render_histogram(lines, 'bot_db_pool_checkout_seconds', '', snapshot['checkout_wait'])
+        lines.append('# TYPE bot_db_pool_timeouts_total counter')
+        lines.append(f'bot_db_pool_timeouts_total {snapshot["checkout_timeouts"]}')
+        lines.append('# TYPE bot_db_errors_total counter')
+        lines.append(f'bot_db_errors_total {snapshot["errors"]}')
+
+    def __render_gauges(self, lines: List[str]) -> None:
+        for name, help_text, func, kind in self.gauges:
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if not isinstance(value, dict):
+                lines.append(f'{name} {value}')
+                continue
+            for labels, labeled_value in sorted(value.items()):
+                label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f'{name}{{{label_str}}} {labeled_value}')
+
+
+def render_histogram(lines: List[str], name: str, labels: str,
+                     histogram: Union[Histogram, dict]) -> None:
+    """
+    В Prometheus корзины накопительные: `le="0.1"` включает все, что попало и в меньшие корзины.
+    """
+    data = histogram.to_dict() if isinstance(histogram, Histogram) else histogram
+    prefix = f'{labels},' if labels else ''
+    cumulative = 0
+    for bound, count in zip(data['buckets'], data['counts']):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {data["count"]}')
+    label_part = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{label_part} {data["sum"]:.6f}')
+    lines.append(f'{name}_count{label_part} {data["count"]}')
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+db_stats.listeners.append(lambda duration: metrics.record_call('mysql', duration))
+
+
+def get_handler_name(func: Callable) -> str:
+    module = getattr(func, '__module__', '') or ''
+    name = getattr(func, '__qualname__', None) or getattr(func, '__name__', repr(func))
+    return f'{module.rsplit(".", 1)[-1]}.{name}' if module else name
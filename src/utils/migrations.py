@@ -0,0 +1,190 @@
+"""
+Версионные миграции схемы бд.
+
+Примененные миграции записываются в таблицу `schema_migrations`, поэтому каждая выполняется
+ровно один раз. Миграции запускаются при старте бота (см. `start.prepare`) или вручную:
+
+    python -m src.utils.migrations
+"""
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Set
+
+from sqlalchemy import Column, Integer, String, DateTime, func, inspect, select, and_
+from sqlalchemy.engine import Connection
+
+from src.utils.db import Base
+from src.utils.logger_helpers import get_logger
+from src.utils.misc import chunks
+
+logger = get_logger(__name__)
+
+
+class SchemaMigrationDB(Base):
+    __tablename__ = 'schema_migrations'
+
+    version = Column('version', Integer, primary_key=True, autoincrement=False)
+    description = Column('description', String(255))
+    applied_at = Column('applied_at', DateTime)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Connection], None]
+
+
+def import_models() -> None:
+    """
+    Модели регистрируются в `Base.metadata` только после импорта их модулей.
+    """
+    # noinspection PyUnresolvedReferences
+    import src.models.chat_user
+    # noinspection PyUnresolvedReferences
+    import src.models.leave_collector
+    # noinspection PyUnresolvedReferences
+    import src.models.user
+    # noinspection PyUnresolvedReferences
+    import src.models.user_stat
+    # noinspection PyUnresolvedReferences
+    import src.models.wordle_day
+
+
+def _create_tables(conn: Connection) -> None:
+    Base.metadata.create_all(conn)
+
+
+def _dedupe_user_stats(conn: Connection) -> None:
+    """
+    Без уникального ключа параллельные вставки могли создать несколько строк на одного юзера
+    за одну неделю. Складываем их счетчики в самую старую строку, остальные удаляем.
+    """
+    from src.models.user_stat import UserStatDB
+
+    table = UserStatDB.__table__
+    counters = [c for c in table.columns if UserStatDB.is_counter(c.key)]
+    keys = [table.c.stats_monday, table.c.cid, table.c.uid]
+    groups = conn.execute(
+        select(keys + [func.min(table.c.id)]).group_by(*keys).having(func.count() > 1)
+    ).fetchall()
+    for stats_monday, cid, uid, min_id in groups:
+        where = and_(table.c.stats_monday == stats_monday, table.c.cid == cid,
+                     table.c.uid == uid)
+        sums = conn.execute(
+            select([func.coalesce(func.sum(c), 0) for c in counters]
+                   + [func.max(table.c.last_activity)]).where(where)
+        ).first()
+        update = {c.key: sums[i] for i, c in enumerate(counters)}
+        update['last_activity'] = sums[-1]
+        conn.execute(table.update().where(table.c.id == min_id).values(**update))
+        conn.execute(table.delete().where(and_(where, table.c.id != min_id)))
+    logger.info(f'[migrations] user_stats: merged {len(groups)} duplicate groups')
+
+
+def _dedupe_latest(table, key_columns: List[str]) -> Callable[[Connection], None]:
+    """
+    Оставляет только самую свежую строку (с максимальным id) для каждого ключа.
+    """
+
+    def apply(conn: Connection) -> None:
+        keys = [table.c[key] for key in key_columns]
+        groups = conn.execute(
+            select(keys + [func.max(table.c.id)]).group_by(*keys).having(func.count() > 1)
+        ).fetchall()
+        for row in groups:
+            where = and_(*[column == value for column, value in zip(keys, row)])
+            conn.execute(table.delete().where(and_(where, table.c.id != row[-1])))
+        logger.info(f'[migrations] {table.name}: removed duplicates for {len(groups)} keys')
+
+    return apply
+
+
+def _create_indexes(conn: Connection) -> None:
+    """
+    Создает индексы, объявленные в `__table_args__` моделей, если их еще нет.
+    """
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            logger.info(f'[migrations] create index {index.name}')
+            index.create(conn)
+
+
+def _fill_chat_membership(conn: Connection) -> None:
+    """
+    Заполняет состояние участников чатов по последнему событию из leave_logs.
+    """
+    from src.models.leave_collector import ChatMembershipDB, LeaveCollectorDB
+
+    ChatMembershipDB.__table__.create(conn, checkfirst=True)
+    logs = LeaveCollectorDB.__table__
+    latest = select([logs.c.cid, logs.c.uid, func.max(logs.c.date).label('date')]) \
+        .group_by(logs.c.cid, logs.c.uid) \
+        .subquery()
+    rows = conn.execute(
+        select([logs.c.cid, logs.c.uid, logs.c.leave_type, logs.c.date, logs.c.from_uid])
+        .select_from(logs.join(latest, and_(logs.c.cid == latest.c.cid,
+                                            logs.c.uid == latest.c.uid,
+                                            logs.c.date == latest.c.date)))
+        .order_by(logs.c.id)
+    ).fetchall()
+    # при одинаковой дате побеждает более позднее событие
+    state = {(row.cid, row.uid): dict(row._mapping) for row in rows}
+    for part in chunks(list(state.values()), 1000):
+        conn.execute(ChatMembershipDB.__table__.insert(), part)
+    logger.info(f'[migrations] chat_membership: {len(state)} rows')
+
+
+def get_migrations() -> List[Migration]:
+    from src.models.chat_user import ChatUserDB
+    from src.models.user import UserDB
+
+    return [
+        Migration(1, 'create missing tables', _create_tables),
+        Migration(2, 'merge duplicate user_stats rows', _dedupe_user_stats),
+        Migration(3, 'remove duplicate chat_users rows',
+                  _dedupe_latest(ChatUserDB.__table__, ['uid', 'cid'])),
+        Migration(4, 'remove duplicate users rows', _dedupe_latest(UserDB.__table__, ['uid'])),
+        Migration(5, 'create composite and unique indexes', _create_indexes),
+        Migration(6, 'fill chat_membership from leave_logs', _fill_chat_membership),
+    ]
+
+
+def get_applied_versions(conn: Connection) -> Set[int]:
+    table = SchemaMigrationDB.__table__
+    return {row[0] for row in conn.execute(select([table.c.version]))}
+
+
+def migrate(engine) -> List[int]:
+    """
+    Применяет все еще не примененные миграции по порядку.
+
+    :return: версии примененных сейчас миграций
+    """
+    import_models()
+    SchemaMigrationDB.__table__.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        applied = get_applied_versions(conn)
+
+    done = []
+    for migration in get_migrations():
+        if migration.version in applied:
+            continue
+        logger.info(f'[migrations] apply {migration.version}: {migration.description}')
+        with engine.begin() as conn:
+            migration.apply(conn)
+            conn.execute(SchemaMigrationDB.__table__.insert().values(
+                version=migration.version, description=migration.description,
+                applied_at=datetime.now()))
+        done.append(migration.version)
+    return done
+
+
+if __name__ == '__main__':
+    from src.utils.db import engine as db_engine
+
+    print(migrate(db_engine))
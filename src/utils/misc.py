@@ -107,3 +107,28 @@ class CustomNamedTemporaryFile:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._tempFile.close()
         os.remove(self._tempFile.name)
+
+
+class SlotsState:
+    """
+    Примесь для легких моделей со `__slots__`.
+
+    Пиклится кортежем значений в порядке `__slots__`, а не словарем с именами полей. Умеет читать
+    и старые пиклы из редиса, где состояние было словарем `__dict__`. Недостающие поля берутся
+    из конструктора по-умолчанию, поэтому у модели должен быть `__init__` без обязательных
+    аргументов.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state) -> None:
+        self.__init__()
+        if isinstance(state, dict):
+            for name in self.__slots__:
+                if name in state:
+                    setattr(self, name, state[name])
+            return
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
@@ -0,0 +1,265 @@
+"""
+Очередь исходящих сообщений с учетом лимитов телеграма.
+
+Телеграм ограничивает частоту сообщений и глобально (~30 в секунду), и для каждого чата отдельно
+(~20 в минуту для групп). Поэтому у каждого чата свое ведро токенов, плюс общее ведро на всех.
+Большой отчет в один чат не задерживает сообщения в другие чаты, а ответы на команды
+отправляются раньше отчетов.
+"""
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional, Dict, Tuple, Deque, NamedTuple
+
+import telegram
+
+from src.utils.logger_helpers import get_logger
+
+logger = get_logger(__name__)
+
+
+class Priority:
+    INTERACTIVE = 0  # ответы на команды и кнопки
+    NORMAL = 1
+    REPORT = 2  # недельная стата и прочие большие отчеты
+
+
+class TokenBucket:
+    """
+    Ведро токенов: `rate` токенов в секунду, не больше `capacity` за раз.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        Сколько секунд ждать до появления токена. 0 — можно отправлять сейчас.
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Item(NamedTuple):
+    seq: int
+    func: Callable
+    args: tuple
+    kwargs: dict
+    chat_id: Optional[int]
+    priority: int
+    enqueued: float
+    retries: int
+
+
+class OutboundScheduler:
+    """
+    Замена `telegram.ext.DelayQueue`. Вызывается так же: `dsp(func, *args, **kwargs)`.
+
+    Если первые аргументы — бот и id чата (`dsp(bot.send_message, chat_id, text)` или
+    `dsp(send_html, bot, chat_id, text)`), то чат определяется автоматически. Иначе чат и приоритет
+    можно указать явно через `put`.
+
+    Внутри одного чата и одного приоритета порядок сообщений сохраняется.
+    """
+    max_retries = 3
+    prune_interval = 60.  # как часто выбрасывать ведра простаивающих чатов, сек
+
+    def __init__(self, global_rate: float = 25., global_burst: float = 25.,
+                 group_rate: float = 18 / 60, group_burst: float = 5.,
+                 private_rate: float = 1., private_burst: float = 3.,
+                 exc_route: Optional[Callable[[Exception], None]] = None,
+                 name: str = 'OutboundScheduler') -> None:
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.group_limits = (group_rate, group_burst)
+        self.private_limits = (private_rate, private_burst)
+        self.exc_route = exc_route if exc_route else self._default_exception_handler
+
+        self._queues: Dict[Tuple[Optional[int], int], Deque[_Item]] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        # None — пауза после RetryAfter у сообщений без чата, другие чаты она не держит
+        self._blocked_until: Dict[Optional[int], float] = {}
+        self._pruned_at = time.monotonic()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._running = True
+
+        self._sent = 0
+        self._errors = 0
+        self._retry_after_count = 0
+        self._wait_sum = 0.
+        self._wait_max = 0.
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __call__(self, func: Callable, *args, **kwargs) -> None:
+        self.put(func, args, kwargs, chat_id=self._guess_chat_id(args))
+
+    def put(self, func: Callable, args: tuple = (), kwargs: Optional[dict] = None,
+            chat_id: Optional[int] = None, priority: int = Priority.NORMAL) -> None:
+        with self._cond:
+            self._seq += 1
+            item = _Item(self._seq, func, args, kwargs or {}, chat_id, priority,
+                         time.monotonic(), 0)
+            self._queues.setdefault((chat_id, priority), deque()).append(item)
+            self._cond.notify()
+
+    def share_global_limit(self, parts: int) -> None:
+        """
+        Оставляет этой очереди долю `1 / parts` общего лимита. Нужно, когда сообщения шлют
+        несколько процессов с одним токеном бота, а лимит телеграма на всех один.
+        """
+        with self._cond:
+            bucket = self.global_bucket
+            # ведро меньше одного токена никогда не даст отправить сообщение
+            self.global_bucket = TokenBucket(bucket.rate / parts, max(1., bucket.capacity / parts))
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        """
+        Глубина очереди и время ожидания сообщений (в секундах).
+        """
+        with self._cond:
+            depth_by_priority: Dict[int, int] = {}
+            for (_, priority), queue in self._queues.items():
+                depth_by_priority[priority] = depth_by_priority.get(priority, 0) + len(queue)
+            return {
+                'depth': sum(depth_by_priority.values()),
+                'depth_by_priority': depth_by_priority,
+                'sent': self._sent,
+                'errors': self._errors,
+                'retry_after': self._retry_after_count,
+                'wait_avg': self._wait_sum / self._sent if self._sent else 0.,
+                'wait_max': self._wait_max,
+            }
+
+    @staticmethod
+    def _guess_chat_id(args: tuple) -> Optional[int]:
+        if args and isinstance(args[0], int):
+            return args[0]
+        if len(args) > 1 and isinstance(args[0], telegram.Bot) and isinstance(args[1], int):
+            return args[1]
+        return None
+
+    def _get_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            rate, burst = self.group_limits if chat_id < 0 else self.private_limits
+            bucket = self._buckets[chat_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def _next_item(self, now: float) -> Tuple[Optional[_Item], Optional[float]]:
+        """
+        Выбирает сообщение с наивысшим приоритетом среди тех, чьи чаты сейчас не упираются в лимит.
+        Если таких нет, то возвращает через сколько секунд стоит посмотреть снова.
+        """
+        if now - self._pruned_at >= self.prune_interval:
+            self._prune(now)
+        global_wait = self.global_bucket.wait_time(now)
+        best_key = None
+        best_item = None
+        min_wait = None
+        for key, queue in self._queues.items():
+            chat_id = key[0]
+            head = queue[0]
+            wait = max(global_wait, self._blocked_until.get(chat_id, 0) - now)
+            if chat_id is not None:
+                wait = max(wait, self._get_bucket(chat_id).wait_time(now))
+            if wait > 0:
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+                continue
+            if best_item is None or (head.priority, head.seq) < (best_item.priority, best_item.seq):
+                best_key, best_item = key, head
+        if best_item is None:
+            return None, min_wait
+
+        queue = self._queues[best_key]
+        queue.popleft()
+        if not queue:
+            del self._queues[best_key]
+        self.global_bucket.consume(now)
+        if best_item.chat_id is not None:
+            self._get_bucket(best_item.chat_id).consume(now)
+        return best_item, None
+
+    def _prune(self, now: float) -> None:
+        """
+        Выбрасывает истекшие паузы и полные ведра чатов без очереди: такое ведро ничем
+        не отличается от нового.
+        """
+        self._pruned_at = now
+        for chat_id, until in list(self._blocked_until.items()):
+            if until <= now:
+                del self._blocked_until[chat_id]
+        queued = {chat_id for chat_id, _ in self._queues}
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in queued and bucket.wait_time(now) == 0 \
+                    and bucket.tokens >= bucket.capacity:
+                del self._buckets[chat_id]
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                item, wait = self._next_item(time.monotonic())
+                if item is None:
+                    self._cond.wait(wait)
+                    continue
+            self._process(item)
+
+    def _process(self, item: _Item) -> None:
+        try:
+            item.func(*item.args, **item.kwargs)
+        except telegram.error.RetryAfter as e:
+            self._on_retry_after(item, e.retry_after)
+            return
+        except Exception as e:
+            with self._cond:
+                self._errors += 1
+            self.exc_route(e)
+            return
+        waited = time.monotonic() - item.enqueued
+        with self._cond:
+            self._sent += 1
+            self._wait_sum += waited
+            self._wait_max = max(self._wait_max, waited)
+
+    def _on_retry_after(self, item: _Item, retry_after: float) -> None:
+        """
+        Телеграм сказал, сколько ждать. Ставим чат на паузу ровно на это время и возвращаем
+        сообщение в начало его очереди.
+        """
+        with self._cond:
+            self._retry_after_count += 1
+            self._blocked_until[item.chat_id] = time.monotonic() + retry_after
+            if item.retries >= self.max_retries:
+                self._errors += 1
+                logger.error(f'[outbound] chat {item.chat_id}: too many RetryAfter, dropped')
+                return
+            logger.warning(f'[outbound] chat {item.chat_id}: flood limit, wait {retry_after} sec')
+            self._queues.setdefault((item.chat_id, item.priority), deque()).appendleft(
+                item._replace(retries=item.retries + 1))
+            self._cond.notify()
+
+    @staticmethod
+    def _default_exception_handler(e: Exception) -> None:
+        logger.error(f'[outbound] {repr(e)}')
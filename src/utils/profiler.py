@@ -0,0 +1,212 @@
+"""
+Профилирование медленных апдейтов.
+
+Быстрые апдейты почти ничего не стоят: обработчик только записывает время своего старта.
+Отдельный поток раз в `interval_ms` смотрит, кто из обработчиков работает дольше `threshold_ms`,
+и снимает их стеки через `sys._current_frames()`. Если апдейт в итоге оказался медленным,
+то стеки сохраняются в файл `.folded` (формат flamegraph), а в лог пишется топ функций.
+
+Дополнительно каждый `sample_every`-й апдейт целиком профилируется через cProfile
+и сохраняется в `.prof` (открывается через `python -m pstats` или snakeviz).
+
+Включается в конфиге, раздел `profiler`.
+"""
+import cProfile
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from src.config import CONFIG
+from src.utils.logger_helpers import get_logger
+
+logger = get_logger(__name__)
+
+Frame = Tuple[str, str]  # (файл, функция)
+
+
+class _Watched:
+    __slots__ = ('start', 'samples')
+
+    def __init__(self, start: float) -> None:
+        self.start = start
+        self.samples: Counter = Counter()
+
+
+class SlowUpdateProfiler:
+    def __init__(self, enabled: bool = False, threshold_ms: int = 2000, sample_every: int = 0,
+                 interval_ms: int = 20, directory: str = 'tmp/profiles', keep: int = 200,
+                 top: int = 10) -> None:
+        self.enabled = enabled
+        self.threshold = threshold_ms / 1000
+        self.sample_every = sample_every
+        self.interval = interval_ms / 1000
+        self.directory = directory
+        self.keep = keep
+        self.top = top
+        self._watched: Dict[int, _Watched] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'SlowUpdateProfiler':
+        return cls(enabled=config.get('enabled', False),
+                   threshold_ms=config.get('threshold_ms', 2000),
+                   sample_every=config.get('sample_every', 0),
+                   interval_ms=config.get('interval_ms', 20),
+                   directory=config.get('dir', 'tmp/profiles'),
+                   keep=config.get('keep', 200),
+                   top=config.get('top', 10))
+
+    @contextmanager
+    def watch(self, handler: str, chat_id: Optional[int] = None):
+        if not self.enabled:
+            yield
+            return
+        if self.sample_every and random.randrange(self.sample_every) == 0:
+            with self.__profile(handler, chat_id):
+                yield
+            return
+
+        self.__ensure_sampler()
+        ident = threading.get_ident()
+        watched = _Watched(time.perf_counter())
+        previous = self._watched.get(ident)  # обработчик внутри обработчика
+        self._watched[ident] = watched
+        try:
+            yield
+        finally:
+            if previous is None:
+                self._watched.pop(ident, None)
+            else:
+                self._watched[ident] = previous
+            duration = time.perf_counter() - watched.start
+            if duration >= self.threshold and watched.samples:
+                self.__save_samples(handler, chat_id, duration, watched.samples)
+
+    @contextmanager
+    def __profile(self, handler: str, chat_id: Optional[int]):
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profile.enable()
+        except ValueError:
+            # в python 3.12+ одновременно может работать только один cProfile
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            duration = time.perf_counter() - start
+            try:
+                path = self.__get_path(handler, chat_id, duration, 'prof')
+                stats = pstats.Stats(profile)
+                stats.dump_stats(path)
+                top = get_top_from_stats(stats, self.top)
+                logger.info(f'[profiler] {handler} chat {chat_id}: {duration:.3f} sec, {path}; '
+                            f'top: {format_top(top)}')
+                self.__rotate()
+            except Exception as e:
+                logger.error(f"[profiler] can't save profile: {e}")
+
+    def __ensure_sampler(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self.__sample_loop, name='SlowUpdateSampler',
+                                            daemon=True)
+            self._thread.start()
+
+    def __sample_loop(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            if not self._watched:
+                continue
+            now = time.perf_counter()
+            slow = [(ident, watched) for ident, watched in list(self._watched.items())
+                    if now - watched.start >= self.threshold]
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            for ident, watched in slow:
+                frame = frames.get(ident)
+                if frame is not None:
+                    watched.samples[get_stack(frame)] += 1
+
+    def __save_samples(self, handler: str, chat_id: Optional[int], duration: float,
+                       samples: Counter) -> None:
+        try:
+            path = self.__get_path(handler, chat_id, duration, 'folded')
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in samples.items():
+                    f.write(';'.join(f'{func} ({file})' for file, func in stack) + f' {count}\n')
+            top = get_top_from_samples(samples, self.top)
+            logger.warning(f'[profiler] slow update {handler} chat {chat_id}: {duration:.3f} sec, '
+                           f'{path}; top: {format_top(top)}')
+            self.__rotate()
+        except Exception as e:
+            logger.error(f"[profiler] can't save samples: {e}")
+
+    def __get_path(self, handler: str, chat_id: Optional[int], duration: float, ext: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        name = re.sub(r'[^\w.-]', '_', handler)
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        return os.path.join(self.directory,
+                            f'{stamp}_{chat_id}_{name}_{int(duration * 1000)}ms.{ext}')
+
+    def __rotate(self) -> None:
+        files = sorted((os.path.join(self.directory, name) for name in os.listdir(self.directory)),
+                       key=os.path.getmtime)
+        for path in files[:max(0, len(files) - self.keep)]:
+            os.remove(path)
+
+
+def get_stack(frame) -> Tuple[Frame, ...]:
+    """
+    Стек от корня к текущей функции.
+    """
+    stack: List[Frame] = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def get_top_from_samples(samples: Counter, top: int) -> List[Tuple[str, float]]:
+    """
+    Доля снимков, в которых функция была где-то в стеке (аналог cumulative time).
+    """
+    total = sum(samples.values())
+    cumulative: Counter = Counter()
+    for stack, count in samples.items():
+        for file, func in set(stack):
+            cumulative[f'{file}:{func}'] += count
+    return [(name, count / total) for name, count in cumulative.most_common(top)]
+
+
+def get_top_from_stats(stats: pstats.Stats, top: int) -> List[Tuple[str, float]]:
+    total = stats.total_tt or 1
+    rows = []
+    # noinspection PyUnresolvedReferences
+    for (file, _, func), (_, _, _, cumtime, _) in stats.stats.items():
+        rows.append((f'{os.path.basename(file)}:{func}', cumtime / total))
+    rows.sort(key=lambda row: row[1], reverse=True)
+    return rows[:top]
+
+
+def format_top(top: List[Tuple[str, float]]) -> str:
+    return ', '.join(f'{name} {share:.0%}' for name, share in top)
+
+
+profiler = SlowUpdateProfiler.from_config(CONFIG.get('profiler', {}))
@@ -0,0 +1,301 @@
+"""
+Анализ памяти редиса: какие фичи сколько занимают, у каких ключей нет TTL и что растет без конца.
+
+Ключи перебираются через SCAN и группируются в семейства по префиксу: `userstat`,
+`bayanometer:photo`, `__pure__:metrics:messages` и т.д. Для каждого семейства считается
+количество ключей, суммарный и средний `MEMORY USAGE`, распределение TTL, типы значений
+и класс запикленного значения (по нескольким примерам).
+
+    python -m src.utils.redis_analyzer --host localhost --port 6379 --db 0
+
+Без параметров берутся настройки редиса из конфига. Дамп (RDB) анализируется так же: его
+нужно поднять в отдельном редисе и натравить скрипт на этот порт:
+
+    redis-server --port 6380 --dir <папка> --dbfilename dump.rdb
+
+Так не нужна отдельная библиотека для разбора RDB, а `MEMORY USAGE` считается тем же редисом,
+что и в проде.
+"""
+import argparse
+import json
+import pickle
+import pickletools
+import re
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import redis
+
+# TTL в секундах: (верхняя граница, название). Ключи без TTL идут в 'none'
+TTL_BUCKETS: Tuple[Tuple[int, str], ...] = (
+    (60 * 60, '<1h'),
+    (24 * 60 * 60, '<1d'),
+    (7 * 24 * 60 * 60, '<1w'),
+    (31 * 24 * 60 * 60, '<1m'),
+    (366 * 24 * 60 * 60, '<1y'),
+)
+MAX_FAMILY_DEPTH = 3
+
+_re_variable = re.compile(
+    r'^(-?\d+'  # id чатов и юзеров, номера сообщений, даты вида 20200101
+    r'|\d{4}-\d{2}-\d{2}.*'  # даты
+    r'|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'  # uuid колбэков
+    r'|[0-9a-f]{16,})$',  # хэши картинок
+    re.IGNORECASE)
+_re_date = re.compile(r'^(\d{8}|\d{4}-\d{2}-\d{2}.*)$')
+
+
+def get_family(key: str) -> str:
+    """
+    Семейство ключа: все части до первой переменной (id, даты, uuid, хэша), не больше трех.
+
+    'userstat:20200106:-1001:123' -> 'userstat'
+    'bayanometer:photo:-1001:dhash:ffe0c0' -> 'bayanometer:photo'
+    '__pure__:metrics:messages:20200106' -> '__pure__:metrics:messages'
+    """
+    parts = key.split(':')
+    prefix = []
+    if parts[0] == '__pure__':
+        prefix, parts = parts[:1], parts[1:]
+    family = []
+    for part in parts[:MAX_FAMILY_DEPTH]:
+        if not part or _re_variable.match(part):
+            break
+        family.append(part)
+    if not family:
+        family = parts[:1]
+    return ':'.join(prefix + family)
+
+
+def has_date(key: str) -> bool:
+    return any(_re_date.match(part) for part in key.split(':'))
+
+
+def get_ttl_bucket(ttl: int) -> str:
+    if ttl is None or ttl < 0:
+        return 'none'
+    for bound, name in TTL_BUCKETS:
+        if ttl < bound:
+            return name
+    return '>=1y'
+
+
+class _NoGlobalsUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f'{module}.{name}')
+
+
+def describe_value(raw: bytes) -> str:
+    """
+    Что лежит в строковом значении. Классы из пиклов достаются через pickletools,
+    без импорта и выполнения чужого кода.
+    """
+    if not raw.startswith(b'\x80'):
+        try:
+            text = raw.decode('utf-8')
+        except UnicodeDecodeError:
+            return 'bytes'
+        return 'int' if re.match(r'^-?\d+$', text) else 'str'
+    strings: List[str] = []
+    try:
+        for opcode, arg, _ in pickletools.genops(raw):
+            if opcode.name == 'GLOBAL':
+                return f'pickle:{arg.replace(" ", ".")}'
+            if opcode.name == 'STACK_GLOBAL' and len(strings) >= 2:
+                return f'pickle:{strings[-2]}.{strings[-1]}'
+            if isinstance(arg, str):
+                strings.append(arg)
+        return f'pickle:{type(_NoGlobalsUnpickler(BytesIO(raw)).load()).__name__}'
+    except Exception:
+        return 'bytes'
+
+
+class FamilyStats:
+    def __init__(self, family: str) -> None:
+        self.family = family
+        self.count = 0
+        self.memory = 0
+        self.ttl: Dict[str, int] = {}
+        self.types: Dict[str, int] = {}
+        self.values: Dict[str, int] = {}
+        self.dated_without_ttl = 0
+        self.max_length = 0
+        self.max_length_key: Optional[str] = None
+        self.sample_keys: List[str] = []
+
+    @property
+    def avg_memory(self) -> float:
+        return self.memory / self.count if self.count else 0.
+
+    def add(self, key: str, key_type: str, ttl: int, memory: Optional[int]) -> None:
+        self.count += 1
+        self.memory += memory or 0
+        ttl_bucket = get_ttl_bucket(ttl)
+        self.ttl[ttl_bucket] = self.ttl.get(ttl_bucket, 0) + 1
+        self.types[key_type] = self.types.get(key_type, 0) + 1
+        if ttl_bucket == 'none' and has_date(key):
+            self.dated_without_ttl += 1
+
+    def add_length(self, key: str, length: int) -> None:
+        if length > self.max_length:
+            self.max_length = length
+            self.max_length_key = key
+
+    def add_value(self, value_type: str) -> None:
+        self.values[value_type] = self.values.get(value_type, 0) + 1
+
+    def get_warnings(self, large_collection: int) -> List[str]:
+        warnings = []
+        if self.dated_without_ttl:
+            warnings.append(f'{self.dated_without_ttl} keys with a date in the name have no TTL')
+        elif self.ttl.get('none'):
+            warnings.append(f'{self.ttl["none"]} keys have no TTL')
+        if self.max_length >= large_collection:
+            warnings.append(f'{self.max_length_key} has {self.max_length} elements')
+        return warnings
+
+    def to_dict(self, large_collection: int) -> dict:
+        return {
+            'family': self.family,
+            'count': self.count,
+            'memory': self.memory,
+            'avg_memory': round(self.avg_memory, 1),
+            'ttl': self.ttl,
+            'types': self.types,
+            'values': self.values,
+            'max_length': self.max_length,
+            'max_length_key': self.max_length_key,
+            'warnings': self.get_warnings(large_collection),
+        }
+
+
+_length_commands = {
+    'list': 'llen',
+    'set': 'scard',
+    'zset': 'zcard',
+    'hash': 'hlen',
+    'stream': 'xlen',
+}
+
+
+def analyze(client: redis.StrictRedis, match: str = '*', batch_size: int = 500,
+            limit: Optional[int] = None, samples: int = 3,
+            memory_samples: int = 5) -> Dict[str, FamilyStats]:
+    """
+    Перебирает ключи порциями. На порцию — два пайплайна: тип, TTL и память,
+    затем длины коллекций и примеры значений.
+    """
+    stats: Dict[str, FamilyStats] = {}
+    batch: List[str] = []
+    seen = 0
+
+    def flush() -> None:
+        pipe = client.pipeline(transaction=False)
+        for key in batch:
+            pipe.type(key)
+            pipe.ttl(key)
+            pipe.memory_usage(key, samples=memory_samples)
+        values = pipe.execute(raise_on_error=False)
+
+        pipe = client.pipeline(transaction=False)
+        followups = []
+        for i, key in enumerate(batch):
+            key_type, ttl, memory = values[3 * i:3 * i + 3]
+            if isinstance(key_type, bytes):
+                key_type = key_type.decode('utf-8')
+            if key_type == 'none':  # ключ успел истечь
+                continue
+            family = get_family(key)
+            family_stats = stats.get(family)
+            if family_stats is None:
+                family_stats = stats[family] = FamilyStats(family)
+            family_stats.add(key, key_type, ttl if isinstance(ttl, int) else None,
+                             memory if isinstance(memory, int) else None)
+            if key_type in _length_commands:
+                getattr(pipe, _length_commands[key_type])(key)
+                followups.append((family_stats, key, 'length'))
+            elif key_type == 'string' and len(family_stats.sample_keys) < samples:
+                family_stats.sample_keys.append(key)
+                pipe.get(key)
+                followups.append((family_stats, key, 'value'))
+        for (family_stats, key, kind), result in zip(followups, pipe.execute(raise_on_error=False)):
+            if kind == 'length' and isinstance(result, int):
+                family_stats.add_length(key, result)
+            elif kind == 'value' and isinstance(result, bytes):
+                family_stats.add_value(describe_value(result))
+
+    for key in client.scan_iter(match=match, count=batch_size):
+        batch.append(key.decode('utf-8', 'backslashreplace') if isinstance(key, bytes) else key)
+        seen += 1
+        if len(batch) >= batch_size:
+            flush()
+            batch = []
+        if limit is not None and seen >= limit:
+            break
+    if batch:
+        flush()
+    return stats
+
+
+def format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+
+def format_report(stats: Dict[str, FamilyStats], large_collection: int = 10000) -> str:
+    families = sorted(stats.values(), key=lambda s: s.memory, reverse=True)
+    total = sum(s.memory for s in families) or 1
+    lines = [f'{"family":<40} {"keys":>9} {"memory":>10} {"%":>5} {"avg":>9}  ttl / types / values']
+    for s in families:
+        ttl = ' '.join(f'{k}={v}' for k, v in sorted(s.ttl.items()))
+        types = ' '.join(f'{k}={v}' for k, v in sorted(s.types.items()))
+        values = ' '.join(sorted(s.values))
+        lines.append(f'{s.family:<40} {s.count:>9} {format_size(s.memory):>10} '
+                     f'{100 * s.memory / total:>5.1f} {format_size(s.avg_memory):>9}  '
+                     f'{ttl} / {types}' + (f' / {values}' if values else ''))
+        for warning in s.get_warnings(large_collection):
+            lines.append(f'{"":<40} ! {warning}')
+    lines.append(f'total: {sum(s.count for s in families)} keys, '
+                 f'{format_size(sum(s.memory for s in families))}')
+    return '\n'.join(lines)
+
+
+def get_client(args) -> redis.StrictRedis:
+    if args.host is None:
+        from src.config import CONFIG
+
+        config = CONFIG['cache']['redis']
+        return redis.StrictRedis(host=config['host'], port=config['port'], db=config['db'])
+    return redis.StrictRedis(host=args.host, port=args.port, db=args.db)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Redis memory usage by key family')
+    parser.add_argument('--host', help='by default the redis from config.json is used')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=0)
+    parser.add_argument('--match', default='*', help='SCAN pattern')
+    parser.add_argument('--limit', type=int, help='stop after this many keys')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--samples', type=int, default=3,
+                        help='string values per family to decode')
+    parser.add_argument('--large-collection', type=int, default=10000,
+                        help='warn about lists/sets/hashes with this many elements')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    stats = analyze(get_client(args), match=args.match, batch_size=args.batch_size,
+                    limit=args.limit, samples=args.samples)
+    if args.json:
+        print(json.dumps([s.to_dict(args.large_collection)
+                          for s in sorted(stats.values(), key=lambda s: s.memory, reverse=True)],
+                         ensure_ascii=False, indent=2))
+        return
+    print(format_report(stats, args.large_collection))
+
+
+if __name__ == '__main__':
+    main()
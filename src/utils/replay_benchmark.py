@@ -0,0 +1,552 @@
+"""
+Офлайн-бенчмарк бота: прогоняет апдейты через настоящий диспетчер с обработчиками из
+`add_chat_handlers` и `add_private_handlers` и считает пропускную способность.
+
+    python -m src.utils.replay_benchmark --count 5000
+    python -m src.utils.replay_benchmark --updates recorded.jsonl
+
+Запускать из корня репозитория (нужен файл `commands`). Апдейты берутся из файла (по одному
+json на строку, как их отдает getUpdates) или генерируются: тексты, ответы, упоминания, стикеры,
+фото, ссылки, команды и личка. `--save` сохраняет сгенерированные апдейты, чтобы прогонять
+один и тот же набор до и после изменений.
+
+Окружение:
+
+- бд — временная sqlite, схема создается миграциями (или `--database`);
+- редис — кэш в памяти процесса (`src/utils/memory_cache.py`) или `--redis-url`
+  на пустую базу локального редиса;
+- телеграм — поддельный `Request`: запросы бота записываются и получают правдоподобные ответы;
+- внешние http-запросы обработчиков не уходят в сеть: картинки получают сгенерированный png,
+  остальное — 503;
+- лимиты очереди исходящих сообщений сняты, иначе бенчмарк мерил бы лимиты телеграма.
+
+В отчете: апдейтов в секунду, перцентили времени по обработчикам и запросы к редису и бд на апдейт.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from io import BytesIO
+from typing import Dict, Iterable, List, Optional
+
+import requests
+
+from src.config import CONFIG, CMDS
+
+BOT_ID = 100500
+BOT_TOKEN = f'{BOT_ID}:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+BOT_USER = {'id': BOT_ID, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+
+# доли типов синтетических апдейтов
+DEFAULT_MIX = {
+    'text': 50,
+    'reply': 15,
+    'mention': 5,
+    'sticker': 8,
+    'photo': 5,
+    'link': 5,
+    'command': 10,
+    'private': 2,
+}
+COMMANDS = ('self_stat', 'who_is', 'time', 'rules', 'weather', 'flip', 'khaleesi')
+WORDS = ('привет', 'как', 'дела', 'сегодня', 'погода', 'бот', 'чат', 'работа', 'кофе', 'утро',
+         'вечер', 'кот', 'пятница', 'мем', 'ахаха', 'ну', 'да', 'нет', 'может', 'завтра')
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+class SyntheticUpdates:
+    """
+    Генератор апдейтов в формате Bot API.
+    """
+
+    def __init__(self, chats: int = 5, users: int = 200, seed: int = 1,
+                 mix: Optional[Dict[str, int]] = None) -> None:
+        self.random = random.Random(seed)
+        self.chat_ids = [-1001000000000 - i for i in range(chats)]
+        self.uids = [1000 + i for i in range(users)]
+        self.mix = mix or DEFAULT_MIX
+        self.update_id = 0
+        self.message_ids: Dict[int, int] = defaultdict(int)
+        self.now = int(time.time())
+        self.commands = [CMDS.get('common', {}).get(key, {}).get('name', key) for key in COMMANDS]
+
+    def generate(self, count: int) -> Iterable[dict]:
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        for _ in range(count):
+            kind = self.random.choices(kinds, weights)[0]
+            yield getattr(self, f'_{kind}')()
+
+    def _message(self, chat_id: Optional[int] = None, uid: Optional[int] = None, **fields) -> dict:
+        uid = uid or self.random.choice(self.uids)
+        chat_id = chat_id or self.random.choice(self.chat_ids)
+        self.update_id += 1
+        self.message_ids[chat_id] += 1
+        self.now += 1
+        chat = {'id': chat_id, 'type': 'private', 'first_name': f'user{uid}'} if chat_id > 0 else \
+            {'id': chat_id, 'type': 'supergroup', 'title': f'bench {chat_id}'}
+        message = {
+            'message_id': self.message_ids[chat_id],
+            'date': self.now,
+            'chat': chat,
+            'from': self._user(uid),
+        }
+        message.update(fields)
+        return {'update_id': self.update_id, 'message': message}
+
+    @staticmethod
+    def _user(uid: int) -> dict:
+        return {'id': uid, 'is_bot': False, 'first_name': f'user{uid}', 'username': f'user{uid}'}
+
+    def _words(self, low: int = 2, high: int = 15) -> str:
+        return ' '.join(self.random.choice(WORDS) for _ in range(self.random.randint(low, high)))
+
+    def _text(self) -> dict:
+        return self._message(text=self._words())
+
+    def _reply(self) -> dict:
+        chat_id = self.random.choice(self.chat_ids)
+        uid = self.random.choice(self.uids)
+        replied = {
+            'message_id': max(1, self.message_ids[chat_id] - self.random.randint(0, 20)),
+            'date': self.now,
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'bench {chat_id}'},
+            'from': self._user(uid),
+            'text': self._words(),
+        }
+        return self._message(chat_id=chat_id, text=self._words(), reply_to_message=replied)
+
+    def _mention(self) -> dict:
+        name = f'@user{self.random.choice(self.uids)}'
+        text = f'{name} {self._words()}'
+        return self._message(text=text, entities=[{'type': 'mention', 'offset': 0,
+                                                   'length': len(name)}])
+
+    def _sticker(self) -> dict:
+        number = self.random.randint(1, 50)
+        return self._message(sticker={'file_id': f'sticker{number}',
+                                      'file_unique_id': f'st{number}',
+                                      'width': 512, 'height': 512, 'is_animated': False,
+                                      'emoji': '😀', 'set_name': 'bench'})
+
+    def _photo(self) -> dict:
+        # картинки иногда повторяются, чтобы баянометру было что находить
+        number = self.random.randint(1, 30)
+        return self._message(photo=[{'file_id': f'photo{number}', 'file_unique_id': f'ph{number}',
+                                      'width': 800, 'height': 600}])
+
+    def _link(self) -> dict:
+        url = f'https://example.com/{self.random.randint(1, 1000)}'
+        text = f'{self._words(1, 5)} {url}'
+        return self._message(text=text, entities=[{'type': 'url', 'offset': text.index(url),
+                                                   'length': len(url)}])
+
+    def _command(self) -> dict:
+        command = f'/{self.random.choice(self.commands)}'
+        return self._message(text=command, entities=[{'type': 'bot_command', 'offset': 0,
+                                                      'length': len(command)}])
+
+    def _private(self) -> dict:
+        uid = self.random.choice(self.uids)
+        command = self.random.choice(('/mystat', '/whois', '/help'))
+        entity = {'type': 'bot_command', 'offset': 0, 'length': len(command)}
+        return self._message(chat_id=uid, uid=uid, text=command, entities=[entity])
+
+
+class FakeRequest:
+    """
+    Вместо http-запросов к Bot API: запоминает вызовы и отвечает правдоподобными результатами.
+    """
+    con_pool_size = 64
+
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+        self.lock = threading.Lock()
+        self.message_id = 10 ** 6
+
+    def get(self, url: str, timeout=None):
+        return self.post(url, {}, timeout)
+
+    def post(self, url: str, data: dict, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        with self.lock:
+            self.calls[method] += 1
+            self.message_id += 1
+            message_id = self.message_id
+        data = data or {}
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getFile':
+            return {'file_id': data.get('file_id'), 'file_unique_id': data.get('file_id'),
+                    'file_size': 1000, 'file_path': f'photos/{data.get("file_id")}.png'}
+        if method == 'getChat':
+            return {'id': data.get('chat_id'), 'type': 'supergroup', 'title': 'bench'}
+        if method == 'getChatMember':
+            return {'user': {'id': data.get('user_id'), 'is_bot': False, 'first_name': 'bench'},
+                    'status': 'member'}
+        if method in ('getChatAdministrators', 'getMyCommands', 'getUpdates'):
+            return []
+        if method == 'getStickerSet':
+            return {'name': data.get('name'), 'title': 'bench', 'is_animated': False,
+                    'contains_masks': False, 'stickers': []}
+        if method.startswith(('send', 'forward', 'copy', 'edit')):
+            chat_id = data.get('chat_id', 0)
+            chat_id = chat_id if isinstance(chat_id, int) else 0
+            return {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                    'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'},
+                    'text': data.get('text') or data.get('caption') or ''}
+        return True
+
+    def retrieve(self, url: str, timeout=None) -> bytes:
+        with self.lock:
+            self.calls['download'] += 1
+        return make_png(url)
+
+    def download(self, url: str, filename: str, timeout=None) -> None:
+        with open(filename, 'wb') as f:
+            f.write(self.retrieve(url, timeout))
+
+    def stop(self) -> None:
+        pass
+
+
+def make_png(seed: str) -> bytes:
+    """
+    Картинка 800x600, одинаковая для одинакового seed.
+    """
+    from PIL import Image
+
+    rnd = random.Random(seed)
+    small = Image.new('RGB', (16, 12))
+    small.putdata([(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+                   for _ in range(16 * 12)])
+    buffer = BytesIO()
+    small.resize((800, 600)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class OfflineAdapter(requests.adapters.BaseAdapter):
+    """
+    Транспорт для `requests`, который никуда не ходит: картинки — сгенерированный png,
+    остальное — 503.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls: Counter = Counter()
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        host = requests.utils.urlparse(request.url).netloc
+        self.calls[host] += 1
+        if request.url.lower().endswith(('.png', '.jpg', '.jpeg')):
+            response.status_code = 200
+            response._content = make_png(request.url.rsplit('/', 1)[-1])
+            response.headers['Content-Type'] = 'image/png'
+        else:
+            response.status_code = 503
+            response._content = b''
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+def setup_environment(database: Optional[str], redis_url: Optional[str]) -> OfflineAdapter:
+    """
+    Конфиг меняется до импорта модулей бота: бд и редис подключаются при импорте.
+    """
+    if database is None:
+        database = f'sqlite:///{tempfile.mkdtemp(prefix="bench_")}/bench.sqlite'
+    CONFIG['database'] = database
+    CONFIG['cache'] = {'backend': 'memory'}
+    CONFIG.pop('profiler', None)
+    CONFIG.pop('webhook_domain', None)
+
+    import src.utils.cache as cache_module
+
+    if redis_url is not None:
+        import redis
+
+        pool = redis.ConnectionPool.from_url(redis_url)
+        pure_pool = redis.ConnectionPool.from_url(redis_url, decode_responses=True)
+        cache_module._redis = cache_module.InstrumentedRedis(connection_pool=pool)
+        cache_module._pure_redis = cache_module.InstrumentedRedis(connection_pool=pure_pool)
+    cache_module._bot_id = BOT_ID
+
+    from src.utils.db import engine
+    from src.utils.migrations import migrate
+
+    migrate(engine)
+
+    adapter = OfflineAdapter()
+    requests.Session.get_adapter = lambda self, url: adapter
+    return adapter
+
+
+def create_dispatcher(workers: int):
+    import telegram
+    from telegram.ext import Dispatcher
+
+    class BenchmarkDispatcher(Dispatcher):
+        """
+        Считает обработанные апдейты и незавершенные run_async-задачи, чтобы дождаться конца.
+        """
+
+        def __init__(self, *args, **kwargs) -> None:
+            super().__init__(*args, **kwargs)
+            self.processed = 0
+            self.pending = 0
+            self.async_errors: Counter = Counter()
+            self.counter_lock = threading.Condition()
+
+        def process_update(self, update) -> None:
+            try:
+                super().process_update(update)
+            finally:
+                with self.counter_lock:
+                    self.processed += 1
+                    self.counter_lock.notify_all()
+
+        def run_async(self, func, *args, **kwargs):
+            with self.counter_lock:
+                self.pending += 1
+
+            def run(*run_args, **run_kwargs):
+                try:
+                    return func(*run_args, **run_kwargs)
+                except Exception as e:
+                    with self.counter_lock:
+                        self.async_errors[type(e).__name__] += 1
+                    raise
+                finally:
+                    with self.counter_lock:
+                        self.pending -= 1
+                        self.counter_lock.notify_all()
+
+            return super().run_async(run, *args, **kwargs)
+
+        def wait(self, count: int, timeout: float, pipelines=()) -> bool:
+            """
+            Обработчики отдают работу в run_async, полосы и конвейеры, а те — друг другу.
+            Поэтому ждем, пока не опустеет все сразу. `pipelines` — все, у чего есть
+            `join(timeout)` и `in_flight`.
+            """
+            deadline = time.monotonic() + timeout
+            while True:
+                with self.counter_lock:
+                    while self.processed < count or self.pending > 0:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            return False
+                        self.counter_lock.wait(left)
+                for pipeline in pipelines:
+                    if not pipeline.join(max(0., deadline - time.monotonic())):
+                        return False
+                with self.counter_lock:
+                    if self.pending == 0 and not any(p.in_flight for p in pipelines):
+                        return True
+
+    from queue import Queue
+
+    request = FakeRequest()
+    bot = telegram.Bot(BOT_TOKEN, request=request)
+    dp = BenchmarkDispatcher(bot, Queue(), workers=workers, use_context=False)
+    # run_async в обработчиках ищет диспетчер через Dispatcher.get_instance(), а синглтон
+    # записывается на класс экземпляра — то есть на наследника
+    Dispatcher._set_singleton(dp)
+    return dp, request
+
+
+def unthrottle_outbound() -> None:
+    from src.utils.outbound_scheduler import TokenBucket
+    from src.utils.telegram_helpers import dsp
+
+    dsp.global_bucket = TokenBucket(10 ** 9, 10 ** 9)
+    dsp.group_limits = (10 ** 9, 10 ** 9)
+    dsp.private_limits = (10 ** 9, 10 ** 9)
+
+
+def load_updates(path: str) -> List[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def configure_chats(updates: List[dict]) -> None:
+    """
+    Чаты из апдейтов разрешаются в конфиге, иначе chat_guard отбросит их команды.
+    """
+    chats = CONFIG.setdefault('chats', {})
+    for update in updates:
+        chat = (update.get('message') or {}).get('chat') or {}
+        if chat.get('id', 0) < 0:
+            chats.setdefault(str(chat['id']), {'all_cmd': True})
+
+
+def run(updates: List[dict], workers: int, timeout: float, adapter: OfflineAdapter) -> dict:
+    import telegram
+
+    from src.bot_start.add_handlers import add_chat_handlers, add_private_handlers
+    from src.modules.message_reactions import passive_pipeline
+    from src.utils.handlers_decorators import instrument_handlers
+    from src.utils.lanes import LANES
+    from src.utils.metrics import metrics
+
+    dp, request = create_dispatcher(workers)
+    add_chat_handlers(dp)
+    add_private_handlers(dp)
+    instrument_handlers(dp)
+    errors: Counter = Counter()
+    dp.add_error_handler(lambda bot, update, error: errors.update([type(error).__name__]))
+    unthrottle_outbound()
+
+    durations: Dict[str, List[float]] = defaultdict(list)
+    durations_lock = threading.Lock()
+
+    def observe(name: str, duration: float) -> None:
+        with durations_lock:
+            durations[name].append(duration)
+
+    metrics.observers.append(observe)
+    parsed = [telegram.Update.de_json(update, dp.bot) for update in updates]
+    calls_before = dict(metrics.calls)
+    lanes_before = {lane.name: (lane.tasks, lane.wait_total, Counter(lane.errors))
+                    for lane in LANES}
+
+    thread = threading.Thread(target=dp.start, name='dispatcher', daemon=True)
+    thread.start()
+    start = time.perf_counter()
+    for update in parsed:
+        dp.update_queue.put(update)
+    finished = dp.wait(len(parsed), timeout, [passive_pipeline, *LANES])
+    elapsed = time.perf_counter() - start
+    dp.stop()
+
+    count = len(parsed) or 1
+    lanes = {}
+    lane_errors: Counter = Counter()
+    for lane in LANES:
+        tasks, wait_total, lane_errors_before = lanes_before[lane.name]
+        tasks = lane.tasks - tasks
+        lanes[lane.name] = {
+            'workers': lane.workers,
+            'tasks': tasks,
+            'wait_avg_ms': (lane.wait_total - wait_total) / tasks * 1000 if tasks else 0,
+            'wait_max_ms': lane.wait_max * 1000,
+        }
+        lane_errors += lane.errors - lane_errors_before
+    handlers = {}
+    for name, values in sorted(durations.items()):
+        stats = metrics.handlers.get(name)
+        handlers[name] = {
+            'count': len(values),
+            'errors': stats.errors if stats else 0,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p90_ms': percentile(values, 90) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': max(values) * 1000,
+            'redis_per_call': stats.calls['redis'] / stats.updates if stats else 0,
+            'mysql_per_call': stats.calls['mysql'] / stats.updates if stats else 0,
+        }
+    return {
+        'updates': len(parsed),
+        'finished': finished,
+        'seconds': elapsed,
+        'updates_per_sec': len(parsed) / elapsed if elapsed else 0,
+        'redis_per_update': (metrics.calls['redis'] - calls_before['redis']) / count,
+        'mysql_per_update': (metrics.calls['mysql'] - calls_before['mysql']) / count,
+        'handlers': handlers,
+        'lanes': lanes,
+        'errors': dict(errors + dp.async_errors + lane_errors),
+        'bot_api_calls': dict(request.calls),
+        'external_http_calls': dict(adapter.calls),
+    }
+
+
+def format_report(result: dict) -> str:
+    lines = [
+        f'updates: {result["updates"]} in {result["seconds"]:.2f} sec, '
+        f'{result["updates_per_sec"]:.1f} updates/sec'
+        + ('' if result['finished'] else ' (timeout: not everything finished)'),
+        f'per update: redis {result["redis_per_update"]:.1f}, '
+        f'mysql {result["mysql_per_update"]:.1f}',
+        '',
+        f'{"handler":<50} {"count":>6} {"err":>4} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} '
+        f'{"max ms":>8} {"redis":>6} {"mysql":>6}',
+    ]
+    for name, h in sorted(result['handlers'].items(), key=lambda item: -item[1]['count']):
+        lines.append(f'{name:<50} {h["count"]:>6} {h["errors"]:>4} {h["p50_ms"]:>8.2f} '
+                     f'{h["p90_ms"]:>8.2f} {h["p99_ms"]:>8.2f} {h["max_ms"]:>8.2f} '
+                     f'{h["redis_per_call"]:>6.1f} {h["mysql_per_call"]:>6.1f}')
+    lines.append(f'\n{"lane":<20} {"workers":>8} {"tasks":>8} {"wait avg ms":>12} '
+                 f'{"wait max ms":>12}')
+    for name, lane in result['lanes'].items():
+        lines.append(f'{name:<20} {lane["workers"]:>8} {lane["tasks"]:>8} '
+                     f'{lane["wait_avg_ms"]:>12.2f} {lane["wait_max_ms"]:>12.2f}')
+    if result['errors']:
+        lines.append(f'\nerrors: {result["errors"]}')
+    lines.append(f'\nbot api calls: {result["bot_api_calls"]}')
+    if result['external_http_calls']:
+        lines.append(f'external http calls: {result["external_http_calls"]}')
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Replay updates through the bot dispatcher offline')
+    parser.add_argument('--updates', help='recorded updates: json lines or a json array')
+    parser.add_argument('--count', type=int, default=2000, help='synthetic updates to generate')
+    parser.add_argument('--chats', type=int, default=5)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='save the updates to replay them later')
+    parser.add_argument('--workers', type=int, default=32,
+                        help='dispatcher run_async workers, as in start.py')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--database', help='sqlalchemy url, a temporary sqlite by default')
+    parser.add_argument('--redis-url',
+                        help='an empty local redis db, the in-memory cache by default')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--verbose', action='store_true', help='keep the bot logs and tracebacks')
+    args = parser.parse_args(argv)
+
+    if args.updates:
+        updates = load_updates(args.updates)
+    else:
+        updates = list(SyntheticUpdates(args.chats, args.users, args.seed).generate(args.count))
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            for update in updates:
+                f.write(json.dumps(update, ensure_ascii=False) + '\n')
+
+    os.environ.setdefault('TZ', 'Europe/Moscow')
+    if not args.verbose:
+        # ошибки обработчиков считаются в отчете, трейсбеки только мешают читать его
+        logging.disable(logging.CRITICAL)
+    adapter = setup_environment(args.database, args.redis_url)
+    configure_chats(updates)
+    result = run(updates, args.workers, args.timeout, adapter)
+    print(json.dumps(result, ensure_ascii=False, indent=2) if args.json else format_report(result))
+    # потоки бота (очередь исходящих, планировщики) не останавливаются сами
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,11 @@ from typing import List, Optional
 
 import telegram
 from telegram import ParseMode, StickerSet
-from telegram.ext import DelayQueue
 
 from src.utils.logger_helpers import get_logger
 from src.utils.misc import chunks
 from src.utils.mwt import MWT
+from src.utils.outbound_scheduler import OutboundScheduler, Priority
 
 logger = get_logger(__name__)
 
@@ -18,7 +18,7 @@ def dsp_catch(e: Exception):
     traceback.print_exception(Exception, e, e.__traceback__)
 
 
-dsp = DelayQueue(burst_limit=20, time_limit_ms=1017, exc_route=dsp_catch)
+dsp = OutboundScheduler(exc_route=dsp_catch)
 
 
 def telegram_retry(tries=4, delay=3, backoff=2, logger=None, silence: bool = False, default=None,
@@ -42,8 +42,8 @@ def telegram_retry(tries=4, delay=3, backoff=2, logger=None, silence: bool = Fal
                     if isinstance(e, telegram.error.TimedOut):
                         found = True
                     if isinstance(e, telegram.error.RetryAfter):
-                        log(f'{stitle}Flood limit, wait 5 sec')
-                        time.sleep(5)
+                        log(f'{stitle}Flood limit, wait {e.retry_after} sec')
+                        time.sleep(e.retry_after)
                         found = True
                     if not found:
                         break
@@ -80,9 +80,10 @@ def get_photo_url(bot: telegram.Bot, message: telegram.Message) -> str:
     return bot.get_file(message.photo[-1].file_id).file_path
 
 
-def send_long(bot: telegram.Bot, chat_id: int, msg: str):
+def send_long(bot: telegram.Bot, chat_id: int, msg: str, priority: int = Priority.NORMAL):
     for chunk in chunks(msg, 4096):
-        dsp(bot.send_message, chat_id, chunk, parse_mode=ParseMode.HTML)
+        dsp.put(bot.send_message, (chat_id, chunk), {'parse_mode': ParseMode.HTML},
+                chat_id=chat_id, priority=priority)
 
 
 def get_sticker_set_fixed(bot: telegram.Bot, name: str) -> StickerSet:
@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
 
 def today_str() -> str:
     return datetime.today().strftime('%Y%m%d')
@@ -15,3 +15,15 @@ def get_yesterday() -> datetime:
 
 def get_current_monday_str():
     return get_date_monday(datetime.today()).strftime('%Y%m%d')
+
+def get_last_due(at: time, days: tuple, now: datetime) -> datetime:
+    """
+    Когда ежедневная задача (`run_daily(time=at, days=days)`) последний раз должна была
+    выполниться. `at` и `now` — с таймзоной.
+    """
+    now = now.astimezone(at.tzinfo)
+    for days_ago in range(8):
+        due = datetime.combine(now.date() - timedelta(days=days_ago), at)
+        if due <= now and due.weekday() in days:
+            return due
+    raise ValueError(f'no days to run: {days}')
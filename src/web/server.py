@@ -1,2 +1,105 @@
-def start_server(bot, port):
-    pass
+"""
+Локальный http-сервер с метриками бота в формате Prometheus: `GET /metrics`.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from src.config import CONFIG
+from src.utils.async_pipeline import AsyncPipeline
+from src.utils.lanes import LANES
+from src.utils.logger_helpers import get_logger
+from src.utils.metrics import metrics
+from src.utils.telegram_helpers import dsp
+
+logger = get_logger(__name__)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        # прометей ходит часто, не засоряем лог
+        pass
+
+
+def register_gauges(dispatcher) -> None:
+    metrics.register_gauge('bot_dispatcher_workers', 'Size of the run_async worker pool',
+                           lambda: dispatcher.workers)
+    metrics.register_gauge('bot_dispatcher_utilization', 'Busy run_async workers / pool size',
+                           lambda: metrics.async_busy / dispatcher.workers
+                           if dispatcher.workers else 0)
+    metrics.register_gauge('bot_update_queue_depth', 'Updates waiting for the dispatcher',
+                           lambda: dispatcher.update_queue.qsize())
+
+    def outbound_depth():
+        depth = dsp.stats()['depth_by_priority']
+        return {(('priority', str(priority)),): count for priority, count in depth.items()}
+
+    metrics.register_gauge('bot_outbound_queue_depth', 'Outgoing messages waiting to be sent',
+                           outbound_depth)
+    for key, help_text, kind in (
+            ('sent', 'Outgoing messages sent', 'counter'),
+            ('errors', 'Outgoing messages failed', 'counter'),
+            ('retry_after', 'RetryAfter responses from telegram', 'counter'),
+            ('wait_avg', 'Average wait of an outgoing message, sec', 'gauge'),
+            ('wait_max', 'Max wait of an outgoing message, sec', 'gauge')):
+        name = f'bot_outbound_{key}_total' if kind == 'counter' else f'bot_outbound_{key}_seconds'
+        metrics.register_gauge(name, help_text, lambda key=key: dsp.stats()[key], kind)
+
+    for name, help_text, kind, func in (
+            ('bot_lane_workers', 'Threads in the lane', 'gauge', lambda lane: lane.workers),
+            ('bot_lane_busy', 'Busy threads in the lane', 'gauge', lambda lane: lane.busy),
+            ('bot_lane_queue_depth', 'Tasks waiting for a lane thread', 'gauge',
+             lambda lane: lane.queued),
+            ('bot_lane_saturation', 'Busy lane threads / lane size', 'gauge',
+             lambda lane: lane.saturation),
+            ('bot_lane_tasks_total', 'Tasks started in the lane', 'counter',
+             lambda lane: lane.tasks),
+            ('bot_lane_wait_seconds_total', 'Time tasks waited for a lane thread', 'counter',
+             lambda lane: lane.wait_total),
+            ('bot_lane_errors_total', 'Lane tasks failed', 'counter',
+             lambda lane: sum(lane.errors.values()))):
+        metrics.register_gauge(name, help_text, lambda func=func: {
+            (('lane', lane.name),): func(lane) for lane in LANES}, kind)
+
+    for name, help_text, kind, func in (
+            ('bot_pipeline_in_flight', 'Messages in the pipeline, with the backlog', 'gauge',
+             lambda pipeline: pipeline.in_flight),
+            ('bot_pipeline_backlog', 'Messages waiting for a free pipeline slot', 'gauge',
+             lambda pipeline: pipeline.backlog),
+            ('bot_pipeline_dropped_total', 'Messages dropped because the backlog was full',
+             'counter', lambda pipeline: pipeline.dropped)):
+        metrics.register_gauge(name, help_text, lambda func=func: {
+            (('pipeline', pipeline.name),): func(pipeline)
+            for pipeline in AsyncPipeline.registry.values()}, kind)
+
+
+def start_server(dispatcher, port, offset: int = 0) -> Optional[ThreadingHTTPServer]:
+    """
+    `offset` — сдвиг порта, чтобы у каждого воркера кластера был свой.
+    """
+    config = CONFIG.get('metrics', {})
+    if not config.get('enabled', True):
+        return None
+    host = config.get('host', '127.0.0.1')
+    port = int(config.get('port', port)) + offset
+    register_gauges(dispatcher)
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    except OSError as e:
+        logger.error(f"[metrics] can't listen on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    logger.info(f'[metrics] http://{host}:{port}/metrics')
+    return server
@@ -0,0 +1,47 @@
+import random
+import unittest
+from collections import Counter
+
+from tests.utils import real_modules
+
+with real_modules():
+    from src.models.chat_user import ChatMembers, ChatUser
+    from src.utils import cache as cache_module
+    from src.utils.memory_cache import MemoryRedis, MemoryStore
+
+
+class RandomMembersTest(unittest.TestCase):
+    cid = -1
+    uids = list(range(1, 11))
+
+    def setUp(self):
+        self.backup = cache_module._redis, cache_module._pure_redis
+        self.store = MemoryStore(sweep_interval=0)
+        cache_module._redis = MemoryRedis(self.store)
+        cache_module._pure_redis = MemoryRedis(self.store, decode_responses=True)
+        cache_module.pure_cache.replace_set(f'chat_members:{self.cid}',
+                                            {ChatMembers.placeholder, *map(str, self.uids)})
+        random.seed(1)
+
+    def tearDown(self):
+        cache_module._redis, cache_module._pure_redis = self.backup
+
+    def test_distinct(self):
+        for count in (1, 5, 10):
+            uids = ChatUser.get_random_uids(self.cid, count)
+            self.assertEqual(count, len(set(uids)))
+            self.assertLessEqual(set(uids), set(self.uids))
+        self.assertEqual(set(self.uids), set(ChatUser.get_random_uids(self.cid, 20)))
+
+    def test_weighted_distinct(self):
+        uids = ChatUser.get_random_uids(self.cid, 5, weights={1: 100})
+        self.assertEqual(5, len(set(uids)))
+        self.assertIn(1, uids)
+
+    def test_weighted_bias(self):
+        weights = {1: 50, 2: 50}
+        picks = Counter(ChatUser.get_random(self.cid, weights).uid for _ in range(1000))
+        # у двух активных по 50 из 108, остальные восемь делят 8
+        self.assertGreater(picks[1] + picks[2], 850)
+        self.assertLessEqual(set(picks), set(self.uids))
+        self.assertGreater(len(picks), 2)  # остальные тоже выпадают
@@ -0,0 +1,42 @@
+import sys
+from contextlib import contextmanager
+from typing import Dict
+from unittest import mock
+
+# настоящие модули, импортированные через real_modules
+_real_modules: Dict[str, object] = {}
+
+
+@contextmanager
+def real_modules():
+    """
+    Импорт настоящих модулей `src` и `telegram`, даже если старые тесты уже подменили их
+    моками в `sys.modules` (см. tests/modules/test_antimat.py). Pytest сначала собирает
+    все тесты, так что без этого результат зависит от порядка файлов.
+
+    На время импорта убираются моки и модули `src` (они могли импортироваться вместе с
+    моками), а после импорта возвращаются на место, чтобы не сломать те старые тесты.
+    Остальные модули, импортированные внутри (например, `redis`), остаются в `sys.modules`:
+    иначе следующий импорт создаст второй объект модуля со своими классами исключений.
+    """
+    # без подмененного пакета его настоящие подмодули не попадут в атрибуты нового
+    telegram_mocked = isinstance(sys.modules.get('telegram'), mock.Mock)
+    stubbed = {name: module for name, module in sys.modules.items()
+               if isinstance(module, mock.Mock) or _is_package(name, 'src')
+               or telegram_mocked and _is_package(name, 'telegram')}
+    for name in stubbed:
+        del sys.modules[name]
+    sys.modules.update(_real_modules)
+    try:
+        yield
+    finally:
+        for name, module in list(sys.modules.items()):
+            if _is_package(name, 'src') or _is_package(name, 'telegram'):
+                _real_modules.setdefault(name, module)
+                if _is_package(name, 'src') or telegram_mocked:
+                    del sys.modules[name]
+        sys.modules.update(stubbed)
+
+
+def _is_package(name: str, package: str) -> bool:
+    return name == package or name.startswith(package + '.')
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from tests.utils import real_modules
+
+with real_modules():
+    from src.utils import cache as cache_module
+    from src.utils.async_pipeline import AsyncPipeline, Stage
+    from src.utils.lanes import Lane
+    from src.utils.memory_cache import MemoryRedis, MemoryStore
+
+
+class AsyncPipelineTest(unittest.TestCase):
+    def test_steps_and_stages(self):
+        events = []
+        lock = threading.Lock()
+        both_started = threading.Barrier(2, timeout=5)
+
+        def record(name):
+            def stage(value):
+                with lock:
+                    events.append((name, value))
+            return stage
+
+        def concurrent(name):
+            # оба этапа шага должны работать одновременно, иначе барьер не пройти
+            def stage(value):
+                both_started.wait()
+                record(name)(value)
+            return stage
+
+        async def async_stage(value):
+            await asyncio.sleep(0)
+            record('async')(value)
+
+        def failing(_):
+            raise ValueError('stage error')
+
+        pipeline = AsyncPipeline('test', [
+            [Stage('first', record('first'))],
+            [
+                Stage('db', concurrent('db')),
+                Stage('http', concurrent('http'), 'http'),
+                Stage('async', async_stage, 'async'),
+                Stage('failing', failing),
+                Stage('skipped', record('skipped'), when=lambda value: value > 10),
+            ],
+        ], lanes={'db': Lane('test-db', 2), 'http': Lane('test-http', 2)})
+        for value in range(3):
+            pipeline.submit(value)
+        self.assertTrue(pipeline.join(timeout=10))
+        self.assertEqual(0, pipeline.in_flight)
+
+        for value in range(3):
+            names = [name for name, v in events if v == value]
+            self.assertEqual('first', names[0])
+            self.assertEqual({'first', 'db', 'http', 'async'}, set(names))
+
+    def test_submit_does_not_block(self):
+        release = threading.Event()
+        done = []
+
+        def blocking(value):
+            release.wait(5)
+            done.append(value)
+
+        pipeline = AsyncPipeline('test-backpressure', [[Stage('blocking', blocking)]],
+                                 lanes={'db': Lane('test-backpressure', 2)},
+                                 max_in_flight=2, max_backlog=3)
+        start = time.monotonic()
+        futures = [pipeline.submit(value) for value in range(7)]
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual((5, 3, 2), (pipeline.in_flight, pipeline.backlog, pipeline.dropped))
+        self.assertEqual([False] * 5 + [True] * 2, [future.cancelled() for future in futures])
+
+        release.set()
+        self.assertTrue(pipeline.join(timeout=10))
+        self.assertEqual([0, 1, 2, 3, 4], sorted(done))
+        self.assertTrue(all(future.done() for future in futures))
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            AsyncPipeline('test', [[Stage('bad', print, 'cpu')]])
+
+
+class AsyncCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.backup = cache_module._redis, cache_module._pure_redis
+        store = MemoryStore(sweep_interval=0)
+        cache_module._redis = MemoryRedis(store)
+        cache_module._pure_redis = MemoryRedis(store, decode_responses=True)
+
+    def tearDown(self):
+        cache_module._redis, cache_module._pure_redis = self.backup
+
+    def test_shares_data_with_sync_cache(self):
+        async def run():
+            await cache_module.async_cache.set('key', {'a': 1}, time=100)
+            await cache_module.async_pure_cache.incr('counter')
+            return await cache_module.async_pure_cache.incr('counter', 2)
+
+        self.assertEqual(3, asyncio.run(run()))
+        self.assertEqual({'a': 1}, cache_module.cache.get('key'))
+        self.assertEqual(3, cache_module.pure_cache.get_int('counter'))
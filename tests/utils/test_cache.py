@@ -0,0 +1,51 @@
+import fnmatch
+import unittest
+
+from tests.utils import real_modules
+
+with real_modules():
+    from src.utils.cache import scan_delete, TouchThrottle
+    from src.utils.cache_buckets import modulo_bucket
+
+
+class FakeRedis:
+    def __init__(self, keys):
+        self.keys = set(keys)
+
+    def scan_iter(self, match, count):
+        return iter([key for key in sorted(self.keys) if fnmatch.fnmatch(key, match)])
+
+    def unlink(self, *keys):
+        found = self.keys & set(keys)
+        self.keys -= found
+        return len(found)
+
+
+class ScanDeleteTest(unittest.TestCase):
+    def test_batches(self):
+        client = FakeRedis([f'user:{i}' for i in range(25)] + ['chatuser:1:1'])
+        progress = []
+        deleted = scan_delete(client, 'user:*', batch_size=10,
+                              progress=lambda scanned, count: progress.append((scanned, count)))
+        self.assertEqual(25, deleted)
+        self.assertEqual([(10, 10), (20, 20), (25, 25)], progress)
+        self.assertEqual({'chatuser:1:1'}, client.keys)
+
+
+class TouchThrottleTest(unittest.TestCase):
+    def test_throttle(self):
+        throttle = TouchThrottle(60)
+        calls = []
+        throttle.touch('a', lambda: calls.append('a'))
+        throttle.touch('a', lambda: calls.append('a'))
+        throttle.forget('b')
+        throttle.touch('b', lambda: calls.append('b'))
+        self.assertEqual(['a'], calls)
+
+
+class ModuloBucketTest(unittest.TestCase):
+    def test_same_bucket_for_int_and_str(self):
+        self.assertEqual('5', modulo_bucket(1029, 1024))
+        self.assertEqual(modulo_bucket(-100123, 1024), modulo_bucket('-100123', 1024))
+        self.assertEqual(modulo_bucket('a-b-c', 256), modulo_bucket('a-b-c', 256))
+        self.assertLess(int(modulo_bucket('a-b-c', 256)), 256)
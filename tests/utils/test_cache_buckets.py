@@ -0,0 +1,93 @@
+import pickle
+import unittest
+from unittest import mock
+
+from tests.utils import real_modules
+
+with real_modules():
+    from src.utils import cache as cache_module
+    from src.utils import cache_buckets
+    from src.utils.cache_buckets import BucketedCache
+    from src.utils.memory_cache import MemoryPipeline, MemoryRedis, MemoryStore
+
+
+class BucketedCacheTest(unittest.TestCase):
+    version = (7, 4)
+
+    def setUp(self):
+        self.backup = cache_module._redis, cache_module._pure_redis, cache_buckets._redis_version
+        self.store = MemoryStore(sweep_interval=0)
+        self.client = MemoryRedis(self.store)
+        cache_module._redis = self.client
+        cache_module._pure_redis = MemoryRedis(self.store, decode_responses=True)
+        cache_buckets._redis_version = self.version
+        self.commands = []
+        execute = MemoryPipeline.execute
+
+        def spy(pipe, *args, **kwargs):
+            self.commands.extend((raw.__name__, kwargs) for raw, _, kwargs in pipe.commands)
+            return execute(pipe, *args, **kwargs)
+
+        self.spy = mock.patch.object(MemoryPipeline, 'execute', spy)
+        self.spy.start()
+
+    def tearDown(self):
+        self.spy.stop()
+        cache_module._redis, cache_module._pure_redis, cache_buckets._redis_version = self.backup
+        BucketedCache.registry.clear()
+
+    def test_get_set_delete(self):
+        bucketed = BucketedCache('test_family', 100, bucket_of=lambda key: '1')
+        bucketed.set('a', {'x': 1})
+        bucketed.set('b', [2], bucket='2')
+        self.assertEqual({'x': 1}, bucketed.get('a'))
+        self.assertEqual([{'x': 1}, None], bucketed.get_many(['a', 'c']))
+        self.assertEqual([2], bucketed.get('b', bucket='2'))
+        bucketed.delete('a')
+        self.assertEqual('default', bucketed.get('a', default='default'))
+
+    def test_generations(self):
+        bucketed = BucketedCache('test_generations', 100, bucket_of=lambda key: '1',
+                                 generations=True)
+        with mock.patch('time.time', return_value=1000):
+            bucketed.set('a', 1)
+        with mock.patch('time.time', return_value=1150):
+            self.assertEqual(1, bucketed.get('a'))  # прошлое поколение
+            bucketed.set('b', 2)
+        with mock.patch('time.time', return_value=1250):
+            self.assertIsNone(bucketed.get('a'))
+            self.assertEqual(2, bucketed.get('b'))
+
+    def test_migrate_keeps_longer_ttl(self):
+        bucketed = BucketedCache('test_migrate', 100, bucket_of=lambda key: '1',
+                                 legacy_key='test_migrate:{field}')
+        self.client.set('test_migrate:old', pickle.dumps('old'), ex=50)
+        self.client.hset('test_migrate:h:1', 'new', pickle.dumps('new'))
+        self.client.expire('test_migrate:h:1', 1000)
+        self.assertEqual('old', bucketed.get('old'))  # до переноса читается старый ключ
+        self.assertEqual(1, bucketed.migrate())
+        self.assertEqual('old', bucketed.get('old'))
+        self.assertIsNone(self.client.get('test_migrate:old'))
+        if cache_buckets.is_field_ttl_supported():
+            self.assertEqual(1000, self.client.ttl('test_migrate:h:1'))
+        else:
+            self.assertGreater(self.client.ttl('test_migrate:h:1'), 900)
+
+    def test_expire_flags_only_on_supported_versions(self):
+        BucketedCache('test_flags', 100, bucket_of=lambda key: '1', generations=True).set('a', 1)
+        flags = [kwargs for name, kwargs in self.commands if name == 'expire' and kwargs]
+        self.assertEqual(cache_buckets.is_expire_flags_supported(), bool(flags))
+
+
+class FieldTtlUnsupportedTest(BucketedCacheTest):
+    version = (7, 2)
+
+    def test_set_extends_hash(self):
+        bucketed = BucketedCache('test_extend', 100, bucket_of=lambda key: '1')
+        bucketed.set('a', 1)
+        self.assertEqual(100, self.client.ttl('test_extend:h:1'))
+        self.assertNotIn('hexpire', [name for name, _ in self.commands])
+
+
+class ExpireFlagsUnsupportedTest(FieldTtlUnsupportedTest):
+    version = (6, 2)
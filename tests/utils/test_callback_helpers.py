@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+
+from tests.utils import real_modules
+
+with real_modules():
+    from src.config import CONFIG
+    from src.utils import cache as cache_module
+    from src.utils import callback_helpers
+    from src.utils.memory_cache import MemoryRedis, MemoryStore
+
+
+class CallbackDataTest(unittest.TestCase):
+    def setUp(self):
+        self.config = mock.patch.dict(CONFIG, {'bot_token': '123:secret'})
+        self.config.start()
+        self.backup = cache_module._redis, cache_module._pure_redis
+        self.store = MemoryStore(sweep_interval=0)
+        cache_module._redis = MemoryRedis(self.store)
+        cache_module._pure_redis = MemoryRedis(self.store, decode_responses=True)
+
+    def tearDown(self):
+        self.config.stop()
+        cache_module._redis, cache_module._pure_redis = self.backup
+
+    def test_small_data_is_encoded_into_button(self):
+        data = {'name': 'matshowtime', 'module': 'matshowtime',
+                'value': 'matshowtime_like_click', 'id': 12345678}
+        key = callback_helpers.get_callback_data(data)
+        self.assertTrue(key.startswith(callback_helpers.PREFIX))
+        self.assertLessEqual(len(key.encode('utf-8')), callback_helpers.MAX_CALLBACK_DATA)
+        self.assertEqual(data, callback_helpers.get_callback_data_by_key(key))
+        self.assertEqual(0, len(self.store.data))  # в редис ничего не записано
+
+    def test_value_types(self):
+        data = {'name': '/off', 'bot_command': 'кек', 'plohish_id': -1001234567890,
+                'x': [True, None, -1], 'y': {}}
+        key = callback_helpers.encode_callback_data(data)
+        self.assertEqual(data, callback_helpers.decode_callback_data(key))
+
+    def test_forged_data_is_rejected(self):
+        key = callback_helpers.get_callback_data({'name': 'i_stat', 'chat_id': 1})
+        middle = len(key) // 2
+        forged = key[:middle] + ('A' if key[middle] != 'A' else 'B') + key[middle + 1:]
+        self.assertIsNone(callback_helpers.get_callback_data_by_key(forged))
+        with mock.patch.dict(CONFIG, {'bot_token': '123:other'}):
+            self.assertIsNone(callback_helpers.get_callback_data_by_key(key))
+
+    def test_falls_back_to_redis(self):
+        too_long = {'name': 'last_word', 'leaves_uid': list(range(10 ** 6, 10 ** 6 + 20))}
+        unsupported = {'name': 'spoiler', 'ids': (1, 2)}
+        for data in (too_long, unsupported):
+            key = callback_helpers.get_callback_data(data)
+            self.assertFalse(key.startswith(callback_helpers.PREFIX))
+            self.assertEqual(data, callback_helpers.get_callback_data_by_key(key))
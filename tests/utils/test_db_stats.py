@@ -0,0 +1,58 @@
+import unittest
+
+from tests.utils import real_modules
+
+with real_modules():
+    from src.utils.db_stats import normalize_sql, get_statement_type, Histogram, DbStats, \
+        OTHER_STATEMENTS
+
+
+class NormalizeSqlTest(unittest.TestCase):
+    def test_literals(self):
+        sql = """
+            SELECT * FROM leave_logs
+            WHERE cid = -1001 AND date > '2026-10-12' AND uid IN (1, 2, 3)
+        """
+        self.assertEqual("SELECT * FROM leave_logs WHERE cid = ? AND date > ? AND uid IN (...)",
+                         normalize_sql(sql))
+
+    def test_params_and_names(self):
+        sql = 'SELECT t1.uid FROM user_stats_monthly t1 WHERE t1.cid = %(cid_1)s LIMIT %(param_1)s'
+        self.assertEqual(sql, normalize_sql(sql))
+
+    def test_statement_type(self):
+        self.assertEqual('select', get_statement_type(' SELECT 1'))
+        self.assertEqual('insert', get_statement_type('insert into users'))
+        self.assertEqual('other', get_statement_type('SHOW TABLES'))
+        self.assertEqual('other', get_statement_type(''))
+
+
+class DbStatsTest(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1.))
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.observe(value)
+        self.assertEqual([1, 2, 1], histogram.counts)
+        self.assertEqual(4, histogram.count)
+        self.assertAlmostEqual(4.25, histogram.sum)
+
+    def test_slow_queries(self):
+        stats = DbStats()
+        stats.slow_query_threshold = 0.5
+        stats.observe_statement('SELECT * FROM users WHERE uid = 1', 0.1)
+        stats.observe_statement('SELECT * FROM users WHERE uid = 2', 0.6)
+        self.assertEqual(['SELECT * FROM users WHERE uid = ?'],
+                         [q.sql for q in stats.get_slow_queries()])
+        statements = stats.snapshot()['statements']
+        self.assertEqual(2, statements['SELECT * FROM users WHERE uid = ?']['count'])
+
+    def test_statements_are_capped(self):
+        stats = DbStats()
+        stats.max_statements = 2
+        for table in ('users', 'chats', 'users', 'leave_logs', 'pidors'):
+            stats.observe_statement(f'SELECT * FROM {table} WHERE uid = 1', 0.01)
+        statements = stats.snapshot()['statements']
+        self.assertEqual({'SELECT * FROM users WHERE uid = ?', 'SELECT * FROM chats WHERE uid = ?',
+                          OTHER_STATEMENTS}, set(statements))
+        self.assertEqual(2, statements['SELECT * FROM users WHERE uid = ?']['count'])
+        self.assertEqual(2, statements[OTHER_STATEMENTS]['count'])
@@ -0,0 +1,106 @@
+import threading
+import unittest
+from functools import wraps
+
+from tests.utils import real_modules
+
+with real_modules():
+    from src.utils.handlers_decorators import _instrument_callback, instrument_handlers
+    from src.utils.lanes import Lane
+    from src.utils.metrics import get_handler_name, metrics
+
+
+def outer_decorator(func):
+    @wraps(func)
+    def decorator(*args, **kwargs):
+        return func(*args, **kwargs)
+
+    return decorator
+
+
+class LaneTest(unittest.TestCase):
+    def test_runs_in_lane_threads(self):
+        lane = Lane('test', workers=2)
+        threads = []
+
+        @lane
+        def task(value):
+            threads.append(threading.current_thread().name)
+            return value * 2
+
+        self.assertEqual(4, task(2).result(timeout=5))
+        self.assertTrue(lane.join(timeout=5))
+        self.assertTrue(threads[0].startswith('lane-test'))
+        self.assertEqual(1, lane.tasks)
+        self.assertEqual(0, lane.in_flight)
+
+    def test_saturation_and_errors(self):
+        lane = Lane('test', workers=1)
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocking():
+            started.set()
+            release.wait(5)
+            raise ValueError('task error')
+
+        lane.submit(blocking)
+        lane.submit(blocking)
+        started.wait(5)
+        self.assertEqual(1., lane.saturation)
+        self.assertEqual(1, lane.queued)
+        release.set()
+        self.assertTrue(lane.join(timeout=5))
+        self.assertEqual(0, lane.saturation)
+        self.assertEqual({'ValueError': 2}, dict(lane.errors))
+
+    def test_instrumented_handler_stays_in_lane(self):
+        lane = Lane('test', workers=1)
+        handled = []
+
+        @outer_decorator
+        @lane
+        def handler(bot, update):
+            handled.append(threading.current_thread().name)
+
+        instrumented = _instrument_callback(handler)
+        instrumented(None, None)
+        self.assertTrue(lane.join(timeout=5))
+        # внешний декоратор не должен приводить к двойной постановке в очередь
+        self.assertEqual(1, lane.tasks)
+        self.assertEqual(1, metrics.handlers[get_handler_name(handler)].updates)
+
+        lane_handler = lane(lambda bot, update: handled.append('direct'))
+        _instrument_callback(lane_handler)(None, None)
+        self.assertTrue(lane.join(timeout=5))
+        self.assertEqual(2, lane.tasks)
+        self.assertEqual('direct', handled[-1])
+
+    def test_unwrap(self):
+        lane = Lane('test', workers=1)
+
+        def handler(bot, update):
+            pass
+
+        lane_handler = lane(handler)
+        self.assertEqual((lane, handler), Lane.unwrap(lane_handler))
+        # у внешнего декоратора атрибуты полосы есть, но это не ее обертка
+        self.assertTrue(hasattr(outer_decorator(lane_handler), 'lane'))
+        self.assertIsNone(Lane.unwrap(outer_decorator(lane_handler)))
+        self.assertIsNone(Lane.unwrap(handler))
+
+    def test_instrumented_run_async(self):
+        busy = []
+
+        class Dispatcher:
+            handlers = {}
+
+            def run_async(self, func, *args, **kwargs):
+                return func(*args, **kwargs)
+
+        dp = Dispatcher()
+        instrument_handlers(dp)
+        queued = metrics.async_queued
+        dp.run_async(lambda value: busy.append((metrics.async_busy, value)), 1)
+        self.assertEqual([(1, 1)], busy)
+        self.assertEqual((queued, 0), (metrics.async_queued, metrics.async_busy))
@@ -0,0 +1,75 @@
+import unittest
+from concurrent.futures import Future
+
+from tests.utils import real_modules
+
+with real_modules():
+    from src.utils import cache as cache_module
+    from src.utils.leader_lease import LeaderLease
+    from src.utils.memory_cache import MemoryRedis, MemoryStore
+
+
+class LeaderLeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.backup = cache_module._redis, cache_module._pure_redis
+        self.store = MemoryStore(sweep_interval=0)
+        cache_module._redis = MemoryRedis(self.store)
+        cache_module._pure_redis = MemoryRedis(self.store, decode_responses=True)
+
+    def tearDown(self):
+        cache_module._redis, cache_module._pure_redis = self.backup
+
+    def test_single_leader_and_failover(self):
+        first = LeaderLease('jobs', owner='first', ttl=60)
+        second = LeaderLease('jobs', owner='second', ttl=60)
+        self.assertTrue(first.renew())
+        self.assertFalse(second.renew())
+        self.assertTrue(first.renew())  # продление своей аренды
+        self.assertTrue(first.is_leader)
+        self.assertFalse(second.is_leader)
+
+        # лидер упал и не продлил аренду
+        self.store.expires[b'__pure__:leader_lease:jobs'] = 0
+        self.assertTrue(second.renew())
+        self.assertFalse(first.renew())
+        self.assertFalse(first.is_leader)
+
+    def test_stop_releases_lease(self):
+        first = LeaderLease('jobs', owner='first', ttl=60)
+        second = LeaderLease('jobs', owner='second', ttl=60)
+        first.start()
+        first.stop()
+        self.assertTrue(second.renew())
+
+    def test_guard(self):
+        lease = LeaderLease('jobs', owner='first', ttl=60)
+        calls = []
+        job = lease.guard(lambda bot, _: calls.append(bot))
+        job('not leader', None)
+        lease.renew()
+        job('leader', None)
+        self.assertEqual(['leader'], calls)
+
+    def test_guard_records_last_run(self):
+        lease = LeaderLease('jobs', owner='first', ttl=60)
+        lease.renew()
+        future = Future()
+        lease.guard(lambda bot, _: None, 'sync')('bot', None)
+        lease.guard(lambda bot, _: future, 'lane')('bot', None)
+        self.assertIsNotNone(LeaderLease.get_last_run('sync'))
+        self.assertIsNone(LeaderLease.get_last_run('lane'))
+        future.set_result(None)
+        self.assertIsNotNone(LeaderLease.get_last_run('lane'))
+
+    def test_on_acquire(self):
+        first = LeaderLease('jobs', owner='first', ttl=60)
+        second = LeaderLease('jobs', owner='second', ttl=60)
+        acquired = []
+        second.on_acquire(lambda: acquired.append('second'))
+        first.renew()
+        second.renew()
+        self.assertEqual([], acquired)
+        first.stop()
+        second.renew()
+        second.renew()  # продление — не получение
+        self.assertEqual(['second'], acquired)
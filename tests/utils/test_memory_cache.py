@@ -0,0 +1,132 @@
+import os
+import tempfile
+import unittest
+
+from tests.utils import real_modules
+
+with real_modules():
+    import redis
+
+    from src.utils import cache as cache_module
+    from src.utils.memory_cache import MemoryRedis, MemoryStore
+
+
+class MemoryRedisTest(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore(sweep_interval=0)
+        self.client = MemoryRedis(self.store)
+        self.pure = MemoryRedis(self.store, decode_responses=True)
+
+    def expire_now(self, key: bytes):
+        self.store.expires[key] = 0
+
+    def test_strings(self):
+        self.assertTrue(self.client.set('a', 1, ex=100))
+        self.assertEqual(b'1', self.client.get('a'))
+        self.assertEqual('1', self.pure.get('a'))
+        self.assertEqual([b'1', None], self.client.mget(['a', 'b']))
+        self.assertIsNone(self.client.set('a', 2, nx=True))
+        self.assertEqual(3, self.client.incr('a', 2))
+        self.assertGreater(self.client.ttl('a'), 90)  # incr не сбрасывает TTL
+        self.assertEqual(-2, self.client.ttl('b'))
+
+        self.expire_now(b'a')
+        self.assertIsNone(self.client.get('a'))
+        self.assertEqual(0, self.client.exists('a'))
+
+    def test_expire_flags(self):
+        self.client.set('a', 'x')
+        self.assertFalse(self.client.expire('a', 100, gt=True))  # без TTL ключ вечный
+        self.assertTrue(self.client.expire('a', 100, nx=True))
+        self.assertFalse(self.client.expire('a', 10, gt=True))
+        self.assertTrue(self.client.expire('a', 1000, gt=True))
+        self.assertFalse(self.client.expire('missing', 10))
+
+    def test_wrong_type(self):
+        self.client.rpush('l', 'a')
+        with self.assertRaises(redis.ResponseError):
+            self.client.get('l')
+
+    def test_collections(self):
+        self.pure.rpush('l', 'a', 'b', 'c')
+        self.assertEqual(['b', 'c'], self.pure.lrange('l', 1, -1))
+        self.assertEqual(['a', 'b'], self.pure.lrange('l', 0, 1))
+
+        self.assertEqual(2, self.pure.sadd('s', 1, 2, 2))
+        self.assertEqual({'1', '2'}, self.pure.smembers('s'))
+        self.assertTrue(self.pure.sismember('s', 1))
+        self.assertEqual(2, len(self.pure.srandmember('s', 5)))
+        self.assertEqual(2, self.pure.srem('s', 1, 2))
+        self.assertEqual(0, self.pure.exists('s'))  # пустое множество удаляется
+
+    def test_hash_field_ttl(self):
+        self.assertEqual(2, self.client.hset('h', mapping={'a': 1, 'b': 2}))
+        self.assertFalse(self.client.hsetnx('h', 'a', 3))
+        self.assertEqual([1, -2], self.client.hexpire('h', 100, 'a', 'c'))
+        self.store.field_expires[b'h'][b'a'] = 0
+        self.assertIsNone(self.client.hget('h', 'a'))
+        self.assertEqual(b'2', self.client.hget('h', 'b'))
+        self.client.hdel('h', 'b')
+        self.assertEqual(0, self.client.exists('h'))
+
+    def test_pipeline_and_scan(self):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set('user:1', 'a')
+        pipe.set('user:2', 'b')
+        pipe.incr('user:1')
+        pipe.get('user:2')
+        results = pipe.execute(raise_on_error=False)
+        self.assertIsInstance(results[2], redis.ResponseError)
+        self.assertEqual(b'b', results[3])
+        self.assertEqual({'user:1', 'user:2'}, set(self.pure.scan_iter(match='user:*')))
+        self.assertEqual(2, cache_module.scan_delete(self.client, 'user:*', batch_size=1))
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.pickle')
+            store = MemoryStore(snapshot=path, sweep_interval=0)
+            client = MemoryRedis(store)
+            client.set('kept', 'x', ex=100)
+            client.set('expired', 'x', ex=100)
+            store.expires[b'expired'] = 0
+            store.save()
+
+            loaded = MemoryRedis(MemoryStore(snapshot=path, sweep_interval=0))
+            self.assertEqual(b'x', loaded.get('kept'))
+            self.assertIsNone(loaded.get('expired'))
+
+
+class PureCacheOnMemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.backup = cache_module._redis, cache_module._pure_redis
+        store = MemoryStore(sweep_interval=0)
+        cache_module._redis = MemoryRedis(store)
+        cache_module._pure_redis = MemoryRedis(store, decode_responses=True)
+
+    def tearDown(self):
+        cache_module._redis, cache_module._pure_redis = self.backup
+
+    def test_update_existing_set(self):
+        pure_cache = cache_module.pure_cache
+        self.assertFalse(pure_cache.update_existing_set('members', add=1))
+        pure_cache.replace_set('members', [1, 2])
+        self.assertTrue(pure_cache.update_existing_set('members', add=3, remove=1))
+        self.assertEqual({'2', '3'}, pure_cache.get_set('members'))
+
+    def test_take_hash(self):
+        pure_cache = cache_module.pure_cache
+        pure_cache.incr_hash_field('pending', '1:2:202405', 3)
+        pure_cache.incr_hash_field('pending', '1:2:202405', 2)
+        self.assertEqual({'1:2:202405': '5'}, pure_cache.take_hash('pending', 'flushing'))
+        pure_cache.incr_hash_field('pending', '1:3:202405')
+        # пока старое не обработано, новое ждет
+        self.assertEqual({'1:2:202405': '5'}, pure_cache.take_hash('pending', 'flushing'))
+        pure_cache.delete('flushing')
+        self.assertEqual({'1:3:202405': '1'}, pure_cache.take_hash('pending', 'flushing'))
+
+    def test_cache(self):
+        cache = cache_module.cache
+        cache.set('value', {'a': [1, 2]}, time=100)
+        self.assertEqual({'a': [1, 2]}, cache.get('value'))
+        self.assertEqual(1, cache.delete_by_pattern('val*'))
+        self.assertEqual('default', cache.get('value', 'default'))
@@ -0,0 +1,42 @@
+import unittest
+
+from tests.utils import real_modules
+
+with real_modules():
+    from src.utils.metrics import Metrics, render_histogram, escape_label
+    from src.utils.db_stats import Histogram
+
+
+class MetricsTest(unittest.TestCase):
+    def test_calls_are_attributed_to_handler(self):
+        metrics = Metrics()
+        metrics.record_call('redis', 0.5)
+        with metrics.track_handler('weather'):
+            metrics.record_call('redis', 0.25)
+            metrics.record_call('mysql', 0.125)
+        with self.assertRaises(ValueError):
+            with metrics.track_handler('weather'):
+                raise ValueError()
+
+        stats = metrics.handlers['weather']
+        self.assertEqual((2, 1), (stats.updates, stats.errors))
+        self.assertEqual({'redis': 1, 'mysql': 1}, stats.calls)
+        self.assertEqual(2, metrics.calls['redis'])
+        text = metrics.render()
+        self.assertIn('bot_handler_updates_total{handler="weather"} 2', text)
+        self.assertIn('bot_handler_backend_seconds_total{handler="weather",backend="mysql"} '
+                      '0.125000', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram((0.1, 1.))
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.observe(value)
+        lines = []
+        render_histogram(lines, 'x', 'h="a"', histogram)
+        self.assertEqual(['x_bucket{h="a",le="0.1"} 1', 'x_bucket{h="a",le="1.0"} 3',
+                          'x_bucket{h="a",le="+Inf"} 4', 'x_sum{h="a"} 4.250000',
+                          'x_count{h="a"} 4'], lines)
+
+    def test_escape_label(self):
+        self.assertEqual('SELECT ? FROM t WHERE a = \\"b\\" AND c = \\\\',
+                         escape_label('SELECT ? FROM t WHERE a = "b" AND c = \\'))
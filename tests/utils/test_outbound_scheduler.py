@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+
+from tests.utils import real_modules
+
+with real_modules():
+    import telegram
+
+    from src.utils.outbound_scheduler import TokenBucket, OutboundScheduler, Priority
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+        now = bucket.updated
+        self.assertEqual(0, bucket.wait_time(now))
+        bucket.consume(now)
+        bucket.consume(now)
+        self.assertAlmostEqual(0.5, bucket.wait_time(now))
+        self.assertEqual(0, bucket.wait_time(now + 0.5))
+
+
+class OutboundSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.dsp = OutboundScheduler(global_rate=1000, global_burst=1000,
+                                     group_rate=1000, group_burst=1000)
+        self.sent = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.dsp.stop(1)
+
+    def send(self, chat_id, text):
+        self.sent.append((chat_id, text))
+        if text == 'last':
+            self.done.set()
+
+    def test_guess_chat_id(self):
+        self.assertEqual(-1, OutboundScheduler._guess_chat_id((-1, 'text')))
+        self.assertIsNone(OutboundScheduler._guess_chat_id(('text', -1)))
+        self.assertIsNone(OutboundScheduler._guess_chat_id(()))
+
+    def test_share_global_limit(self):
+        self.dsp.share_global_limit(4)
+        self.assertEqual(250, self.dsp.global_bucket.rate)
+        self.assertEqual(250, self.dsp.global_bucket.capacity)
+        small = OutboundScheduler(global_rate=25, global_burst=2)
+        small.share_global_limit(4)
+        self.assertEqual(1, small.global_bucket.capacity)
+        small.stop(1)
+
+    def test_priority_and_order(self):
+        gate = threading.Event()
+        self.dsp.put(gate.wait, (1,), chat_id=-3)  # придерживаем очередь
+        self.dsp.put(self.send, (-1, 'report 1'), chat_id=-1, priority=Priority.REPORT)
+        self.dsp.put(self.send, (-1, 'report 2'), chat_id=-1, priority=Priority.REPORT)
+        self.dsp.put(self.send, (-2, 'reply'), chat_id=-2, priority=Priority.INTERACTIVE)
+        self.dsp.put(self.send, (-2, 'last'), chat_id=-2, priority=Priority.REPORT)
+        gate.set()
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual([(-2, 'reply'), (-1, 'report 1'), (-1, 'report 2'), (-2, 'last')],
+                         self.sent)
+        self.assertEqual(0, self.dsp.stats()['depth'])
+
+    def test_retry_after(self):
+        calls = []
+
+        def flood(chat_id, text):
+            calls.append(text)
+            if len(calls) == 1:
+                raise telegram.error.RetryAfter(0.1)
+            self.send(chat_id, text)
+
+        self.dsp.put(flood, (-1, 'last'), chat_id=-1)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(['last', 'last'], calls)
+        self.assertEqual(1, self.dsp.stats()['retry_after'])
+
+    def test_chatless_retry_after_does_not_block_chats(self):
+        def flood():
+            raise telegram.error.RetryAfter(5)
+
+        self.dsp.put(flood)
+        self.dsp.put(self.send, (-1, 'last'), chat_id=-1)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(1, self.dsp.stats()['depth'])  # сообщение без чата еще ждет
+
+    def test_prune(self):
+        with self.dsp._cond:
+            now = time.monotonic()
+            self.dsp._get_bucket(-5).consume(now)
+            self.dsp._blocked_until[-5] = now + 1
+            self.dsp._prune(now)
+            self.assertIn(-5, self.dsp._buckets)
+            self.assertIn(-5, self.dsp._blocked_until)
+            self.dsp._prune(now + 100)
+            self.assertNotIn(-5, self.dsp._buckets)
+            self.assertNotIn(-5, self.dsp._blocked_until)
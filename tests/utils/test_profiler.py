@@ -0,0 +1,39 @@
+import os
+import tempfile
+import time
+import unittest
+from collections import Counter
+
+from tests.utils import real_modules
+
+with real_modules():
+    from src.utils.profiler import SlowUpdateProfiler, get_top_from_samples
+
+
+def slow_part():
+    time.sleep(0.3)
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_top_from_samples(self):
+        samples = Counter({
+            (('a.py', 'main'), ('b.py', 'query')): 3,
+            (('a.py', 'main'), ('c.py', 'regex')): 1,
+        })
+        self.assertEqual([('a.py:main', 1.), ('b.py:query', .75)], get_top_from_samples(samples, 2))
+
+    def test_only_slow_updates_are_saved(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = SlowUpdateProfiler(enabled=True, threshold_ms=100, interval_ms=5,
+                                          directory=directory, keep=1)
+            with profiler.watch('fast', -1):
+                pass
+            self.assertFalse(os.path.exists(directory) and os.listdir(directory))
+            for _ in range(2):
+                with profiler.watch('slow', -1):
+                    slow_part()
+            files = os.listdir(directory)
+            self.assertEqual(1, len(files))
+            self.assertIn('_-1_slow_', files[0])
+            with open(os.path.join(directory, files[0])) as f:
+                self.assertIn('slow_part', f.read())
@@ -0,0 +1,35 @@
+import pickle
+import unittest
+
+from src.utils.redis_analyzer import get_family, get_ttl_bucket, describe_value, FamilyStats
+
+
+class GetFamilyTest(unittest.TestCase):
+    def test_variable_parts(self):
+        self.assertEqual('userstat', get_family('userstat:20200106:-1001:123'))
+        self.assertEqual('bayanometer:photo', get_family('bayanometer:photo:-1001:dhash:ffe0c0'))
+        self.assertEqual('__pure__:metrics:messages',
+                         get_family('__pure__:metrics:messages:20200106'))
+        self.assertEqual('callback', get_family('callback:1b4e28ba-2fa1-11d2-883f-0016d3cca427'))
+        self.assertEqual('pipinder:fav_stickersets_names',
+                         get_family('pipinder:fav_stickersets_names'))
+
+
+class DescribeValueTest(unittest.TestCase):
+    def test_values(self):
+        self.assertEqual('int', describe_value(b'42'))
+        self.assertEqual('str', describe_value(b'hello'))
+        self.assertEqual('pickle:dict', describe_value(pickle.dumps({'a': (1, 2)})))
+        self.assertEqual('pickle:unittest.case.TestCase',
+                         describe_value(pickle.dumps(unittest.TestCase)))
+
+
+class FamilyStatsTest(unittest.TestCase):
+    def test_warnings(self):
+        stats = FamilyStats('mat:words')
+        stats.add('mat:words:20200106:-1', 'list', -1, 100)
+        stats.add_length('mat:words:20200106:-1', 50)
+        self.assertEqual('none', get_ttl_bucket(-1))
+        self.assertEqual('<1d', get_ttl_bucket(3600))
+        self.assertEqual(['1 keys with a date in the name have no TTL',
+                          'mat:words:20200106:-1 has 50 elements'], stats.get_warnings(10))
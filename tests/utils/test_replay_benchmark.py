@@ -0,0 +1,36 @@
+import unittest
+
+from tests.utils import real_modules
+
+with real_modules():
+    import telegram
+
+    from src.utils.replay_benchmark import SyntheticUpdates, FakeRequest, percentile, BOT_TOKEN
+
+
+class PercentileTest(unittest.TestCase):
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(50., percentile(values, 50))
+        self.assertEqual(99., percentile(values, 99))
+        self.assertEqual(100., percentile(values, 100))
+        self.assertEqual(0., percentile([], 50))
+
+
+class SyntheticUpdatesTest(unittest.TestCase):
+    def test_same_seed_same_updates(self):
+        first = list(SyntheticUpdates(seed=7).generate(50))
+        second = list(SyntheticUpdates(seed=7).generate(50))
+        # даты берутся от текущего времени
+        for update in first + second:
+            update['message'].pop('date')
+        self.assertEqual(first, second)
+
+    def test_updates_are_parsed(self):
+        bot = telegram.Bot(BOT_TOKEN, request=FakeRequest())
+        updates = list(SyntheticUpdates(chats=2, users=10).generate(200))
+        self.assertEqual(list(range(1, 201)), [update['update_id'] for update in updates])
+        for update in updates:
+            message = telegram.Update.de_json(update, bot).message
+            self.assertIsNotNone(message.from_user)
+            self.assertTrue(message.text or message.sticker or message.photo)
@@ -0,0 +1,25 @@
+import pickle
+import unittest
+
+from src.utils.misc import SlotsState
+
+
+class Point(SlotsState):
+    __slots__ = ('x', 'y', 'label')
+
+    def __init__(self, x=0, y=0, label=None):
+        self.x = x
+        self.y = y
+        self.label = label
+
+
+class SlotsStateTest(unittest.TestCase):
+    def test_pickle(self):
+        point = pickle.loads(pickle.dumps(Point(1, 2, 'a')))
+        self.assertEqual((1, 2, 'a'), (point.x, point.y, point.label))
+
+    def test_old_dict_state(self):
+        # так выглядело состояние до __slots__: словарь, в котором может не быть новых полей
+        point = Point.__new__(Point)
+        point.__setstate__({'x': 5, 'unknown': 1})
+        self.assertEqual((5, 0, None), (point.x, point.y, point.label))
@@ -0,0 +1,24 @@
+import unittest
+from datetime import datetime, time
+from zoneinfo import ZoneInfo
+
+from src.utils.time_helpers import get_last_due
+
+MSK = ZoneInfo('Europe/Moscow')
+
+
+class GetLastDueTest(unittest.TestCase):
+    def test_daily(self):
+        at = time(0, 0, 10, tzinfo=MSK)
+        # 23:00 UTC — это уже 02:00 следующего дня по Москве
+        now = datetime(2024, 5, 7, 23, 0, tzinfo=ZoneInfo('UTC'))
+        self.assertEqual(datetime(2024, 5, 8, 0, 0, 10, tzinfo=MSK),
+                         get_last_due(at, tuple(range(7)), now))
+        before = datetime(2024, 5, 8, 0, 0, 5, tzinfo=MSK)
+        self.assertEqual(datetime(2024, 5, 7, 0, 0, 10, tzinfo=MSK),
+                         get_last_due(at, tuple(range(7)), before))
+
+    def test_weekly(self):
+        at = time(0, 0, 10, tzinfo=MSK)
+        now = datetime(2024, 5, 8, 12, 0, tzinfo=MSK)  # среда
+        self.assertEqual(datetime(2024, 5, 6, 0, 0, 10, tzinfo=MSK), get_last_due(at, (0,), now))